@@ -0,0 +1,554 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Checks Authorization headers outside of any web framework.
+
+Authorizer holds everything OAuthHandler does when it authorizes a request:
+header parsing, credential caching, negative caching, coalescing, early
+refresh, stale-if-error and session tickets. OAuthHandler is an Authorizer,
+and middleware.OAuthMiddleware uses one for any WSGI application.
+
+Settings are class attributes, as on OAuthHandler. Override them in a
+subclass, or pass them to the constructor:
+
+authorizer = Authorizer(supported_services=[FACEBOOK_SERVICE],
+                        cache_backend=cache.MemcachedBackend())
+
+identity = authorizer.authorize("Facebook 1234|token")
+identity.service, identity.user_id, identity.ticket
+
+authorize() keeps no per-request state, so one Authorizer can serve every
+thread in the process. Its caches, like the verifiers' connection pool, are
+shared process-wide. It raises an OAuthException if the credentials are
+rejected, and a verifier.UpstreamException if the provider can't give an
+answer: it can't be reached, answers with a 5xx, runs past the deadline
+or has its circuit breaker open.
+
+authorize_async() does the same and returns an eventloop.Future, verifying
+with verify_async() so the calling thread's event loop isn't blocked while
+the provider answers.
+"""
+
+import collections
+import math
+import random
+import sys
+import threading
+import time
+
+import cache
+import eventloop
+import header
+import metrics
+import ratelimit
+import singleflight
+import verifier
+
+#The result of a successful authorization. ticket is None unless a ticket_signer is set.
+Identity = collections.namedtuple("Identity", ["service", "user_id", "ticket"])
+
+
+class Authorizer(object):
+    # You can set a custom array of services you want to support.
+    supported_services = [verifier.TWITTER_SERVICE, verifier.FACEBOOK_SERVICE, verifier.GOOGLE_SERVICE]
+
+    #Only necessary for Twitter. These should be kept secret.
+    consumer_key = None
+    consumer_secret = None
+
+    #Set this to your Google OAuth client ID (or a list of them) to accept
+    #Google ID tokens instead of access tokens. ID tokens are verified
+    #locally against Google's cached signing keys, with no call to Google.
+    google_id_token_audience = None
+
+    #Longer Authorization headers are rejected without being parsed.
+    max_authorization_header_length = header.MAX_HEADER_LENGTH
+
+    #Set this to a ticket.TicketSigner to give verified users a short-lived
+    #signed ticket in the ticket_response_header response header. Clients can
+    #then send "Authorization: Ticket <ticket>" until it expires, and those
+    #requests are checked with one HMAC, without the cache or the provider.
+    ticket_signer = None
+    ticket_response_header = "X-OAuth-Ticket"
+
+    #Cut down on network traffic by saving oAuth tokens
+    #to memcache. Requests can then be verfied without hitting the
+    #service provider. Note that if you turn this option off,
+    # you might run up against rate limits from the 3rd party provider.
+    use_credential_caching = True
+
+    #Expiration time for cached tokens
+    credential_caching_period = 900
+
+    #Where cached credentials are stored. Defaults to process memory, which
+    #works anywhere; use cache.MemcachedBackend() to share them between
+    #processes. OAuthHandler defaults to App Engine's memcache instead.
+    cache_backend = cache.MemoryBackend()
+
+    #Hot credentials are also kept in process memory, so most requests
+    #don't need a memcache RPC. The cache is shared by every handler in
+    #the process; replace it with cache.LocalCache(max_size=...) to resize it.
+    #Entries never live longer than credential_caching_period.
+    use_local_cache = True
+    local_cache = cache.LocalCache(max_size=10000)
+    local_cache_period = 60
+
+    #Where save_local_cache() and load_local_cache() keep a snapshot of
+    #local_cache, so a restarted process doesn't re-verify every user. Only
+    #hashed keys and timestamps are written.
+    local_cache_snapshot_path = None
+
+    #Set this to a cache.SharedMemoryCache to share verified credentials
+    #between the processes on a host. It is checked after local_cache and
+    #before cache_backend.
+    shared_cache = None
+
+    #Concurrent requests with identical credentials share one provider
+    #verification instead of each calling the provider.
+    coalesce_verifications = True
+    verification_flight = singleflight.SingleFlight()
+
+    #Tokens the provider rejected with a 400 or 401 are remembered for a
+    #short time, so clients retrying a dead token don't reach the provider.
+    #Timeouts and 5xx errors are never cached.
+    use_negative_caching = True
+    negative_caching_period = 30
+    negative_cache = cache.LocalCache(max_size=10000)
+
+    #Cache hits close to expiry sometimes re-verify the credentials in the
+    #background while the cached answer is served, so a hot user's entry is
+    #renewed before it expires. The chance of a refresh grows as expiry gets
+    #closer; early_refresh_delta sets the scale in seconds.
+    use_early_refresh = True
+    early_refresh_delta = 30
+
+    #Keep expired entries this many more seconds, and serve them when the
+    #provider can't be reached (5xx errors, timeouts). Off by default.
+    stale_if_error_period = 0
+
+    #Seconds authorize() may spend asking the provider, when it isn't
+    #given a deadline. None leaves only the verifiers' connect and read
+    #timeouts.
+    verification_deadline = None
+
+    refresh_lock = threading.Lock()
+    refreshes_in_flight = set()
+
+    def __init__(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(Authorizer, name):
+                raise TypeError("Unknown Authorizer setting: %s" % name)
+            setattr(self, name, value)
+
+    def authorize(self, authorization_header, deadline=None):
+        """Checks an Authorization header. -> Identity.
+
+        deadline is the most seconds to spend asking the provider.
+        """
+        service, user_id, token, token_secret = self.parse_authorization_header(authorization_header)
+
+        if service == header.TICKET_SCHEME:
+            return self.authorize_ticket(token)
+
+        entry = self.load_cached_credentials(service, user_id, token, token_secret)
+        if entry:
+            return self.identity_for(service, user_id, Authorizer.entry_usable_until(entry))
+
+        try:
+            verified_user_id, expires_at = self.verify_credentials(
+                service, user_id, token, token_secret,
+                deadline if deadline is not None else self.verification_deadline)
+        except Exception:
+            entry = self.verification_failed(service, user_id, token, token_secret)
+            return self.identity_for(service, user_id, Authorizer.entry_usable_until(entry))
+
+        self.cache_credentials(service, user_id, token, token_secret, expires_at)
+        return self.identity_for(service, verified_user_id, expires_at)
+
+    @eventloop.tasklet
+    def authorize_async(self, authorization_header, deadline=None):
+        """Non-blocking authorize(). Returns an eventloop.Future for the same result.
+
+        Cache lookups still happen on the calling thread; only the provider
+        is asked without blocking.
+        """
+        service, user_id, token, token_secret = self.parse_authorization_header(authorization_header)
+
+        if service == header.TICKET_SCHEME:
+            raise eventloop.Return(self.authorize_ticket(token))
+
+        entry = self.load_cached_credentials(service, user_id, token, token_secret)
+        if entry:
+            raise eventloop.Return(self.identity_for(service, user_id, Authorizer.entry_usable_until(entry)))
+
+        try:
+            verified_user_id, expires_at = yield self.verify_credentials_async(
+                service, user_id, token, token_secret,
+                deadline if deadline is not None else self.verification_deadline)
+        except Exception:
+            entry = self.verification_failed(service, user_id, token, token_secret)
+            raise eventloop.Return(self.identity_for(service, user_id, Authorizer.entry_usable_until(entry)))
+
+        self.cache_credentials(service, user_id, token, token_secret, expires_at)
+        raise eventloop.Return(self.identity_for(service, verified_user_id, expires_at))
+
+    def parse_authorization_header(self, authorization_header):
+        if not authorization_header:
+            raise verifier.OAuthException("Authorization header is required.")
+
+        service, user_id, token, token_secret = header.parse_authorization_header(
+            authorization_header, self.max_authorization_header_length)
+
+        if service != header.TICKET_SCHEME and service not in self.supported_services:
+            raise verifier.OAuthException("%s authentication not supported." % service)
+
+        return service, user_id, token, token_secret
+
+    def verification_failed(self, service, user_id, token, token_secret=None):
+        """Called from an except block. -> the stale cache entry if one can be served, or re-raises."""
+        exc_type, e, tb = sys.exc_info()
+
+        if isinstance(e, verifier.OAuthException):
+            if self.stale_if_error_period > 0:
+                self.forget_credentials(service, user_id, token, token_secret)
+
+        else:
+            entry = self.load_stale_credentials(service, user_id, token, token_secret)
+            if entry:
+                return entry
+
+        raise exc_type, e, tb
+
+    def identity_for(self, service, user_id, expires_at=None):
+        #Tickets are only issued for provider credentials, so a ticket can't be
+        #renewed with itself forever. Nor do they outlive the provider token.
+        ticket = self.ticket_signer.issue(service, user_id, expires_at=expires_at) if self.ticket_signer else None
+        return Identity(service, user_id, ticket)
+
+    def authorize_ticket(self, value):
+        if not self.ticket_signer:
+            raise verifier.OAuthException("Ticket authentication not supported.")
+
+        try:
+            service, user_id, expires_at = self.ticket_signer.verify(value)
+        except ValueError as e:
+            raise verifier.OAuthException(str(e), 401)
+
+        if service not in self.supported_services:
+            raise verifier.OAuthException("%s authentication not supported." % service)
+
+        return Identity(service, user_id, None)
+
+    def verifier_for(self, service, user_id, token, token_secret=None):
+        return verifier.verifier_for(service, user_id, token, token_secret,
+                                     self.consumer_key, self.consumer_secret,
+                                     google_audience=self.google_id_token_audience)
+
+    def verify_credentials(self, service, user_id, token, token_secret=None, deadline=None,
+                           priority=ratelimit.INTERACTIVE):
+        """-> (verified user ID, when the provider says the token expires, or None)."""
+        cache_key = Authorizer.key_for_credentials(service, user_id, token, token_secret)
+        self.check_rejected_credentials(cache_key)
+
+        credentials_verifier = self.verifier_for(service, user_id, token, token_secret)
+        credentials_verifier.priority = priority
+
+        try:
+            if not self.coalesce_verifications:
+                return Authorizer.run_verifier(credentials_verifier, deadline)
+
+            #Requests that join a verification in flight wait on the first request's deadline.
+            #They only join one of the same priority: a user logging in mustn't share the
+            #fate of a background refresh, which is refused first when the quota runs low.
+            return self.verification_flight.do((cache_key, priority), Authorizer.run_verifier,
+                                               credentials_verifier, deadline)
+
+        except verifier.OAuthException as e:
+            if e.code in (400, 401):
+                self.cache_rejected_credentials(cache_key, e)
+            raise
+
+    @eventloop.tasklet
+    def verify_credentials_async(self, service, user_id, token, token_secret=None, deadline=None):
+        cache_key = Authorizer.key_for_credentials(service, user_id, token, token_secret)
+        self.check_rejected_credentials(cache_key)
+
+        credentials_verifier = self.verifier_for(service, user_id, token, token_secret)
+
+        try:
+            if not self.coalesce_verifications:
+                verification = yield Authorizer.run_verifier_async(credentials_verifier, deadline)
+            else:
+                verification = yield self.verification_flight.do_async(
+                    (cache_key, ratelimit.INTERACTIVE), Authorizer.run_verifier_async, credentials_verifier, deadline)
+
+        except verifier.OAuthException as e:
+            if e.code in (400, 401):
+                self.cache_rejected_credentials(cache_key, e)
+            raise
+
+        raise eventloop.Return(verification)
+
+    @staticmethod
+    def run_verifier(credentials_verifier, deadline=None):
+        return credentials_verifier.verify(deadline), credentials_verifier.expires_at
+
+    @staticmethod
+    @eventloop.tasklet
+    def run_verifier_async(credentials_verifier, deadline=None):
+        verified_user_id = yield credentials_verifier.verify_async(deadline)
+        raise eventloop.Return((verified_user_id, credentials_verifier.expires_at))
+
+    @staticmethod
+    def key_for_credentials(service, user_id, token, token_secret=None):
+        return cache.key_for_credentials(service, user_id, token, token_secret)
+
+    def load_cached_credentials(self, service, user_id, token, token_secret=None):
+        """-> the fresh cache entry for the credentials, or None."""
+        cache_key = Authorizer.key_for_credentials(service, user_id, token, token_secret)
+        entry = self.cache_get(cache_key) if self.use_credential_caching else None
+        now = time.time()
+
+        if entry and Authorizer.entry_is_fresh(entry, now):
+            metrics.get_metrics().increment("oauth_cache_lookups_total", {"result": "hit"})
+
+            if self.should_refresh_early(entry, now):
+                self.refresh_credentials_in_background(service, user_id, token, token_secret)
+
+            return entry
+
+        else:
+            metrics.get_metrics().increment("oauth_cache_lookups_total", {"result": "miss"})
+            return None
+
+    def load_stale_credentials(self, service, user_id, token, token_secret=None):
+        """-> the cache entry for the credentials if it can still be served stale, or None."""
+        if not self.use_credential_caching or self.stale_if_error_period <= 0:
+            return None
+
+        cache_key = Authorizer.key_for_credentials(service, user_id, token, token_secret)
+        entry = self.cache_get(cache_key)
+
+        if entry and (entry is True or time.time() < self.stale_until(entry)):
+            metrics.get_metrics().increment("oauth_cache_lookups_total", {"result": "stale"})
+            return entry
+
+        return None
+
+    def cache_credentials(self, service, user_id, token, token_secret=None, expires_at=None):
+        """Caches verified credentials for credential_caching_period seconds.
+
+        If the provider said when the token expires, the entry is neither
+        fresh nor served stale past that time.
+        """
+        now = time.time()
+        period = self.credential_caching_period
+
+        if expires_at is not None:
+            period = min(period, expires_at - now)
+
+            #Memcache TTLs are whole seconds, and 0 would mean forever.
+            if period < 1:
+                return
+
+        cache_key = Authorizer.key_for_credentials(service, user_id, token, token_secret)
+        entry = (now, now + period) if expires_at is None else (now, now + period, expires_at)
+
+        self.cache_backend.set(cache_key, entry, max(1, int(math.ceil(self.stale_until(entry) - now))))
+        self.shared_cache_set(cache_key, entry)
+        self.local_cache_set(cache_key, entry)
+
+    def forget_credentials(self, service, user_id, token, token_secret=None):
+        cache_key = Authorizer.key_for_credentials(service, user_id, token, token_secret)
+        self.cache_backend.delete(cache_key)
+        if self.shared_cache:
+            self.shared_cache.delete(cache_key)
+        self.local_cache.delete(cache_key)
+
+    @staticmethod
+    def entry_is_fresh(entry, now):
+        #Entries are (verified_at, expires_at), plus the provider token's
+        #expiry when it is known. Older versions stored True.
+        return entry is True or now < entry[1]
+
+    @staticmethod
+    def entry_usable_until(entry):
+        """-> the time after which entry must not be served at all, or None if there is no limit."""
+        return entry[2] if entry is not True and len(entry) > 2 else None
+
+    def stale_until(self, entry):
+        """-> the time until which entry may be served stale, capped at entry_usable_until()."""
+        until = entry[1] + self.stale_if_error_period
+        usable_until = Authorizer.entry_usable_until(entry)
+        return min(until, usable_until) if usable_until is not None else until
+
+    def should_refresh_early(self, entry, now):
+        if not self.use_early_refresh or entry is True:
+            return False
+
+        #Probabilistic early expiration: refresh when now - delta * log(U) passes
+        #the expiry, so concurrent hits rarely all decide to refresh at once.
+        return now - self.early_refresh_delta * math.log(1.0 - random.random()) >= entry[1]
+
+    def refresh_credentials_in_background(self, service, user_id, token, token_secret=None):
+        cache_key = Authorizer.key_for_credentials(service, user_id, token, token_secret)
+
+        with Authorizer.refresh_lock:
+            if cache_key in Authorizer.refreshes_in_flight:
+                return
+            Authorizer.refreshes_in_flight.add(cache_key)
+
+        def refresh():
+            try:
+                verified_user_id, expires_at = self.verify_credentials(service, user_id, token, token_secret,
+                                                                       priority=ratelimit.BACKGROUND)
+                self.cache_credentials(service, user_id, token, token_secret, expires_at)
+                result = "ok"
+
+            except verifier.OAuthException:
+                self.forget_credentials(service, user_id, token, token_secret)
+                result = "rejected"
+
+            except Exception:
+                #Keep serving the cached entry until it expires.
+                result = "error"
+
+            finally:
+                with Authorizer.refresh_lock:
+                    Authorizer.refreshes_in_flight.discard(cache_key)
+
+            metrics.get_metrics().increment("oauth_cache_refreshes_total", {"result": result})
+
+        self.schedule_refresh(refresh)
+
+    def schedule_refresh(self, refresh):
+        """Runs refresh() in the background. Override this to use a task queue instead of a thread."""
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def cache_get(self, cache_key):
+        if self.use_local_cache:
+            value = self.local_cache.get(cache_key)
+            metrics.get_metrics().increment("oauth_local_cache_lookups_total", {"result": "hit" if value else "miss"})
+
+            if value:
+                return value
+
+        if self.shared_cache:
+            value = self.shared_cache.get(cache_key)
+            metrics.get_metrics().increment("oauth_shared_cache_lookups_total", {"result": "hit" if value else "miss"})
+
+            if value:
+                self.local_cache_set(cache_key, value)
+                return value
+
+        value = self.cache_backend.get(cache_key)
+
+        if value:
+            self.shared_cache_set(cache_key, value)
+            self.local_cache_set(cache_key, value)
+
+        return value
+
+    def shared_cache_set(self, cache_key, value):
+        #Entries from older versions (True) have no expiry to store.
+        if not self.shared_cache or value is True:
+            return
+
+        ttl = self.stale_until(value) - time.time()
+        if ttl > 0:
+            self.shared_cache.set(cache_key, value, ttl)
+
+    def local_cache_set(self, cache_key, value):
+        if self.use_local_cache:
+            ttl = min(self.local_cache_period, self.credential_caching_period)
+            self.local_cache.set(cache_key, value, ttl)
+
+    def snapshot_path(self, path):
+        path = path or self.local_cache_snapshot_path
+
+        if not path:
+            raise ValueError("No local cache snapshot path was given.")
+
+        return path
+
+    def save_local_cache(self, path=None):
+        """Writes local_cache's unexpired entries to a snapshot. -> number of entries written."""
+        return cache.save_snapshot(self.local_cache, self.snapshot_path(path))
+
+    def load_local_cache(self, path=None):
+        """Warms local_cache from a snapshot, skipping expired entries. -> number of entries loaded."""
+        return cache.load_snapshot(self.local_cache, self.snapshot_path(path),
+                                   min(self.local_cache_period, self.credential_caching_period))
+
+    def save_local_cache_periodically(self, interval=60, path=None):
+        """Saves a snapshot every interval seconds from a daemon thread. -> the thread."""
+        path = self.snapshot_path(path)
+
+        def save():
+            while True:
+                time.sleep(interval)
+
+                try:
+                    self.save_local_cache(path)
+                except (IOError, OSError):
+                    #Try again next time; a stale snapshot only means a colder start.
+                    pass
+
+        thread = threading.Thread(target=save)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @staticmethod
+    def rejected_key_for(cache_key):
+        return "rejected|" + cache_key
+
+    def check_rejected_credentials(self, cache_key):
+        if not self.use_negative_caching:
+            return
+
+        rejected_key = Authorizer.rejected_key_for(cache_key)
+        rejection = self.negative_cache.get(rejected_key)
+
+        if not rejection:
+            rejection = self.cache_backend.get(rejected_key)
+
+            if rejection:
+                self.negative_cache.set(rejected_key, rejection, self.negative_caching_period)
+
+        if rejection:
+            metrics.get_metrics().increment("oauth_cache_lookups_total", {"result": "negative"})
+            message, code = rejection
+            raise verifier.OAuthException(message, code)
+
+    def cache_rejected_credentials(self, cache_key, e):
+        if not self.use_negative_caching:
+            return
+
+        rejected_key = Authorizer.rejected_key_for(cache_key)
+        rejection = (str(e), e.code)
+
+        self.cache_backend.set(rejected_key, rejection, self.negative_caching_period)
+        self.negative_cache.set(rejected_key, rejection, self.negative_caching_period)
@@ -0,0 +1,341 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Microbenchmarks for the verification hot path.
+
+Run from the package directory:
+
+python benchmark.py                          #Run everything.
+python benchmark.py header cache             #Only benchmarks whose names contain "header" or "cache".
+python benchmark.py --save baseline.json     #Save the results as a baseline.
+python benchmark.py --compare baseline.json  #Show the change against a saved baseline.
+
+Each benchmark runs its operation in timed batches. The report shows the
+overall ops/sec and the p50/p90/p99 of the per-operation time across
+batches. Provider requests go to a stub HTTP server on localhost, so the
+numbers measure this package and not the network.
+"""
+
+import argparse
+import collections
+import json
+import platform
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+import cache
+import header
+import jsonfields
+import oauth
+import ticket
+import verifier
+
+
+def legacy_parse_authorization_header(authorization_header):
+    """The two-regex parser OAuthHandler used before header.py."""
+    fb_goog_re = re.compile("(Facebook|Google) (.+)\|(.+)")
+    twitter_re = re.compile("Twitter (.+)\|(.+)\|(.+)")
+
+    fb_goog_match = fb_goog_re.match(authorization_header)
+    twitter_match = twitter_re.match(authorization_header)
+
+    if twitter_match:
+        return "Twitter", twitter_match.group(1), twitter_match.group(2), twitter_match.group(3)
+    elif fb_goog_match:
+        return fb_goog_match.group(1), fb_goog_match.group(2), fb_goog_match.group(3), None
+
+
+HEADERS = {
+    "facebook": "Facebook 10153410229491234|EAACEdEose0cBAKx7ZBfZCkZBrZAq9ZCZCZAjZBEZCu6zXw",
+    "twitter": "Twitter 1234567890|1234567890-AbCdEfGhIjKlMnOpQrStUvWxYz|SeCrEtSeCrEtSeCrEtSeCrEt",
+    "hostile": "Twitter " + "a" * 2000 + "|" + "a" * 2000,
+}
+
+USER_ID = "1234567890"
+
+#Shaped like Twitter's verify_credentials.json user object, with the latest status.
+TWITTER_USER = json.dumps(collections.OrderedDict(
+    [("id", int(USER_ID)), ("id_str", USER_ID), ("name", "Benchmark User"), ("screen_name", "benchmark"),
+     ("description", "x" * 160), ("entities", {"url": {"urls": [{"url": "https://t.co/x", "indices": [0, 23]}]}})] +
+    [("field_%d" % i, i) for i in range(40)] +
+    [("status", {"id": 1, "text": "y" * 280, "entities": {"hashtags": [], "urls": [], "user_mentions": []}})]))
+
+
+class StubProviderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    #Buffer the response so it goes out in one segment, instead of stalling on Nagle's algorithm.
+    wbufsize = -1
+
+    body = json.dumps({"id": USER_ID, "id_str": USER_ID, "user_id": USER_ID, "name": "Benchmark User"})
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubProvider(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A keep-alive HTTP server on localhost that accepts every token."""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, handler_class=StubProviderHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), handler_class)
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/me" % self.server_address[1]
+
+
+#(name, batch size, setup function returning the operation to time), in run order.
+BENCHMARKS = []
+
+
+def benchmark(name, batch_size=1000):
+    def register(setup):
+        BENCHMARKS.append((name, batch_size, setup))
+        return setup
+    return register
+
+
+def ignoring_errors(function, *args):
+    def run():
+        try:
+            function(*args)
+        except Exception:
+            pass
+    return run
+
+
+for kind, authorization_header in sorted(HEADERS.items()):
+    batch_size = 20 if kind == "hostile" else 5000
+
+    benchmark("header_parse_%s" % kind, batch_size)(
+        lambda h=authorization_header: ignoring_errors(header.parse_authorization_header, h))
+    benchmark("header_parse_legacy_regex_%s" % kind, batch_size)(
+        lambda h=authorization_header: ignoring_errors(legacy_parse_authorization_header, h))
+
+
+@benchmark("key_for_credentials", 5000)
+def setup_key_for_credentials():
+    return lambda: cache.key_for_credentials("Twitter", USER_ID, "token-abcdefghijklmnop", "secret-qrstuvwxyz")
+
+
+@benchmark("local_cache_hit", 5000)
+def setup_local_cache_hit():
+    local_cache = cache.LocalCache(max_size=10000)
+    keys = [cache.key_for_credentials("Facebook", str(i), "token") for i in range(1000)]
+
+    for key in keys:
+        local_cache.set(key, (time.time(), time.time() + 900))
+
+    return lambda: local_cache.get(random.choice(keys))
+
+
+@benchmark("local_cache_miss", 5000)
+def setup_local_cache_miss():
+    local_cache = cache.LocalCache(max_size=10000)
+    key = cache.key_for_credentials("Facebook", USER_ID, "missing")
+    return lambda: local_cache.get(key)
+
+
+@benchmark("memory_backend_get", 5000)
+def setup_memory_backend_get():
+    backend = cache.MemoryBackend()
+    key = cache.key_for_credentials("Facebook", USER_ID, "token")
+    backend.set(key, (time.time(), time.time() + 900), 900)
+    return lambda: backend.get(key)
+
+
+@benchmark("shared_memory_cache_hit", 5000)
+def setup_shared_memory_cache_hit():
+    fd, path = tempfile.mkstemp(suffix=".shm")
+    os.close(fd)
+
+    shared_cache = cache.SharedMemoryCache(path)
+    os.remove(path)
+
+    keys = [cache.key_for_credentials("Facebook", str(i), "token") for i in range(1000)]
+    for key in keys:
+        shared_cache.set(key, (time.time(), time.time() + 900), 900)
+
+    return lambda: shared_cache.get(random.choice(keys))
+
+
+def twitter_request():
+    consumer = oauth.OAuthConsumer("consumer-key-abcdefghijkl", "consumer-secret-abcdefghijklmnopqrstuvwxyz")
+    token = oauth.OAuthToken("1234567890-AbCdEfGhIjKlMnOpQrStUvWxYz", "SeCrEtSeCrEtSeCrEtSeCrEt")
+    request = oauth.OAuthRequest.from_consumer_and_token(
+        consumer, token=token, http_method="GET",
+        http_url="https://api.twitter.com/1.1/account/verify_credentials.json")
+    return consumer, token, request
+
+
+@benchmark("oauth_get_normalized_parameters", 2000)
+def setup_get_normalized_parameters():
+    consumer, token, request = twitter_request()
+    return request.get_normalized_parameters
+
+
+@benchmark("oauth_hmac_sha1_build_signature", 2000)
+def setup_build_signature():
+    consumer, token, request = twitter_request()
+    method = oauth.OAuthSignatureMethod_HMAC_SHA1()
+    return lambda: method.build_signature(request, consumer, token)
+
+
+@benchmark("twitter_sign_request_legacy", 2000)
+def setup_sign_request_legacy():
+    consumer, token, request = twitter_request()
+
+    def sign():
+        request = oauth.OAuthRequest.from_consumer_and_token(
+            consumer, token=token, http_method="GET",
+            http_url="https://api.twitter.com/1.1/account/verify_credentials.json")
+        request.sign_request(oauth.OAuthSignatureMethod_HMAC_SHA1(), consumer, token)
+        return request.to_header()
+
+    return sign
+
+
+@benchmark("twitter_sign_request_signer", 2000)
+def setup_sign_request_signer():
+    consumer, token, request = twitter_request()
+    signer = oauth.OAuthSigner(consumer, "GET", "https://api.twitter.com/1.1/account/verify_credentials.json")
+    return lambda: signer.sign_header(token)
+
+
+@benchmark("parse_response_json_loads", 2000)
+def setup_parse_response_json_loads():
+    return lambda: json.loads(TWITTER_USER)["id_str"]
+
+
+@benchmark("parse_response_scan_fields", 2000)
+def setup_parse_response_scan_fields():
+    return lambda: jsonfields.scan_fields([TWITTER_USER], ["id_str"])["id_str"]
+
+
+@benchmark("ticket_verify", 5000)
+def setup_ticket_verify():
+    signer = ticket.TicketSigner({"k1": "secret-one", "k2": "secret-two"}, current_key_id="k2")
+    value = signer.issue("Facebook", USER_ID)
+    return lambda: signer.verify(value)
+
+
+@benchmark("execute_request_stub_provider", 50)
+def setup_execute_request():
+    url = StubProvider().url
+    return lambda: verifier.OAuthVerifier("token", USER_ID, url).verify()
+
+
+def run_benchmark(operation, batch_size, batches):
+    #Warm up caches, connections and the interpreter first.
+    for _ in xrange(max(1, batch_size // 10)):
+        operation()
+
+    timings = []
+    total = 0.0
+
+    for _ in xrange(batches):
+        started = time.time()
+        for _ in xrange(batch_size):
+            operation()
+        elapsed = time.time() - started
+
+        total += elapsed
+        timings.append(elapsed / batch_size)
+
+    timings.sort()
+
+    def percentile(p):
+        return timings[int(round(p / 100.0 * (len(timings) - 1)))]
+
+    return {
+        "ops_per_sec": batch_size * batches / total if total else float("inf"),
+        "p50_us": percentile(50) * 1e6,
+        "p90_us": percentile(90) * 1e6,
+        "p99_us": percentile(99) * 1e6,
+    }
+
+
+def format_change(result, baseline):
+    """-> the change in ops/sec against baseline, e.g. "-12.5%". Negative is slower."""
+    if not baseline:
+        return ""
+
+    return "%+.1f%%" % ((result["ops_per_sec"] / baseline["ops_per_sec"] - 1) * 100)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the verification hot path.")
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose names contain one of these")
+    parser.add_argument("--batches", type=int, default=20, help="timed batches per benchmark")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare ops/sec against a saved baseline")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    print "%-40s %12s %10s %10s %10s %9s" % ("benchmark", "ops/sec", "p50 us", "p90 us", "p99 us",
+                                             "change" if baseline else "")
+
+    for name, batch_size, setup in BENCHMARKS:
+        if args.names and not any(n in name for n in args.names):
+            continue
+
+        result = results[name] = run_benchmark(setup(), batch_size, args.batches)
+        print "%-40s %12.0f %10.2f %10.2f %10.2f %9s" % (name, result["ops_per_sec"], result["p50_us"],
+                                                         result["p90_us"], result["p99_us"],
+                                                         format_change(result, baseline.get(name)))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": sys.version.split()[0],
+                       "platform": platform.platform(),
+                       "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "results": results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,676 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Caches used by OAuthHandler.
+
+LocalCache is a thread-safe, size-bounded dictionary whose entries expire
+after a TTL. When it is full, the least recently used entry is evicted.
+
+CacheBackend is the interface for the shared credential store. Three
+backends are included:
+
+AppEngineMemcacheBackend -> google.appengine.api.memcache (the default)
+MemcachedBackend -> a memcached server, spoken to over its text protocol
+MemoryBackend -> a LocalCache in this process
+
+class MyHandler(handler.OAuthHandler):
+    cache_backend = cache.MemcachedBackend("127.0.0.1", 11211)
+
+TTLs are in seconds, and a TTL of 0 means the entry never expires, like
+memcache. Backends treat connection failures as cache misses.
+
+SharedMemoryCache is a fixed-size table in a memory-mapped file, shared by
+every process on a host that opens the same path. OAuthHandler can use it
+as a tier between its LocalCache and the backend, so pre-forked workers see
+each other's verifications without a memcache round trip:
+
+class MyHandler(handler.OAuthHandler):
+    shared_cache = cache.SharedMemoryCache("/dev/shm/oauth-credentials")
+
+save_snapshot() writes the unexpired credential entries of a LocalCache to a
+compact binary file (hashed keys and timestamps only), and load_snapshot()
+reads them back, so a restarted process doesn't have to verify every user
+again.
+"""
+
+import collections
+import cPickle as pickle
+import fcntl
+import hashlib
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+
+def key_for_credentials(service, user_id, token, token_secret=None):
+    """-> the SHA256 hex digest that credentials are cached under. Raw tokens are never stored."""
+    key = "OAuthVerifier|{0}|{1}|{2}".format(service, user_id, token)
+
+    if token_secret:
+        key += "|{0}".format(token_secret)
+
+    return hashlib.sha256(key).hexdigest()
+
+
+class LocalCache(object):
+    # Maximum number of entries before the least recently used one is evicted.
+    max_size = 10000
+
+    # Default time to live for entries, in seconds.
+    ttl = 60
+
+    def __init__(self, max_size=None, ttl=None):
+        if max_size is not None:
+            self.max_size = max_size
+        if ttl is not None:
+            self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+
+            if expires_at <= now:
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            # Re-inserting moves the key to the most recently used end.
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        if ttl <= 0:
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        """-> list of (key, value) for the entries that haven't expired."""
+        now = time.time()
+
+        with self.lock:
+            return [(key, value) for key, (expires_at, value) in self.entries.items() if expires_at > now]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "size": len(self.entries),
+            }
+
+
+SNAPSHOT_MAGIC = "OAUTHSNP"
+SNAPSHOT_VERSION = 2
+
+#Magic, version and record count, then one record per entry: the key
+#digest, verified_at, expires_at and when the provider token expires (0
+#if the provider didn't say).
+SNAPSHOT_HEADER = struct.Struct("<8sII")
+SNAPSHOT_RECORD = struct.Struct("<32sddd")
+
+
+def save_snapshot(local_cache, path):
+    """Writes local_cache's unexpired credential entries to path. -> number of entries written.
+
+    Only entries keyed by key_for_credentials() digests with (verified_at,
+    expires_at) or (verified_at, expires_at, token_expires_at) values are
+    written. The file is replaced atomically.
+    """
+    now = time.time()
+    records = []
+
+    for key, value in local_cache.items():
+        if len(key) != 64 or not isinstance(value, tuple) or value[1] <= now:
+            continue
+
+        try:
+            records.append(SNAPSHOT_RECORD.pack(key.decode("hex"), value[0], value[1],
+                                                value[2] if len(value) > 2 else 0))
+        except (TypeError, ValueError, struct.error):
+            continue
+
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+
+    with open(temporary_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(records)))
+        f.write("".join(records))
+
+    os.rename(temporary_path, path)
+    return len(records)
+
+
+def load_snapshot(local_cache, path, max_ttl=None):
+    """Adds the entries in a snapshot that haven't expired to local_cache. -> number of entries loaded.
+
+    Entries are kept until their expires_at, or for at most max_ttl seconds.
+    A missing snapshot, or one written by an older version that didn't
+    record token expiry, loads nothing; a corrupt one raises ValueError.
+    """
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return 0
+
+    with f:
+        size = os.fstat(f.fileno()).st_size
+
+        if size < SNAPSHOT_HEADER.size:
+            raise ValueError("%s is not a credential cache snapshot." % path)
+
+        snapshot = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    try:
+        magic, version, count = SNAPSHOT_HEADER.unpack_from(snapshot)
+
+        if magic != SNAPSHOT_MAGIC or version > SNAPSHOT_VERSION:
+            raise ValueError("%s is not a credential cache snapshot." % path)
+
+        if version < SNAPSHOT_VERSION:
+            return 0
+
+        if size != SNAPSHOT_HEADER.size + count * SNAPSHOT_RECORD.size:
+            raise ValueError("%s is truncated." % path)
+
+        now = time.time()
+        loaded = 0
+
+        for offset in xrange(SNAPSHOT_HEADER.size, size, SNAPSHOT_RECORD.size):
+            digest, verified_at, expires_at, token_expires_at = SNAPSHOT_RECORD.unpack_from(snapshot, offset)
+            ttl = expires_at - now
+
+            if ttl <= 0:
+                continue
+
+            entry = (verified_at, expires_at, token_expires_at) if token_expires_at else (verified_at, expires_at)
+            local_cache.set(digest.encode("hex"), entry, min(ttl, max_ttl) if max_ttl is not None else ttl)
+            loaded += 1
+
+        return loaded
+    finally:
+        snapshot.close()
+
+
+class CacheBackend(object):
+    """The shared store OAuthHandler keeps verified credentials in."""
+
+    def get(self, key):
+        """-> value, or None if the key is missing."""
+        raise NotImplementedError
+
+    def get_multi(self, keys):
+        """-> dict of the keys that were found and their values."""
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=0):
+        """Stores value unless key is already present. -> True if stored."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=0):
+        """Stores value, replacing any existing one. -> True if stored."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """-> True if the key existed."""
+        raise NotImplementedError
+
+
+class AppEngineMemcacheBackend(CacheBackend):
+
+    def __init__(self, namespace=None):
+        self.namespace = namespace
+
+    def memcache(self):
+        from google.appengine.api import memcache
+        return memcache
+
+    def get(self, key):
+        return self.memcache().get(key, namespace=self.namespace)
+
+    def get_multi(self, keys):
+        return self.memcache().get_multi(keys, namespace=self.namespace)
+
+    def add(self, key, value, ttl=0):
+        return self.memcache().add(key, value, time=ttl, namespace=self.namespace)
+
+    def set(self, key, value, ttl=0):
+        return self.memcache().set(key, value, time=ttl, namespace=self.namespace)
+
+    def delete(self, key):
+        return self.memcache().delete(key, namespace=self.namespace) == 2
+
+
+class MemoryBackend(CacheBackend):
+    """Keeps entries in a LocalCache. Useful for tests and single-process servers."""
+
+    def __init__(self, max_size=100000):
+        self.local_cache = LocalCache(max_size=max_size)
+        self.lock = threading.Lock()
+
+    def ttl_for(self, ttl):
+        return ttl if ttl > 0 else float("inf")
+
+    def get(self, key):
+        return self.local_cache.get(key)
+
+    def get_multi(self, keys):
+        found = {}
+
+        for key in keys:
+            value = self.local_cache.get(key)
+            if value is not None:
+                found[key] = value
+
+        return found
+
+    def add(self, key, value, ttl=0):
+        with self.lock:
+            if self.local_cache.get(key) is not None:
+                return False
+
+            self.local_cache.set(key, value, self.ttl_for(ttl))
+            return True
+
+    def set(self, key, value, ttl=0):
+        self.local_cache.set(key, value, self.ttl_for(ttl))
+        return True
+
+    def delete(self, key):
+        return self.local_cache.delete(key)
+
+
+class MemcachedBackend(CacheBackend):
+    """Talks to a memcached server using the text protocol.
+
+    Connections are kept open and reused. Values that aren't strings are
+    pickled, and flagged so that get() unpickles them.
+    """
+
+    FLAG_PICKLED = 1
+
+    def __init__(self, host="127.0.0.1", port=11211, timeout=0.5, max_connections=10):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.max_connections = max_connections
+
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def acquire(self):
+        with self.lock:
+            if self.connections:
+                return self.connections.pop()
+
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile("rb")
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.connections) < self.max_connections:
+                self.connections.append(connection)
+                return
+
+        connection[0].close()
+
+    def command(self, line, reader):
+        """Sends a command and returns reader(file)'s result, or None on errors."""
+        try:
+            connection = self.acquire()
+        except socket.error:
+            return None
+
+        sock, sock_file = connection
+
+        try:
+            sock.sendall(line)
+            result = reader(sock_file)
+        except (socket.error, ValueError, EOFError, pickle.UnpicklingError):
+            sock.close()
+            return None
+
+        self.release(connection)
+        return result
+
+    def encode(self, value):
+        if isinstance(value, str):
+            return 0, value
+        return self.FLAG_PICKLED, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, flags, data):
+        if int(flags) & self.FLAG_PICKLED:
+            return pickle.loads(data)
+        return data
+
+    def read_values(self, sock_file):
+        found = {}
+
+        while True:
+            line = sock_file.readline()
+
+            if line == "END\r\n":
+                return found
+
+            parts = line.split()
+            if len(parts) < 4 or parts[0] != "VALUE":
+                raise ValueError("Unexpected memcached response: %r" % line)
+
+            key, flags, length = parts[1], parts[2], int(parts[3])
+            data = sock_file.read(length + 2)
+
+            if len(data) != length + 2:
+                raise EOFError("Connection closed while reading %s" % key)
+
+            found[key] = self.decode(flags, data[:-2])
+
+    def get(self, key):
+        return self.get_multi([key]).get(key)
+
+    def get_multi(self, keys):
+        if not keys:
+            return {}
+
+        return self.command("get %s\r\n" % " ".join(keys), self.read_values) or {}
+
+    def store(self, command, key, value, ttl):
+        flags, data = self.encode(value)
+        line = "%s %s %d %d %d\r\n%s\r\n" % (command, key, flags, int(ttl), len(data), data)
+        return self.command(line, lambda sock_file: sock_file.readline() == "STORED\r\n") or False
+
+    def add(self, key, value, ttl=0):
+        return self.store("add", key, value, ttl)
+
+    def set(self, key, value, ttl=0):
+        return self.store("set", key, value, ttl)
+
+    def delete(self, key):
+        return self.command("delete %s\r\n" % key,
+                            lambda sock_file: sock_file.readline() == "DELETED\r\n") or False
+
+
+class SharedMemoryCache(object):
+    """Credential entries in a memory-mapped file shared between processes.
+
+    Keys are key_for_credentials() digests and values are the handler's
+    (verified_at, expires_at) entries, stored inline with the time the slot
+    may be reused. get() returns that time as a third element, since the
+    entry must not be served after it. The table is split into buckets of a few slots each; a
+    key lives in one bucket, and when the bucket is full the entry that
+    expires first is replaced.
+
+    Reads take no locks. Each slot has a sequence number that writers make
+    odd while they change the slot (a seqlock), so a reader that sees an odd
+    or changed number reads again. Writers lock their bucket's stripe, with
+    a threading.Lock within the process and an fcntl byte-range lock across
+    processes. This relies on stores not being reordered with each other,
+    as on x86.
+
+    Every process must open the file with the same buckets and
+    slots_per_bucket. Opening a file that has another shape raises
+    ValueError, since processes that still have it mapped would crash if
+    it were resized. To change the shape, use a new path, e.g. one that
+    includes the shape.
+    """
+
+    MAGIC = "OAUTHSHM"
+    VERSION = 1
+
+    #Magic, version, buckets, slots per bucket. The rest of the first page holds the stripe lock bytes.
+    HEADER = struct.Struct("<8sIII")
+    HEADER_SIZE = 4096
+
+    #Sequence number, then the key digest, verified_at, expires_at and keep_until.
+    SEQUENCE = struct.Struct("<I")
+    ENTRY = struct.Struct("<32sddd")
+    SLOT_SIZE = 64
+
+    #Reads that keep colliding with writers give up and count as misses.
+    read_attempts = 8
+
+    def __init__(self, path, buckets=16384, slots_per_bucket=4, stripes=256):
+        if not 0 < stripes <= self.HEADER_SIZE - self.HEADER.size:
+            raise ValueError("stripes must be between 1 and %d." % (self.HEADER_SIZE - self.HEADER.size))
+
+        self.path = path
+        self.buckets = buckets
+        self.slots_per_bucket = slots_per_bucket
+        self.stripes = stripes
+        self.size = self.HEADER_SIZE + buckets * slots_per_bucket * self.SLOT_SIZE
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            self.initialize()
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.map = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+        self.locks = [threading.Lock() for _ in xrange(stripes)]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.read_retries = 0
+
+    def initialize(self):
+        """Sizes the file and writes its header, unless another process already has.
+
+        Raises ValueError if the file holds a table of another shape.
+        """
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.buckets, self.slots_per_bucket)
+
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            found = self.read_header()
+
+            if found == header and os.fstat(self.fd).st_size == self.size:
+                return
+
+            #Processes only map the file once it has a header, so a file
+            #without one isn't in use. Any other file may be, and must not
+            #be shrunk under them.
+            if found.strip("\0"):
+                raise ValueError("%s holds a shared cache of another shape or version; "
+                                 "open it with the same buckets and slots_per_bucket, "
+                                 "or use another path." % self.path)
+
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, self.size)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.write(self.fd, header)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def read_header(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        return os.read(self.fd, self.HEADER.size)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def locate(self, key):
+        """-> (digest, bucket)."""
+        digest = key.decode("hex")
+
+        if len(digest) != 32:
+            raise ValueError("SharedMemoryCache keys are key_for_credentials() digests.")
+
+        return digest, struct.unpack_from("<Q", digest)[0] % self.buckets
+
+    def slot_offsets(self, bucket):
+        first = self.HEADER_SIZE + bucket * self.slots_per_bucket * self.SLOT_SIZE
+        return xrange(first, first + self.slots_per_bucket * self.SLOT_SIZE, self.SLOT_SIZE)
+
+    def read_slot(self, offset):
+        """-> (digest, verified_at, expires_at, keep_until), or None if writers kept changing it."""
+        for _ in xrange(self.read_attempts):
+            sequence = self.SEQUENCE.unpack_from(self.map, offset)[0]
+
+            if not sequence & 1:
+                entry = self.ENTRY.unpack_from(self.map, offset + self.SEQUENCE.size)
+
+                if self.SEQUENCE.unpack_from(self.map, offset)[0] == sequence:
+                    return entry
+
+            self.read_retries += 1
+
+        return None
+
+    def write_slot(self, offset, digest, verified_at, expires_at, keep_until):
+        sequence = self.SEQUENCE.unpack_from(self.map, offset)[0]
+
+        self.SEQUENCE.pack_into(self.map, offset, (sequence + 1) & 0xffffffff)
+        self.ENTRY.pack_into(self.map, offset + self.SEQUENCE.size, digest, verified_at, expires_at, keep_until)
+        self.SEQUENCE.pack_into(self.map, offset, (sequence + 2) & 0xffffffff)
+
+    def lock(self, bucket):
+        stripe = bucket % self.stripes
+        self.locks[stripe].acquire()
+
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.HEADER.size + stripe)
+        except Exception:
+            self.locks[stripe].release()
+            raise
+
+        return stripe
+
+    def unlock(self, stripe):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.HEADER.size + stripe)
+        finally:
+            self.locks[stripe].release()
+
+    def get(self, key):
+        """-> (verified_at, expires_at, keep_until), or None."""
+        digest, bucket = self.locate(key)
+        now = time.time()
+
+        for offset in self.slot_offsets(bucket):
+            entry = self.read_slot(offset)
+
+            if entry and entry[0] == digest and now < entry[3]:
+                self.hits += 1
+                return entry[1], entry[2], entry[3]
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=0):
+        """Stores a (verified_at, expires_at, ...) entry for ttl seconds. -> True."""
+        digest, bucket = self.locate(key)
+        now = time.time()
+        keep_until = now + ttl if ttl > 0 else float("inf")
+
+        stripe = self.lock(bucket)
+        try:
+            victim = None
+            victim_keep_until = None
+
+            for offset in self.slot_offsets(bucket):
+                entry = self.ENTRY.unpack_from(self.map, offset + self.SEQUENCE.size)
+
+                if entry[0] == digest:
+                    victim = offset
+                    break
+
+                #Empty slots have a keep_until of 0, so they are picked before live entries.
+                if victim is None or entry[3] < victim_keep_until:
+                    victim, victim_keep_until = offset, entry[3]
+
+            else:
+                if victim_keep_until > now:
+                    self.evictions += 1
+
+            self.write_slot(victim, digest, value[0], value[1], keep_until)
+        finally:
+            self.unlock(stripe)
+
+        return True
+
+    def delete(self, key):
+        """-> True if the key was present."""
+        digest, bucket = self.locate(key)
+
+        stripe = self.lock(bucket)
+        try:
+            for offset in self.slot_offsets(bucket):
+                if self.ENTRY.unpack_from(self.map, offset + self.SEQUENCE.size)[0] == digest:
+                    self.write_slot(offset, "\0" * 32, 0.0, 0.0, 0.0)
+                    return True
+        finally:
+            self.unlock(stripe)
+
+        return False
+
+    def stats(self):
+        """-> this process's counters."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "read_retries": self.read_retries,
+        }
@@ -0,0 +1,1023 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+
+"""
+Runnable checks for the parts of the package that are easy to get subtly
+wrong: ID token cryptography and the checks around it, splitting
+Facebook batch responses back into per-token results, how provider
+failures surface, what counts against a provider's circuit breaker,
+whose quota a Twitter rate limit uses up, OAuth request signing, the
+OAuth nonce store, the caching OAuth data store, the shared memory
+cache file, local cache snapshots, and keeping users who are logging in
+out of background refreshes.
+Everything runs against stub servers on localhost with locally generated
+keys, so no provider account or network access is needed.
+
+Run from the package directory:
+
+python checks.py             #Run every check.
+python checks.py id_token    #Only checks whose names contain "id_token".
+
+Exits with status 1 if any check fails.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urlparse
+import BaseHTTPServer
+
+import cache
+import circuit
+import datastore
+import eventloop
+import idtoken
+import oauth
+import ratelimit
+import singleflight
+import ticket
+import verifier
+
+from authorizer import Authorizer
+from benchmark import StubProvider
+from circuit import CircuitOpenException, DeadlineExceededException, UpstreamException
+from verifier import OAuthException
+
+
+#(name, check function), in run order.
+CHECKS = []
+
+
+def check(name):
+    def register(function):
+        CHECKS.append((name, function))
+        return function
+    return register
+
+
+#Stub servers started by the checks, shut down before exiting.
+SERVERS = []
+
+
+def stub_server(handler_class):
+    server = StubProvider(handler_class)
+    SERVERS.append(server)
+    return server
+
+
+def expect(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def expect_raises(exception_class, function, *args, **kwargs):
+    try:
+        function(*args, **kwargs)
+    except exception_class as e:
+        return e
+
+    raise AssertionError("%s was not raised" % exception_class.__name__)
+
+
+#RSA keys for signing test tokens, generated here so the checks need no key files or openssl.
+
+def is_probable_prime(n, rounds=20):
+    if n < 4:
+        return n in (2, 3)
+
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29):
+        if n % p == 0:
+            return n == p
+
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+
+    for _ in xrange(rounds):
+        x = pow(random.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+
+        for _ in xrange(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def random_prime(bits):
+    while True:
+        n = random.getrandbits(bits) | (1 << (bits - 1)) | 1
+        if is_probable_prime(n):
+            return n
+
+
+def generate_rsa_key(bits=1024, exponent=65537):
+    """-> (modulus, public exponent, private exponent)."""
+    while True:
+        p, q = random_prime(bits // 2), random_prime(bits // 2)
+        phi = (p - 1) * (q - 1)
+
+        if p != q and phi % exponent:
+            return p * q, exponent, modular_inverse(exponent, phi)
+
+
+def modular_inverse(a, m):
+    x0, x1, r0, r1 = 1, 0, a, m
+    while r1:
+        quotient = r0 // r1
+        x0, x1 = x1, x0 - quotient * x1
+        r0, r1 = r1, r0 - quotient * r1
+    return x0 % m
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip("=")
+
+
+class SigningKey(object):
+
+    def __init__(self, kid, bits=1024):
+        self.kid = kid
+        self.modulus, self.exponent, self.private_exponent = generate_rsa_key(bits)
+
+    def jwk(self):
+        length = (self.modulus.bit_length() + 7) // 8
+        return {"kty": "RSA", "alg": "RS256", "use": "sig", "kid": self.kid,
+                "n": b64url(idtoken.int_to_bytes(self.modulus, length)),
+                "e": b64url(idtoken.int_to_bytes(self.exponent, 3))}
+
+    def sign(self, message):
+        """RSASSA-PKCS1-v1_5 with SHA-256."""
+        length = (self.modulus.bit_length() + 7) // 8
+        digest_info = idtoken.SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+        padded = "\x00\x01" + "\xff" * (length - len(digest_info) - 3) + "\x00" + digest_info
+        signature = pow(idtoken.bytes_to_int(padded), self.private_exponent, self.modulus)
+        return idtoken.int_to_bytes(signature, length)
+
+    def token(self, claims, alg="RS256", kid=None):
+        signing_input = b64url(json.dumps({"alg": alg, "kid": kid or self.kid})) + "." + b64url(json.dumps(claims))
+        return signing_input + "." + b64url(self.sign(signing_input))
+
+
+class KeySetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's JWK set, or its status and delay if set."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.fetches += 1
+        time.sleep(self.server.delay)
+
+        body = json.dumps({"keys": [key.jwk() for key in self.server.keys]})
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Cache-Control", "public, max-age=600")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def key_set_server(*keys):
+    server = stub_server(KeySetHandler)
+    server.keys = list(keys)
+    server.fetches = 0
+    server.delay = 0
+    server.status = 200
+
+    #Checks that give up on slow responses leave the server writing to closed sockets.
+    server.handle_error = lambda request, client_address: None
+    return server
+
+
+CLIENT_ID = "client-id.apps.googleusercontent.com"
+SUBJECT = "110169484474386276334"
+
+
+def claims(**overrides):
+    result = {"iss": "https://accounts.google.com", "aud": CLIENT_ID, "sub": SUBJECT,
+              "iat": int(time.time()), "exp": int(time.time()) + 3600}
+    result.update(overrides)
+    return result
+
+
+def id_token_verifier(token, key_set, user_id=SUBJECT, audience=CLIENT_ID):
+    id_verifier = verifier.GoogleIdTokenVerifier(token, user_id, audience)
+    id_verifier.key_set = key_set
+    return id_verifier
+
+
+_signing_key = []
+
+
+def signing_key():
+    """One key, shared by the checks, since generating it takes a moment."""
+    if not _signing_key:
+        _signing_key.append(SigningKey("k1"))
+    return _signing_key[0]
+
+
+@check("id_token_rs256_roundtrip")
+def check_rs256_roundtrip():
+    key = signing_key()
+    signature = key.sign("message")
+
+    expect(idtoken.verify_rs256("message", signature, key.modulus, key.exponent), "valid signature rejected")
+    expect(not idtoken.verify_rs256("massage", signature, key.modulus, key.exponent), "wrong message accepted")
+    expect(not idtoken.verify_rs256("message", signature[:-1] + chr(ord(signature[-1]) ^ 1),
+                                    key.modulus, key.exponent), "tampered signature accepted")
+    expect(not idtoken.verify_rs256("message", signature[1:], key.modulus, key.exponent),
+           "short signature accepted")
+
+
+@check("id_token_valid")
+def check_valid_id_token():
+    key = signing_key()
+    server = key_set_server(key)
+    key_set = idtoken.KeySet(server.url)
+    token_claims = claims()
+
+    id_verifier = id_token_verifier(key.token(token_claims), key_set)
+    expect(id_verifier.verify() == SUBJECT, "valid token rejected")
+    expect(id_verifier.expires_at == token_claims["exp"], "expires_at not taken from the exp claim")
+
+    expect(id_token_verifier(key.token(token_claims), key_set).verify_async().get_result() == SUBJECT,
+           "valid token rejected by verify_async()")
+
+    expect(server.fetches == 1, "key set fetched %d times instead of once" % server.fetches)
+
+
+@check("id_token_rejected")
+def check_rejected_id_tokens():
+    key = signing_key()
+    other_key = SigningKey("k1", bits=512)
+    key_set = idtoken.KeySet(key_set_server(key).url)
+
+    rejected = [
+        ("another user", key.token(claims(sub="1"))),
+        ("another audience", key.token(claims(aud="someone-else"))),
+        ("expired", key.token(claims(exp=int(time.time()) - 3600))),
+        ("no expiry", key.token(dict((k, v) for k, v in claims().items() if k != "exp"))),
+        ("another issuer", key.token(claims(iss="https://evil.example.com"))),
+        ("signed by another key", other_key.token(claims())),
+        ("unknown key id", key.token(claims(), kid="k2")),
+        ("HS256", key.token(claims(), alg="HS256")),
+        ("none", key.token(claims(), alg="none")),
+        ("not a JWT", "garbage"),
+    ]
+
+    for reason, token in rejected:
+        try:
+            id_token_verifier(token, key_set).verify()
+        except OAuthException:
+            continue
+
+        raise AssertionError("token accepted: %s" % reason)
+
+
+@check("id_token_key_rotation")
+def check_key_rotation():
+    old_key, new_key = signing_key(), SigningKey("k2", bits=512)
+    server = key_set_server(old_key)
+    key_set = idtoken.KeySet(server.url)
+
+    expect(id_token_verifier(old_key.token(claims()), key_set).verify() == SUBJECT, "old key rejected")
+
+    server.keys.append(new_key)
+    key_set.fetched_at -= key_set.min_refresh_interval
+    expect(id_token_verifier(new_key.token(claims()), key_set).verify() == SUBJECT,
+           "new key not fetched on an unknown key id")
+    expect(server.fetches == 2, "expected 2 fetches, got %d" % server.fetches)
+
+    #Made-up key ids don't refetch more often than min_refresh_interval.
+    for _ in range(5):
+        expect_raises(OAuthException, id_token_verifier(new_key.token(claims(), kid="k9"), key_set).verify)
+    expect(server.fetches == 2, "unknown key ids refetched the key set")
+
+
+@check("id_token_refresh_deadline")
+def check_refresh_deadline():
+    key = signing_key()
+    server = key_set_server(key)
+    server.delay = 1.0
+    key_set = idtoken.KeySet(server.url)
+    key_set.provider = "Google ID token checks"
+
+    started = time.time()
+    expect_raises(DeadlineExceededException, id_token_verifier(key.token(claims()), key_set).verify, deadline=0.2)
+    expect(time.time() - started < 0.5, "verify() ran past its deadline")
+
+    started = time.time()
+    future = id_token_verifier(key.token(claims()), key_set).verify_async(deadline=0.2)
+    expect_raises(DeadlineExceededException, future.get_result)
+    expect(time.time() - started < 0.5, "verify_async() ran past its deadline")
+
+    expect(circuit.breaker_for(key_set.provider).stats()["failures"] == 0,
+           "deadline cuts counted as circuit breaker failures")
+
+
+@check("id_token_async_refresh_does_not_block")
+def check_async_refresh_does_not_block():
+    key = signing_key()
+    server = key_set_server(key)
+    server.delay = 0.3
+    key_set = idtoken.KeySet(server.url)
+    ticks = []
+
+    @eventloop.tasklet
+    def ticker():
+        for _ in range(5):
+            yield eventloop.sleep(0.02)
+            ticks.append(time.time())
+
+    started = time.time()
+    ticking = ticker()
+    user_id = id_token_verifier(key.token(claims()), key_set).verify_async().get_result()
+    ticking.get_result()
+
+    expect(user_id == SUBJECT, "valid token rejected")
+    expect(len([t for t in ticks if t - started < 0.25]) == 5, "the key set fetch blocked the event loop")
+
+
+@check("id_token_refresh_circuit_breaker")
+def check_refresh_circuit_breaker():
+    key = signing_key()
+    server = key_set_server(key)
+    server.status = 503
+    key_set = idtoken.KeySet(server.url)
+    key_set.provider = "Google ID token breaker checks"
+    breaker = circuit.breaker_for(key_set.provider)
+    breaker.reset()
+
+    for _ in range(breaker.failure_threshold):
+        expect_raises(Exception, id_token_verifier(key.token(claims()), key_set).verify)
+
+    fetches = server.fetches
+    expect_raises(CircuitOpenException, id_token_verifier(key.token(claims()), key_set).verify)
+    expect(server.fetches == fetches, "key set fetched while the circuit breaker was open")
+    breaker.reset()
+
+
+#A stub Graph API. Tokens starting with "user-" belong to the user named by
+#the rest of the token, "slow-" tokens are left out of batch responses (as
+#Facebook does for operations it didn't get to), and any other token is
+#invalid. Batches are refused as a whole if their top level access token is
+#BAD_APP_TOKEN or an invalid user token, or with the server's status if set.
+
+BAD_APP_TOKEN = "app|bad"
+
+
+def graph_api_answer(token):
+    """-> (status, body) for /me?access_token=token."""
+    if token.startswith("user-"):
+        return 200, json.dumps({"id": token[len("user-"):]})
+    return 400, json.dumps({"error": {"type": "OAuthException", "code": 190}})
+
+
+class GraphApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.single_requests += 1
+        token = urlparse.parse_qs(urlparse.urlsplit(self.path).query)["access_token"][0]
+        self.respond(*graph_api_answer(token))
+
+    def do_POST(self):
+        self.server.batch_requests += 1
+        params = urlparse.parse_qs(self.rfile.read(int(self.headers["Content-Length"])))
+        access_token = params["access_token"][0]
+
+        if self.server.status != 200:
+            return self.respond(self.server.status, "{}")
+
+        if access_token == BAD_APP_TOKEN or (not access_token.startswith("app|") and
+                                             graph_api_answer(access_token)[0] != 200):
+            return self.respond(400, json.dumps({"error": {"type": "OAuthException", "code": 190}}))
+
+        answers = []
+        for operation in json.loads(params["batch"][0]):
+            token = urlparse.parse_qs(urlparse.urlsplit(operation["relative_url"]).query)["access_token"][0]
+
+            if token.startswith("slow-"):
+                answers.append(None)
+            else:
+                code, body = graph_api_answer(token)
+                answers.append({"code": code, "body": body})
+
+        self.respond(200, json.dumps(answers))
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def graph_api_server():
+    server = stub_server(GraphApiHandler)
+    server.batch_requests = 0
+    server.single_requests = 0
+    server.status = 200
+    return server
+
+
+def batch_verifier(server, credentials, app_access_token="app|secret"):
+    """A FacebookBatchVerifier that sends batches, and its one-by-one fallbacks, to server."""
+    single_url = server.url
+    base_url = single_url[:-len("me")]
+
+    class StubBatchVerifier(verifier.FacebookBatchVerifier):
+        url = base_url
+
+        def verifier_for(self, i):
+            single = verifier.FacebookBatchVerifier.verifier_for(self, i)
+            single.url = single_url
+            return single
+
+    return StubBatchVerifier(credentials, app_access_token)
+
+
+def mixed_credentials(count):
+    """-> (token, user_id) pairs: mostly valid, every fifth invalid, every seventh for another user."""
+    credentials = []
+
+    for i in range(count):
+        if i % 5 == 4:
+            credentials.append(("invalid-%d" % i, str(i)))
+        elif i % 7 == 6:
+            credentials.append(("user-%d" % (i + 1), str(i)))
+        else:
+            credentials.append(("user-%d" % i, str(i)))
+
+    return credentials
+
+
+def expect_batch_results(credentials, results):
+    expect(len(results) == len(credentials), "expected %d results, got %d" % (len(credentials), len(results)))
+
+    for (token, user_id), result in zip(credentials, results):
+        if token == "user-" + user_id:
+            expect(result == user_id, "token %s: expected %s, got %r" % (token, user_id, result))
+        else:
+            expect(isinstance(result, OAuthException), "token %s: expected OAuthException, got %r" % (token, result))
+
+
+@check("facebook_batch_split")
+def check_batch_split():
+    server = graph_api_server()
+    credentials = mixed_credentials(120)
+
+    expect_batch_results(credentials, batch_verifier(server, credentials).verify())
+    expect(server.batch_requests == 3, "120 tokens took %d batch requests, not 3" % server.batch_requests)
+
+    expect_batch_results(credentials, batch_verifier(server, credentials).verify_async().get_result())
+    expect(server.single_requests == 0, "tokens were verified one by one")
+
+
+@check("facebook_batch_missing_operations")
+def check_batch_missing_operations():
+    server = graph_api_server()
+    results = batch_verifier(server, [("user-1", "1"), ("slow-2", "2"), ("user-3", "3")]).verify()
+
+    expect(results[0] == "1" and results[2] == "3", "unexpected results %r" % results)
+    expect(isinstance(results[1], UpstreamException), "missing operation gave %r" % results[1])
+
+
+@check("facebook_batch_rejected_app_token")
+def check_batch_rejected_app_token():
+    server = graph_api_server()
+    credentials = mixed_credentials(10)
+
+    for results in (batch_verifier(server, credentials, BAD_APP_TOKEN).verify(),
+                    batch_verifier(server, credentials, BAD_APP_TOKEN).verify_async().get_result()):
+        for result in results:
+            expect(isinstance(result, UpstreamException),
+                   "a rejected app access token gave %r instead of an UpstreamException" % result)
+
+    expect(server.single_requests == 0, "tokens were verified one by one")
+
+
+@check("facebook_batch_without_app_token")
+def check_batch_without_app_token():
+    server = graph_api_server()
+
+    #The first token is invalid, so Facebook refuses the batch it was sent under.
+    credentials = [("invalid-0", "0")] + mixed_credentials(8)[1:]
+
+    expect_batch_results(credentials, batch_verifier(server, credentials, None).verify())
+    expect_batch_results(credentials, batch_verifier(server, credentials, None).verify_async().get_result())
+    expect(server.single_requests == 2 * len(credentials), "the refused batch wasn't verified one by one")
+
+
+@check("facebook_batch_server_error")
+def check_batch_server_error():
+    server = graph_api_server()
+    server.status = 500
+    credentials = mixed_credentials(10)
+
+    try:
+        for app_access_token in ("app|secret", None):
+            for results in (batch_verifier(server, credentials, app_access_token).verify(),
+                            batch_verifier(server, credentials, app_access_token).verify_async().get_result()):
+                for result in results:
+                    expect(isinstance(result, UpstreamException),
+                           "a failed batch gave %r instead of an UpstreamException" % result)
+
+        expect(server.single_requests == 0, "a failed batch was retried one token at a time")
+    finally:
+        circuit.breaker_for(verifier.FACEBOOK_SERVICE).reset()
+
+
+class SlowProviderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(0.5)
+
+        body = json.dumps({"id": "1"})
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@check("circuit_breaker_ignores_deadline_cuts")
+def check_breaker_ignores_deadline_cuts():
+    server = stub_server(SlowProviderHandler)
+    server.handle_error = lambda request, client_address: None
+
+    class SlowVerifier(verifier.OAuthVerifier):
+        provider = "Slow provider checks"
+
+    breaker = circuit.breaker_for(SlowVerifier.provider)
+    breaker.reset()
+
+    #The caller's deadline runs out first: not the provider's fault.
+    for _ in range(breaker.failure_threshold + 1):
+        expect_raises(DeadlineExceededException, SlowVerifier("token", "1", server.url).verify, deadline=0.1)
+        expect_raises(DeadlineExceededException, SlowVerifier("token", "1", server.url).verify_async(0.1).get_result)
+    expect(breaker.stats()["failures"] == 0, "deadline cuts counted as circuit breaker failures")
+
+    #A half-open probe cut short by the deadline frees its slot for the next one.
+    breaker.state, breaker.opened_at = circuit.OPEN, 0
+    expect_raises(DeadlineExceededException, SlowVerifier("token", "1", server.url).verify, deadline=0.1)
+    expect(SlowVerifier("token", "1", server.url).verify(deadline=2) == "1", "the next probe was refused")
+    expect(breaker.stats()["state"] == circuit.CLOSED, "a successful probe didn't close the breaker")
+
+    #The provider's own timeout is.
+    SlowVerifier.read_timeout = 0.1
+    for _ in range(breaker.failure_threshold):
+        expect_raises(Exception, SlowVerifier("token", "1", server.url).verify, deadline=5)
+    expect(breaker.stats()["state"] == circuit.OPEN, "provider timeouts didn't open the circuit breaker")
+    breaker.reset()
+
+
+class FailingProviderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@check("provider_failures_are_upstream_errors")
+def check_provider_failures_are_upstream_errors():
+    server = stub_server(FailingProviderHandler)
+
+    #Nothing listens on a socket that was bound and closed again.
+    closed = StubProvider()
+    closed.shutdown()
+    closed.server_close()
+
+    class FailingVerifier(verifier.OAuthVerifier):
+        provider = "Failing provider checks"
+
+    try:
+        for url in (server.url, closed.url):
+            for verify in (lambda: FailingVerifier("token", "1", url).verify(),
+                           lambda: FailingVerifier("token", "1", url).verify_async().get_result()):
+                error = expect_raises(Exception, verify)
+                expect(isinstance(error, UpstreamException) and not isinstance(error, OAuthException),
+                       "%s gave %r instead of an UpstreamException" % (url, error))
+    finally:
+        circuit.breaker_for(FailingVerifier.provider).reset()
+
+
+#Each access token may verify this many times per window.
+TOKEN_QUOTA = 2
+
+
+class TwitterQuotaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Counts verify_credentials calls per access token, like Twitter does.
+
+    Under .../app every request is answered with a 429 that doesn't say whose
+    quota ran out, as when the whole application is being limited.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        token = re.search(r'oauth_token="([^"]*)"', self.headers.getheader("Authorization")).group(1)
+        remaining = self.server.remaining.setdefault(token, TOKEN_QUOTA)
+
+        if urlparse.urlparse(self.path).path.endswith("/app"):
+            self.answer(429, None)
+        elif remaining <= 0:
+            self.answer(429, 0)
+        else:
+            self.server.remaining[token] = remaining - 1
+            self.answer(200, remaining - 1, json.dumps({"id_str": "1"}))
+
+    def answer(self, code, remaining, body=""):
+        self.server.requests += 1
+        self.send_response(code)
+        if remaining is not None:
+            self.send_header("x-rate-limit-limit", str(TOKEN_QUOTA))
+            self.send_header("x-rate-limit-remaining", str(remaining))
+            self.send_header("x-rate-limit-reset", str(int(time.time()) + 60))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@check("twitter_rate_limit_per_token")
+def check_twitter_rate_limit_per_token():
+    server = stub_server(TwitterQuotaHandler)
+    server.remaining = {}
+    server.requests = 0
+
+    def verify(token, path=""):
+        twitter = verifier.TwitterVerifier(token, "1", "checks-consumer", "secret", "token-secret")
+        twitter.url = server.url + path
+        return twitter.verify()
+
+    #One user running out of verifications doesn't hold up the others.
+    for _ in range(TOKEN_QUOTA):
+        expect(verify("first") == "1", "a verification inside the token's quota failed")
+    expect_raises(verifier.RateLimitedException, verify, "first")
+    expect(verify("second") == "1", "another token's quota paced this one")
+
+    #A 429 nobody's quota explains backs off the whole application without asking again.
+    expect_raises(verifier.RateLimitedException, verify, "third", "/app")
+    requests = server.requests
+    expect_raises(verifier.RateLimitedException, verify, "fourth")
+    expect(server.requests == requests, "a verification was sent while the application was backing off")
+
+
+def random_text(rng, ascii_only=False):
+    alphabet = u"abcXYZ019-._~ &=+/%?" if ascii_only else u"abcXYZ019-._~ &=+/%?\u00e9\u00fc\u4e2d\U0001f600"
+    return u"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 12)))
+
+
+@check("oauth_signer_matches_sign_request")
+def check_signer_matches_sign_request():
+    rng = random.Random(1)
+    twitter_url = "https://api.twitter.com/1.1/account/verify_credentials.json"
+
+    for i in range(300):
+        #Secrets are escaped as they are, so OAuthRequest needs them as UTF-8 bytes.
+        consumer = oauth.OAuthConsumer(random_text(rng), random_text(rng).encode("utf-8"))
+        token = oauth.OAuthToken(random_text(rng), random_text(rng).encode("utf-8")) if i % 4 else None
+        if token is not None and i % 3 == 0:
+            token.set_callback("http://example.com/" + random_text(rng, ascii_only=True))
+
+        if i % 2:
+            url = twitter_url
+            parameters = dict(verifier.TwitterVerifier.lean_parameters) if i % 3 else {}
+        else:
+            url = "http://Example.com:80/" + random_text(rng, ascii_only=True).replace(" ", "")
+            parameters = dict((random_text(rng), random_text(rng)) for _ in range(rng.randint(0, 4)))
+
+        timestamp, nonce = rng.randint(0, 2 ** 31), random_text(rng)
+        signed = oauth.OAuthSigner(consumer, "GET", url, parameters).sign(token, timestamp, nonce)
+
+        request = oauth.OAuthRequest.from_consumer_and_token(consumer, token, http_method="GET",
+                                                             http_url=url, parameters=dict(parameters))
+        request.set_parameter("oauth_timestamp", timestamp)
+        request.set_parameter("oauth_nonce", nonce)
+        request.sign_request(oauth.OAuthSignatureMethod_HMAC_SHA1(), consumer, token)
+
+        expect(signed == request.parameters,
+               "OAuthSigner and sign_request differ for %r:\n%r\n%r" % (url, signed, request.parameters))
+
+
+class FakeClock(object):
+    """Stands in for the time module, so checks can move the clock."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def with_fake_clock(module, now):
+    """Runs a check with module's time module replaced by a FakeClock starting at now."""
+    def decorate(function):
+        def run():
+            real_time, module.time = module.time, FakeClock(now)
+            try:
+                function(module.time)
+            finally:
+                module.time = real_time
+        return run
+    return decorate
+
+
+@check("oauth_nonce_store")
+@with_fake_clock(oauth, 6000)
+def check_nonce_store(clock):
+    #Buckets are 60 seconds wide; the clock starts at the beginning of one.
+    for bloom_bits in (0, 100, 1 << 16):
+        def store(**kwargs):
+            return oauth.OAuthNonceStore(timestamp_threshold=300, buckets=5, bloom_bits=bloom_bits, **kwargs)
+
+        clock.now = 6000
+        nonces = store()
+        expect(not nonces.check_and_add("consumer", "token", 6000, "a"), "a fresh nonce was refused")
+        expect(nonces.check_and_add("consumer", "token", 6000, "a"), "a replayed nonce was accepted")
+        expect(not nonces.check_and_add("consumer", "other", 6000, "a"), "another token's nonce was refused")
+        expect(nonces.check_and_add("consumer", "token", 6000 - 301, "b"), "a timestamp too old to check was accepted")
+
+        #Buckets too old for their timestamps to be accepted are dropped.
+        clock.now = 6400
+        expect(not nonces.check_and_add("consumer", "token", 6400, "c"), "a fresh nonce was refused")
+        expect(len(nonces) == 1, "expired buckets kept %d nonces" % (len(nonces) - 1))
+
+        #When the store is full the oldest bucket goes, and its timestamps are refused from then on.
+        clock.now = 6000
+        nonces = store(max_nonces=2)
+        expect(not nonces.check_and_add("consumer", "token", 5880, "old"), "a fresh nonce was refused")
+        expect(not nonces.check_and_add("consumer", "token", 6000, "new"), "a fresh nonce was refused")
+        expect(not nonces.check_and_add("consumer", "token", 6000, "newer"), "a full store refused a current nonce")
+        expect(nonces.check_and_add("consumer", "token", 5880, "old"), "a nonce from an evicted bucket was replayed")
+        expect(nonces.check_and_add("consumer", "token", 6000, "new"), "a current nonce was replayed")
+
+        if bloom_bits:
+            #Only the oldest sets go; the Bloom filters keep catching replays.
+            nonces = store(max_nonces=2)
+            for nonce in ("a", "b", "c"):
+                expect(not nonces.check_and_add("consumer", "token", 6000, nonce), "a fresh nonce was refused")
+            for nonce in ("a", "b", "c"):
+                expect(nonces.check_and_add("consumer", "token", 6000, nonce), "a nonce was replayed past the filter")
+            continue
+
+        #The bucket holding the current time never goes; new nonces wait for the clock instead.
+        nonces = store(max_nonces=2)
+        expect(not nonces.check_and_add("consumer", "token", 6000, "a"), "a fresh nonce was refused")
+        expect(not nonces.check_and_add("consumer", "token", 6010, "b"), "a fresh nonce was refused")
+        expect(nonces.check_and_add("consumer", "token", 6020, "c"), "a full store accepted a nonce it couldn't keep")
+        expect(nonces.check_and_add("consumer", "token", 6000, "a"), "the current bucket was evicted")
+        expect(nonces.floor <= 6000, "a full store moved its floor past the current time")
+
+        clock.now = 6060
+        expect(not nonces.check_and_add("consumer", "token", 6060, "d"),
+               "a nonce was refused after the clock moved to a new bucket")
+        expect(nonces.check_and_add("consumer", "token", 6000, "a"), "a dropped bucket's nonce was replayed")
+
+
+class CountingDataStore(oauth.OAuthDataStore):
+    """Has one access token, and counts the lookups that reach it.
+
+    While hold is cleared, lookups wait for it after starting.
+    """
+
+    def __init__(self):
+        self.token = oauth.OAuthToken("token", "secret")
+        self.lookups = 0
+        self.started = threading.Event()
+        self.hold = threading.Event()
+        self.hold.set()
+
+    def lookup_token(self, token_type, token_field):
+        self.lookups += 1
+        self.started.set()
+        self.hold.wait(5)
+        return self.token if token_field == self.token.key else None
+
+
+@check("datastore_invalidated_while_loading")
+def check_invalidated_while_loading():
+    store = CountingDataStore()
+    cached = datastore.CachingOAuthDataStore(store)
+
+    #The token is revoked while a lookup started before the revocation is still running.
+    store.hold.clear()
+    lookup = threading.Thread(target=cached.lookup_token, args=("access", "token"))
+    lookup.start()
+    expect(store.started.wait(5), "the lookup didn't reach the data store")
+    cached.invalidate_token("token")
+    store.hold.set()
+    lookup.join(5)
+
+    cached.lookup_token("access", "token")
+    expect(store.lookups == 2, "a lookup invalidated while it ran was cached")
+
+    cached.lookup_token("access", "token")
+    expect(store.lookups == 2, "an undisturbed lookup wasn't cached")
+
+
+@check("datastore_caches_misses")
+@with_fake_clock(cache, 6000)
+def check_caches_misses(clock):
+    store = CountingDataStore()
+    cached = datastore.CachingOAuthDataStore(store, negative_ttl=5)
+
+    expect(cached.lookup_token("access", "missing") is None, "a missing token was found")
+    expect(cached.lookup_token("access", "missing") is None, "a cached miss was found")
+    expect(store.lookups == 1, "a miss wasn't cached")
+
+    clock.now += 6
+    cached.lookup_token("access", "missing")
+    expect(store.lookups == 2, "a miss was cached for longer than negative_ttl")
+
+    cached.lookup_token("access", "token")
+    clock.now += 6
+    cached.lookup_token("access", "token")
+    expect(store.lookups == 3, "a found token wasn't cached for longer than negative_ttl")
+
+
+@check("shared_memory_cache_shape")
+def check_shared_memory_cache_shape():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "credentials")
+    key = hashlib.sha256("credentials").hexdigest()
+
+    try:
+        shared = cache.SharedMemoryCache(path, buckets=1024)
+        shared.set(key, (1.0, time.time() + 60))
+
+        #Processes still using the file must keep working, so it is neither resized nor cleared.
+        expect_raises(ValueError, cache.SharedMemoryCache, path, buckets=16)
+        expect(shared.get(key) is not None, "opening the file with another shape cleared it")
+
+        other = cache.SharedMemoryCache(path, buckets=1024)
+        expect(other.get(key) is not None, "a process opening the file with the same shape can't see its entries")
+        other.close()
+        shared.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+@check("snapshot_keeps_token_expiry")
+def check_snapshot_keeps_token_expiry():
+    directory = tempfile.mkdtemp()
+
+    def authorizer():
+        return Authorizer(cache_backend=cache.MemoryBackend(), local_cache=cache.LocalCache(),
+                          ticket_signer=ticket.TicketSigner({"k": "secret"}, ttl=300),
+                          local_cache_snapshot_path=os.path.join(directory, "snapshot"))
+
+    def ticket_expires_at(authorizer):
+        identity = authorizer.authorize("Facebook 1|token")
+        return authorizer.ticket_signer.verify(identity.ticket)[2]
+
+    try:
+        #The provider token expires well before the ticket would.
+        saved = authorizer()
+        token_expires_at = time.time() + 20
+        saved.cache_credentials(verifier.FACEBOOK_SERVICE, "1", "token", expires_at=token_expires_at)
+        expect(ticket_expires_at(saved) <= token_expires_at, "a ticket outlived the provider token")
+
+        expect(saved.save_local_cache() == 1, "the entry wasn't saved")
+        restored = authorizer()
+        expect(restored.load_local_cache() == 1, "the entry wasn't restored")
+        expect(ticket_expires_at(restored) <= token_expires_at,
+               "a ticket outlived the provider token after the local cache was restored")
+    finally:
+        shutil.rmtree(directory)
+
+
+class ShedBackgroundVerifier(verifier.OAuthVerifier):
+    """Holds BACKGROUND verifications until released, then refuses them as a low quota would."""
+    started = None
+    release = None
+
+    def verify(self, deadline=None):
+        if self.priority == ratelimit.BACKGROUND:
+            self.started.set()
+            self.release.wait(5)
+            raise ratelimit.RateLimitedException(self.provider, 60)
+
+        self.expires_at = None
+        return self.user_id
+
+
+@check("interactive_verification_skips_background_refresh")
+def check_interactive_skips_background_refresh():
+    ShedBackgroundVerifier.started = threading.Event()
+    ShedBackgroundVerifier.release = threading.Event()
+
+    class ShedBackgroundAuthorizer(Authorizer):
+        verification_flight = singleflight.SingleFlight()
+
+        def verifier_for(self, service, user_id, token, token_secret=None):
+            return ShedBackgroundVerifier(token, user_id, "http://127.0.0.1:1/")
+
+    authorizer = ShedBackgroundAuthorizer(cache_backend=cache.MemoryBackend(), local_cache=cache.LocalCache())
+
+    def refresh():
+        try:
+            authorizer.verify_credentials(verifier.FACEBOOK_SERVICE, "1", "token", priority=ratelimit.BACKGROUND)
+        except ratelimit.RateLimitedException:
+            pass
+
+    background = threading.Thread(target=refresh)
+    background.start()
+    expect(ShedBackgroundVerifier.started.wait(5), "the background refresh didn't start")
+
+    #The refresh is still in flight; a user logging in with the same credentials doesn't wait for its fate.
+    login = {}
+    def log_in():
+        try:
+            login["result"] = authorizer.verify_credentials(verifier.FACEBOOK_SERVICE, "1", "token")
+        except Exception as e:
+            login["result"] = e
+    interactive = threading.Thread(target=log_in)
+    interactive.start()
+    interactive.join(1)
+    ShedBackgroundVerifier.release.set()
+    interactive.join(5)
+    background.join(5)
+
+    expect(login.get("result") == ("1", None), "a login joined a background refresh: %r" % (login.get("result"),))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runnable checks against local stub servers.")
+    parser.add_argument("names", nargs="*", help="only run checks whose names contain one of these")
+    args = parser.parse_args(argv)
+
+    failures = 0
+
+    for name, function in CHECKS:
+        if args.names and not any(n in name for n in args.names):
+            continue
+
+        try:
+            function()
+        except Exception:
+            failures += 1
+            print "FAIL %s" % name
+            traceback.print_exc()
+        else:
+            print "ok   %s" % name
+
+    for server in SERVERS:
+        server.shutdown()
+
+    if failures:
+        print "%d check(s) failed." % failures
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+
+"""
+Per-provider circuit breakers.
+
+When a provider is down, every verification waits for a timeout before
+failing. Once failure_threshold timeouts, connection errors or 5xx
+responses happen in a row, the provider's breaker opens. From then on,
+requests fail at once with CircuitOpenException instead of tying up a
+worker. After reset_timeout seconds the breaker goes half-open and lets a
+few probe requests through. A successful probe closes the breaker, and a
+failed one opens it again.
+
+Verifiers share one breaker per provider name:
+
+import circuit
+circuit.breaker_for("Twitter").failure_threshold = 10
+circuit.breaker_for("Twitter").stats()
+
+4xx responses mean the provider is up, so they count as successes.
+"""
+
+import httplib
+import threading
+import time
+
+import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class UpstreamException(Exception):
+    """The provider could not give an answer. Says nothing about the token itself."""
+    pass
+
+
+class CircuitOpenException(UpstreamException):
+
+    def __init__(self, provider):
+        UpstreamException.__init__(self, "%s is unavailable; not calling it until its circuit breaker resets."
+                                   % provider)
+        self.provider = provider
+
+
+class DeadlineExceededException(UpstreamException):
+
+    def __init__(self, message="Deadline exceeded while verifying credentials."):
+        UpstreamException.__init__(self, message)
+
+
+def transport_error(provider, e):
+    """-> an UpstreamException for e if it is a network, HTTP protocol or HTTP status error, or e itself.
+
+    Callers that catch UpstreamException then treat a provider that fails
+    this way like one whose circuit breaker is open. The original error is
+    kept as the exception's cause attribute.
+    """
+    if not isinstance(e, (IOError, httplib.HTTPException)) or isinstance(e, UpstreamException):
+        return e
+
+    error = UpstreamException("%s request failed: %s" % (provider, str(e) or e.__class__.__name__))
+    error.cause = e
+    return error
+
+
+class CircuitBreaker(object):
+    # Consecutive failures that open the breaker.
+    failure_threshold = 5
+
+    # Seconds an open breaker waits before letting probes through.
+    reset_timeout = 30
+
+    # Probe requests allowed at once while half-open.
+    half_open_max_calls = 1
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None, half_open_max_calls=None):
+        self.name = name
+
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if reset_timeout is not None:
+            self.reset_timeout = reset_timeout
+        if half_open_max_calls is not None:
+            self.half_open_max_calls = half_open_max_calls
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+
+        self.rejections = 0
+
+    def before_request(self):
+        """Call before each request. Raises CircuitOpenException if the request must not be sent."""
+        with self.lock:
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    self.reject()
+                self.transition(HALF_OPEN)
+
+            if self.state == HALF_OPEN:
+                if self.probes >= self.half_open_max_calls:
+                    self.reject()
+                self.probes += 1
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+            if self.state != CLOSED:
+                self.transition(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self.transition(OPEN)
+
+    def record_abandoned(self):
+        """For a request given up on without an answer that says anything about the provider.
+
+        Neither a success nor a failure, but it frees its half-open probe slot.
+        """
+        with self.lock:
+            if self.state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def reject(self):
+        self.rejections += 1
+        metrics.get_metrics().increment("oauth_circuit_breaker_rejections_total", {"provider": self.name})
+        raise CircuitOpenException(self.name)
+
+    def transition(self, state):
+        self.state = state
+        self.probes = 0
+        metrics.get_metrics().increment("oauth_circuit_breaker_transitions_total",
+                                        {"provider": self.name, "state": state})
+
+    def reset(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "rejections": self.rejections,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(name):
+    """-> the process-wide CircuitBreaker for a provider, created on first use."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+
+        return breaker
@@ -0,0 +1,381 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+A small, thread-safe keep-alive connection pool used by the verifiers.
+
+Opening a new HTTPS connection for every verification means a DNS lookup,
+a TCP connect and a full TLS handshake before the provider even sees the
+request. The pool keeps idle connections per (scheme, host, port) and hands
+them back out, so steady-state verifications reuse an open TLS session.
+
+All verifiers share connection_pool.default_pool by default. To size it:
+
+OAuthVerifier.pool = connection_pool.ConnectionPool(max_connections_per_host=20)
+
+pool.stats() returns hit/miss counters that can be used to pick a size.
+"""
+
+import errno
+import httplib
+import socket
+import ssl
+import threading
+import time
+import urllib2
+import urlparse
+
+from StringIO import StringIO
+
+
+#Errors that mean a reused connection was closed by the provider before it
+#sent anything back, so the request can safely be sent again.
+STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+def is_stale_connection_error(e):
+    """-> True if e shows the connection was already closed, rather than slow or broken mid-response."""
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.BadStatusLine):
+        # An empty status line (which httplib stores as its repr, "''"); any
+        # other means the provider did answer.
+        return e.line in ("", "''") or e.line.startswith("No status line received")
+    return isinstance(e, socket.error) and e.errno in STALE_CONNECTION_ERRNOS
+
+
+def remaining_timeout(timeout, started):
+    """-> what is left of timeout since started. Raises socket.timeout if nothing is."""
+    if timeout is None:
+        return None
+
+    remaining = timeout - (time.time() - started)
+    if remaining <= 0:
+        raise socket.timeout("timed out")
+
+    return remaining
+
+
+class PooledResponse(object):
+    """A fully read HTTP response, shaped like the object urllib2.urlopen returns."""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+
+class _PooledConnectionMixin:
+    pool = None
+    connect_timeout = None
+
+    def connect(self):
+        connect_timeout = self.connect_timeout if self.connect_timeout is not None else self.timeout
+        self.sock = self.pool.create_connection(self.host, self.port, connect_timeout)
+
+        if connect_timeout != self.timeout:
+            self.sock.settimeout(self.timeout)
+
+
+class _HTTPConnection(_PooledConnectionMixin, httplib.HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_PooledConnectionMixin, httplib.HTTPSConnection):
+
+    def connect(self):
+        _PooledConnectionMixin.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+
+
+class ConnectionPool(object):
+    # Idle connections kept per host. Extra connections are closed on release.
+    max_connections_per_host = 10
+
+    # How long resolved addresses are reused before asking DNS again.
+    dns_ttl = 300
+
+    # Idle connections older than this are dropped instead of reused, since
+    # providers close keep-alive connections on their end after a while.
+    idle_timeout = 50
+
+    # Socket timeout used for new connections. None means no timeout.
+    timeout = None
+
+    # Timeout for establishing connections. None means use timeout.
+    connect_timeout = None
+
+    def __init__(self, max_connections_per_host=None, dns_ttl=None,
+                 idle_timeout=None, timeout=None, ssl_context=None, connect_timeout=None):
+        if max_connections_per_host is not None:
+            self.max_connections_per_host = max_connections_per_host
+        if dns_ttl is not None:
+            self.dns_ttl = dns_ttl
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        if timeout is not None:
+            self.timeout = timeout
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+
+        # One context for every connection, so certificates are loaded once.
+        self.ssl_context = ssl_context or ssl.create_default_context()
+
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.addresses = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.retries = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    def urlopen(self, request, timeout=None, connect_timeout=None):
+        """Performs a request and returns a PooledResponse.
+
+        request may be a URL string or a urllib2.Request. Like urllib2.urlopen,
+        non-2xx responses raise urllib2.HTTPError. timeout applies to each
+        socket read and write, connect_timeout to opening a new connection.
+        """
+        if isinstance(request, basestring):
+            request = urllib2.Request(request)
+
+        url = request.get_full_url()
+        method = request.get_method()
+        body = request.get_data()
+        headers = dict(request.header_items())
+
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port or (443 if scheme == "https" else 80)
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        key = (scheme, host, port)
+        started = time.time()
+        conn, reused = self.acquire(key, timeout, connect_timeout)
+
+        try:
+            response = self.send(conn, method, path, body, headers)
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+
+            if not reused or not is_stale_connection_error(e):
+                raise
+
+            # The provider closed the idle connection under us. Retry once on
+            # a fresh connection; the verification requests are idempotent.
+            # The retry only gets what is left of the caller's timeouts.
+            self.count_retry()
+
+            timeout = remaining_timeout(timeout if timeout is not None else self.timeout, started)
+            connect_timeout = remaining_timeout(connect_timeout, started)
+            conn = self.new_connection(key, timeout, connect_timeout)
+
+            try:
+                response = self.send(conn, method, path, body, headers)
+            except Exception:
+                conn.close()
+                raise
+
+        result_body = response.read()
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+
+        if not 200 <= response.status < 300:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, StringIO(result_body))
+
+        return PooledResponse(url, response.status, response.reason, response.msg, result_body)
+
+    def send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+    def acquire(self, key, timeout=None, connect_timeout=None):
+        conn = self.acquire_idle(key)
+
+        if conn is None:
+            return self.new_connection(key, timeout, connect_timeout), False
+
+        conn.timeout = timeout if timeout is not None else self.timeout
+        if conn.sock:
+            conn.sock.settimeout(conn.timeout)
+        return conn, True
+
+    def acquire_idle(self, key):
+        """Returns a kept-alive connection for key, or None if there isn't one."""
+        now = time.time()
+
+        with self.lock:
+            connections = self.idle.get(key)
+
+            while connections:
+                conn, released_at = connections.pop()
+
+                if now - released_at < self.idle_timeout:
+                    self.hits += 1
+                    return conn
+
+                conn.close()
+
+            self.misses += 1
+
+        return None
+
+    def release(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+
+            if len(connections) < self.max_connections_per_host:
+                connections.append((conn, time.time()))
+                return
+
+        conn.close()
+
+    def count_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def new_connection(self, key, timeout=None, connect_timeout=None):
+        scheme, host, port = key
+
+        if timeout is None:
+            timeout = self.timeout
+        if connect_timeout is None:
+            connect_timeout = self.connect_timeout
+
+        if scheme == "https":
+            conn = _HTTPSConnection(host, port, timeout=timeout, context=self.ssl_context)
+        elif scheme == "http":
+            conn = _HTTPConnection(host, port, timeout=timeout)
+        else:
+            raise ValueError("Unsupported URL scheme: %s" % scheme)
+
+        conn.pool = self
+        conn.connect_timeout = connect_timeout
+        return conn
+
+    def cached_addresses(self, host, port):
+        """Returns the cached getaddrinfo() result, or None if it's missing or expired."""
+        with self.lock:
+            cached = self.addresses.get((host, port))
+
+            if cached and cached[0] > time.time():
+                self.dns_hits += 1
+                return cached[1]
+
+        return None
+
+    def resolve(self, host, port):
+        addresses = self.cached_addresses(host, port)
+
+        if addresses is not None:
+            return addresses
+
+        with self.lock:
+            self.dns_misses += 1
+
+        now = time.time()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+        with self.lock:
+            self.addresses[(host, port)] = (now + self.dns_ttl, addresses)
+
+        return addresses
+
+    def create_connection(self, host, port, timeout=None):
+        """Like socket.create_connection, but resolves through the DNS cache."""
+        error = None
+
+        for family, socktype, proto, canonname, address in self.resolve(host, port):
+            sock = None
+
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                if timeout is not None:
+                    sock.settimeout(timeout)
+
+                sock.connect(address)
+                return sock
+
+            except socket.error as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+
+        # Every cached address failed, so the cached record may be stale.
+        with self.lock:
+            self.addresses.pop((host, port), None)
+
+        if error is not None:
+            raise error
+
+        raise socket.error("getaddrinfo returns an empty list")
+
+    def clear(self):
+        """Closes every idle connection and forgets cached DNS records."""
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+            self.addresses = {}
+
+        for connections in idle.values():
+            for conn, released_at in connections:
+                conn.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "retries": self.retries,
+                "dns_hits": self.dns_hits,
+                "dns_misses": self.dns_misses,
+                "idle": sum(len(connections) for connections in self.idle.values()),
+            }
+
+
+default_pool = ConnectionPool()
@@ -0,0 +1,177 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Caches OAuthServer's consumer and access token lookups in memory.
+
+CachingOAuthDataStore wraps any oauth.OAuthDataStore. Consumers and access
+tokens are kept in LocalCaches, so once they are warm, verifying a signed
+request doesn't touch the database. Lookups that find nothing are cached
+too, for a much shorter time, so a client retrying a bad key can't turn
+every request into a query.
+
+data_store = datastore.CachingOAuthDataStore(MyDataStore(), ttl=300)
+data_store.preload(consumers=all_consumers, tokens=active_access_tokens)
+server = oauth.OAuthServer(data_store)
+
+data_store.invalidate_token(token_key)   #When an access token is revoked.
+data_store.invalidate_consumer(consumer_key)
+
+Invalidation only reaches this process. Other processes keep a revoked token
+for up to ttl seconds, so keep it short if that matters. Request tokens are
+never cached, since they change state while they are being authorized.
+Everything else is passed straight to the wrapped data store.
+"""
+
+import threading
+
+import oauth
+import singleflight
+from cache import LocalCache
+
+#Cached for lookups that found nothing, so a hit can be told apart from a cached miss.
+_NOT_FOUND = object()
+
+
+class CachingOAuthDataStore(oauth.OAuthDataStore):
+    # Maximum number of consumers, and of tokens, kept in memory.
+    max_size = 100000
+
+    # How long found consumers and access tokens are kept, in seconds.
+    ttl = 300
+
+    # How long lookups that found nothing are remembered. 0 turns this off.
+    negative_ttl = 5
+
+    def __init__(self, data_store, max_size=None, ttl=None, negative_ttl=None):
+        if max_size is not None:
+            self.max_size = max_size
+        if ttl is not None:
+            self.ttl = ttl
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+
+        self.data_store = data_store
+        self.consumers = LocalCache(max_size=self.max_size, ttl=self.ttl)
+        self.tokens = LocalCache(max_size=self.max_size, ttl=self.ttl)
+
+        # Concurrent misses for the same key share one database query.
+        self.flight = singleflight.SingleFlight()
+
+        # Generation of each key being loaded, bumped when it is invalidated.
+        # A load only caches its answer if the generation didn't change, so
+        # a query that started before a revocation can't bring it back.
+        self.lock = threading.Lock()
+        self.generations = {}
+
+    def cached(self, local_cache, key, lookup, *args):
+        value = local_cache.get(key, None)
+
+        if value is None:
+            value = self.flight.do((id(local_cache), key), self.load, local_cache, key, lookup, *args)
+
+        return None if value is _NOT_FOUND else value
+
+    def load(self, local_cache, key, lookup, *args):
+        generation_key = (id(local_cache), key)
+
+        # The single flight means there is one load per key at a time.
+        with self.lock:
+            self.generations[generation_key] = 0
+
+        try:
+            value = lookup(*args)
+        except Exception:
+            with self.lock:
+                del self.generations[generation_key]
+            raise
+
+        found = value if value else _NOT_FOUND
+
+        with self.lock:
+            if not self.generations.pop(generation_key):
+                local_cache.set(key, found, None if value else self.negative_ttl)
+
+        return found
+
+    def invalidate(self, local_cache, key):
+        with self.lock:
+            generation_key = (id(local_cache), key)
+            if generation_key in self.generations:
+                self.generations[generation_key] += 1
+
+            return local_cache.delete(key)
+
+    def lookup_consumer(self, key):
+        return self.cached(self.consumers, key, self.data_store.lookup_consumer, key)
+
+    def lookup_token(self, token_type, token_field):
+        # OAuthServer calls lookup_token(token_type, token_field).
+        if token_type != "access":
+            return self.data_store.lookup_token(token_type, token_field)
+
+        return self.cached(self.tokens, token_field, self.data_store.lookup_token, token_type, token_field)
+
+    def lookup_nonce(self, oauth_consumer, oauth_token, nonce):
+        return self.data_store.lookup_nonce(oauth_consumer, oauth_token, nonce)
+
+    def fetch_request_token(self, oauth_consumer, oauth_callback):
+        return self.data_store.fetch_request_token(oauth_consumer, oauth_callback)
+
+    def fetch_access_token(self, oauth_consumer, oauth_token, oauth_verifier):
+        token = self.data_store.fetch_access_token(oauth_consumer, oauth_token, oauth_verifier)
+
+        # The client is about to use it, and a cached miss for its key would now be wrong.
+        if token:
+            self.tokens.set(token.key, token)
+
+        return token
+
+    def authorize_request_token(self, oauth_token, user):
+        return self.data_store.authorize_request_token(oauth_token, user)
+
+    def preload(self, consumers=(), tokens=()):
+        """Caches OAuthConsumers and access OAuthTokens, e.g. all of them at startup."""
+        for consumer in consumers:
+            self.consumers.set(consumer.key, consumer)
+
+        for token in tokens:
+            self.tokens.set(token.key, token)
+
+    def invalidate_consumer(self, key):
+        """Forgets a consumer, so the next lookup goes to the data store. -> True if it was cached."""
+        return self.invalidate(self.consumers, key)
+
+    def invalidate_token(self, key):
+        """Forgets an access token, e.g. when it is revoked. -> True if it was cached."""
+        return self.invalidate(self.tokens, key)
+
+    def clear(self):
+        with self.lock:
+            for generation_key in self.generations:
+                self.generations[generation_key] += 1
+
+            self.consumers.clear()
+            self.tokens.clear()
+
+    def stats(self):
+        return {"consumers": self.consumers.stats(), "tokens": self.tokens.stats()}
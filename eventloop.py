@@ -0,0 +1,722 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+A tiny single-threaded event loop with generator based tasklets, used by the
+non-blocking verify_async() methods.
+
+Tasklets work the same way as App Engine's ndb tasklets: a generator yields
+Futures (or lists of Futures) and is resumed with their results. Use
+raise Return(value) to return a value from a tasklet.
+
+@eventloop.tasklet
+def verify_both(facebook_verifier, google_verifier):
+    facebook_id, google_id = yield [facebook_verifier.verify_async(),
+                                    google_verifier.verify_async()]
+    raise eventloop.Return((facebook_id, google_id))
+
+future = verify_both(...)
+future.get_result() #Runs the loop until the tasklet finishes.
+
+Each thread gets its own loop. A Future must be waited on from the thread
+that created it.
+"""
+
+import errno
+import functools
+import heapq
+import httplib
+import os
+import select
+import socket
+import ssl
+import sys
+import threading
+import time
+import types
+import urllib2
+import urlparse
+
+from StringIO import StringIO
+
+import connection_pool
+
+
+class Return(StopIteration):
+    """Raise Return(value) inside a tasklet to set the result of its Future."""
+
+    def __init__(self, value=None):
+        StopIteration.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    """The eventual result of a tasklet or I/O operation."""
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def set_result(self, result):
+        if self.done:
+            return
+        self.done = True
+        self.result = result
+        self._run_callbacks()
+
+    def set_exception(self, exception, traceback=None):
+        if self.done:
+            return
+        self.done = True
+        self.exc_info = (type(exception), exception, traceback)
+        self._run_callbacks()
+
+    def add_callback(self, callback):
+        """Calls callback(future) once the future is done."""
+        if self.done:
+            get_event_loop().call_soon(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def get_exception(self):
+        self.wait()
+        return self.exc_info[1] if self.exc_info else None
+
+    def get_result(self):
+        self.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+    def wait(self):
+        if not self.done:
+            get_event_loop().run_until(self)
+
+    def _run_callbacks(self):
+        callbacks = self.callbacks
+        self.callbacks = []
+
+        loop = get_event_loop()
+        for callback in callbacks:
+            loop.call_soon(callback, self)
+
+
+class _Timer(object):
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class EventLoop(object):
+    """Runs ready callbacks, timers and socket readiness callbacks."""
+
+    def __init__(self):
+        self.ready = []
+        self.timers = []
+        self.readers = {}
+        self.writers = {}
+
+        # Callbacks handed over by other threads, and the pipe they write to
+        # so a loop blocked in poll() wakes up for them.
+        self.threadsafe = []
+        self.threadsafe_lock = threading.Lock()
+        self.waker = None
+        self.threads = 0
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Like call_soon, but may be called from any thread."""
+        with self.threadsafe_lock:
+            self.threadsafe.append((callback, args))
+
+        os.write(self.waker[1], "x")
+
+    def run_in_thread(self, function, *args):
+        """Returns a Future for function(*args), run on a separate thread.
+
+        For blocking calls, like DNS lookups, that would otherwise stall
+        every tasklet on the loop.
+        """
+        future = Future()
+
+        if self.waker is None:
+            self.waker = os.pipe()
+
+        def run():
+            try:
+                outcome = function(*args), None
+            except Exception:
+                outcome = None, sys.exc_info()
+
+            self.call_soon_threadsafe(finish, outcome)
+
+        def finish(outcome):
+            self.threads -= 1
+            if not self.threads:
+                self.remove_reader(self.waker[0])
+
+            result, exc_info = outcome
+
+            if exc_info:
+                future.set_exception(exc_info[1], exc_info[2])
+            else:
+                future.set_result(result)
+
+        self.threads += 1
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        return future
+
+    def _wake(self):
+        os.read(self.waker[0], 4096)
+
+        with self.threadsafe_lock:
+            self.ready.extend(self.threadsafe)
+            self.threadsafe = []
+
+    def call_later(self, delay, callback, *args):
+        timer = _Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self.writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def run_until(self, future):
+        while not future.done:
+            self.run_once()
+
+    def run_once(self):
+        # Cancelled timers must not keep the loop waiting.
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+
+        # Readers are one-shot, so the wakeup pipe is watched again on every
+        # pass while a thread started by run_in_thread() hasn't reported back.
+        if self.threads and self.waker[0] not in self.readers:
+            self.add_reader(self.waker[0], self._wake)
+
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0].when - time.time())
+        elif self.readers or self.writers:
+            timeout = None
+        else:
+            raise RuntimeError("Event loop has nothing left to run.")
+
+        if self.readers or self.writers:
+            self.poll(timeout)
+        elif timeout:
+            time.sleep(timeout)
+
+        now = time.time()
+        while self.timers and self.timers[0].when <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+        # Ready callbacks run last, so run_until() returns as soon as one of
+        # them finishes its future, without waiting on unrelated timers.
+        ready = self.ready
+        self.ready = []
+
+        for callback, args in ready:
+            callback(*args)
+
+    def poll(self, timeout):
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            for fd in self.readers:
+                poller.register(fd, select.POLLIN)
+            for fd in self.writers:
+                poller.register(fd, select.POLLOUT | (select.POLLIN if fd in self.readers else 0))
+
+            try:
+                events = poller.poll(None if timeout is None else timeout * 1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    return
+                raise
+
+            readable = [fd for fd, event in events if event & ~select.POLLOUT]
+            writable = [fd for fd, event in events if event & (select.POLLOUT | select.POLLERR | select.POLLHUP)]
+        else:
+            readable, writable, _ = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+
+        for fd in readable:
+            callback = self.readers.pop(fd, None)
+            if callback:
+                callback()
+
+        for fd in writable:
+            callback = self.writers.pop(fd, None)
+            if callback:
+                callback()
+
+
+_state = threading.local()
+
+
+def get_event_loop():
+    loop = getattr(_state, "loop", None)
+
+    if loop is None:
+        loop = _state.loop = EventLoop()
+
+    return loop
+
+
+class _Task(object):
+
+    def __init__(self, generator, future):
+        self.generator = generator
+        self.future = future
+
+    def step(self, value=None, exc_info=None):
+        try:
+            if exc_info:
+                yielded = self.generator.throw(*exc_info)
+            else:
+                yielded = self.generator.send(value)
+
+        except Return as r:
+            self.future.set_result(r.value)
+            return
+        except StopIteration:
+            self.future.set_result(None)
+            return
+        except Exception:
+            _, e, tb = sys.exc_info()
+            self.future.set_exception(e, tb)
+            return
+
+        if isinstance(yielded, (list, tuple)):
+            yielded = gather(yielded)
+
+        if not isinstance(yielded, Future):
+            self.step(exc_info=(TypeError, TypeError("Tasklets must yield Futures, not %r" % yielded), None))
+            return
+
+        yielded.add_callback(self.wakeup)
+
+    def wakeup(self, future):
+        if future.exc_info:
+            self.step(exc_info=future.exc_info)
+        else:
+            self.step(future.result)
+
+
+def tasklet(func):
+    """Decorator that turns a generator function into one returning a Future."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        future = Future()
+
+        try:
+            result = func(*args, **kwargs)
+        except Return as r:
+            future.set_result(r.value)
+            return future
+        except Exception:
+            _, e, tb = sys.exc_info()
+            future.set_exception(e, tb)
+            return future
+
+        if isinstance(result, types.GeneratorType):
+            _Task(result, future).step()
+        else:
+            future.set_result(result)
+
+        return future
+
+    return wrapper
+
+
+def gather(futures):
+    """Returns a Future for the list of results. Fails with the first exception."""
+    result = Future()
+    futures = list(futures)
+    remaining = [len(futures)]
+
+    if not futures:
+        result.set_result([])
+        return result
+
+    def on_done(future):
+        if future.exc_info:
+            result.set_exception(future.exc_info[1], future.exc_info[2])
+            return
+
+        remaining[0] -= 1
+        if not remaining[0]:
+            result.set_result([f.result for f in futures])
+
+    for future in futures:
+        future.add_callback(on_done)
+
+    return result
+
+
+def sleep(delay):
+    future = Future()
+    get_event_loop().call_later(delay, future.set_result, None)
+    return future
+
+
+def _wait_for(sock, writable, deadline):
+    future = Future()
+    loop = get_event_loop()
+    fd = sock.fileno()
+
+    if deadline is not None:
+        def on_timeout():
+            (loop.remove_writer if writable else loop.remove_reader)(fd)
+            future.set_exception(socket.timeout("timed out"))
+
+        timer = loop.call_later(max(0, deadline - time.time()), on_timeout)
+    else:
+        timer = None
+
+    def on_ready():
+        if timer:
+            timer.cancel()
+        future.set_result(None)
+
+    if writable:
+        loop.add_writer(fd, on_ready)
+    else:
+        loop.add_reader(fd, on_ready)
+
+    return future
+
+
+class _BufferSocket(object):
+    """Lets httplib parse a response that has already been read."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args, **kwargs):
+        return StringIO(self.data)
+
+
+def _until(future, deadline):
+    """Returns a Future that fails with socket.timeout if future isn't done by deadline."""
+    if deadline is None:
+        return future
+
+    result = Future()
+    timer = get_event_loop().call_later(max(0, deadline - time.time()), result.set_exception,
+                                        socket.timeout("timed out"))
+
+    def on_done(future):
+        timer.cancel()
+        if future.exc_info:
+            result.set_exception(future.exc_info[1], future.exc_info[2])
+        else:
+            result.set_result(future.result)
+
+    future.add_callback(on_done)
+    return result
+
+
+@tasklet
+def _connect(host, port, pool, deadline):
+    error = None
+
+    # getaddrinfo() blocks, so cache misses are resolved on another thread.
+    addresses = pool.cached_addresses(host, port)
+    if addresses is None:
+        addresses = yield _until(get_event_loop().run_in_thread(pool.resolve, host, port), deadline)
+
+    for family, socktype, proto, canonname, address in addresses:
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+
+        try:
+            code = sock.connect_ex(address)
+
+            if code in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                yield _wait_for(sock, True, deadline)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+            if code:
+                raise socket.error(code, errno.errorcode.get(code, "connect failed"))
+
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            raise Return(sock)
+
+        except socket.error as e:
+            error = e
+            sock.close()
+
+    raise error or socket.error("getaddrinfo returns an empty list")
+
+
+@tasklet
+def _open(conn, pool, deadline, connect_deadline):
+    """Connects conn.sock without blocking, including the TLS handshake."""
+    sock = yield _connect(conn.host, conn.port, pool, connect_deadline)
+
+    try:
+        if isinstance(conn, httplib.HTTPSConnection):
+            sock = pool.ssl_context.wrap_socket(sock, server_hostname=conn.host,
+                                                do_handshake_on_connect=False)
+            while True:
+                done, wait = _retry_io(sock, sock.do_handshake, False, deadline)
+                if not wait:
+                    break
+                yield wait
+
+    except Exception:
+        sock.close()
+        raise
+
+    conn.sock = sock
+
+
+def _retry_io(sock, operation, writable, deadline):
+    """Runs a non-blocking operation.
+
+    Returns (result, None) if it completed, or (None, future) where the Future
+    resolves once the socket is ready to retry.
+    """
+    while True:
+        try:
+            return operation(), None
+        except ssl.SSLWantReadError:
+            return None, _wait_for(sock, False, deadline)
+        except ssl.SSLWantWriteError:
+            return None, _wait_for(sock, True, deadline)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None, _wait_for(sock, writable, deadline)
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+
+def _recv(sock):
+    try:
+        return sock.recv(65536)
+    except ssl.SSLEOFError:
+        return ""
+    except ssl.SSLError as e:
+        # OpenSSL 3 reports a close without close_notify as a generic error.
+        # httplib still catches truncated bodies when the response is parsed.
+        if "unexpected eof" in str(e):
+            return ""
+        raise
+
+
+def _is_complete(data, method):
+    """Whether data holds a whole response, going by its framing headers.
+
+    Responses framed by neither Content-Length nor chunked encoding end when
+    the server closes the connection, so they are never complete here.
+    """
+    end = data.find("\r\n\r\n")
+    if end < 0:
+        return False
+
+    head = httplib.HTTPResponse(_BufferSocket(data[:end + 4]), method=method)
+    head.begin()
+    body = data[end + 4:]
+
+    if head.chunked:
+        position = 0
+
+        while True:
+            line_end = body.find("\r\n", position)
+            if line_end < 0:
+                return False
+
+            try:
+                size = int(body[position:line_end].split(";", 1)[0], 16)
+            except ValueError:
+                return True #Let httplib report the malformed chunk.
+
+            if not size:
+                trailer = body[line_end + 2:]
+                return trailer.startswith("\r\n") or "\r\n\r\n" in trailer
+
+            position = line_end + 2 + size + 2
+            if position > len(body):
+                return False
+
+    if head.length is not None:
+        return len(body) >= head.length
+
+    return False
+
+
+@tasklet
+def _exchange(sock, message, method, deadline):
+    """Sends message and reads one response, leaving the connection open.
+
+    Returns (response, body, closed), where closed tells whether the server
+    closed the connection after the response.
+    """
+    while message:
+        sent, wait = _retry_io(sock, lambda: sock.send(message), True, deadline)
+        if wait:
+            yield wait
+        else:
+            message = message[sent:]
+
+    data = ""
+    closed = False
+
+    while not _is_complete(data, method):
+        chunk, wait = _retry_io(sock, lambda: _recv(sock), False, deadline)
+        if wait:
+            yield wait
+        elif chunk:
+            data += chunk
+        else:
+            closed = True
+            break
+
+    if not data:
+        # Same as httplib, so is_stale_connection_error() recognizes it.
+        raise httplib.BadStatusLine("")
+
+    response = httplib.HTTPResponse(_BufferSocket(data), method=method)
+    response.begin()
+    body = response.read()
+
+    raise Return((response, body, closed))
+
+
+@tasklet
+def fetch(request, timeout=None, pool=None, connect_timeout=None):
+    """Non-blocking counterpart of ConnectionPool.urlopen.
+
+    Resolves DNS and SSL settings through pool (the shared verifier pool by
+    default) and returns a Future for a PooledResponse. Non-2xx responses fail
+    the Future with urllib2.HTTPError, and running out of time fails it with
+    socket.timeout. timeout covers the whole request; connect_timeout limits
+    the TCP connect within it.
+
+    Connections are kept alive and shared with the pool's blocking requests:
+    idle ones are borrowed in non-blocking mode and returned afterwards.
+    """
+    pool = pool or connection_pool.default_pool
+
+    if isinstance(request, basestring):
+        request = urllib2.Request(request)
+
+    url = request.get_full_url()
+    method = request.get_method()
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme
+    host = parts.hostname
+    port = parts.port or (443 if scheme == "https" else 80)
+
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    deadline = time.time() + timeout if timeout is not None else None
+
+    body = request.get_data() or ""
+    headers = dict(request.header_items())
+    headers["Host"] = parts.netloc
+    if body:
+        headers["Content-Length"] = str(len(body))
+
+    message = "%s %s HTTP/1.1\r\n" % (method, path)
+    message += "".join("%s: %s\r\n" % item for item in headers.items())
+    message += "\r\n" + body
+
+    key = (scheme, host, port)
+    conn = pool.acquire_idle(key)
+    result = None
+
+    if conn is not None:
+        try:
+            conn.sock.setblocking(0)
+            result = yield _exchange(conn.sock, message, method, deadline)
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+
+            if not connection_pool.is_stale_connection_error(e):
+                raise
+
+            # The provider closed the idle connection under us. Retry once on
+            # a fresh connection, within what is left of the deadline.
+            pool.count_retry()
+
+    if result is None:
+        connect_deadline = deadline
+        if connect_timeout is not None:
+            connect_deadline = min(deadline or float("inf"), time.time() + connect_timeout)
+
+        conn = pool.new_connection(key, timeout, connect_timeout)
+
+        try:
+            yield _open(conn, pool, deadline, connect_deadline)
+            result = yield _exchange(conn.sock, message, method, deadline)
+        except Exception:
+            conn.close()
+            raise
+
+    response, result_body, closed = result
+
+    if closed or response.will_close:
+        conn.close()
+    else:
+        pool.release(key, conn)
+
+    if not 200 <= response.status < 300:
+        raise urllib2.HTTPError(url, response.status, response.reason,
+                                response.msg, StringIO(result_body))
+
+    raise Return(connection_pool.PooledResponse(url, response.status, response.reason,
+                                                response.msg, result_body))
@@ -24,14 +24,12 @@ __author__ = 'nigel'
 
 import webapp2
 import verifier
-import re
-import hashlib
+import authorizer
+import cache
 
-from google.appengine.api import memcache
-
-TWITTER_SERVICE = "Twitter"
-FACEBOOK_SERVICE = "Facebook"
-GOOGLE_SERVICE = "Google"
+TWITTER_SERVICE = verifier.TWITTER_SERVICE
+FACEBOOK_SERVICE = verifier.FACEBOOK_SERVICE
+GOOGLE_SERVICE = verifier.GOOGLE_SERVICE
 
 """
 A simple webapp2 request handler that can check oAuth Authorizations
@@ -64,96 +62,50 @@ self.user_service #The service used to log in ('Facebook', 'Google', or 'Twitter
 If the oAuth token is invalid, or does not belong to the specified user,
 the handler will throw an OAuthException.
 
+To skip that work on later requests, set ticket_signer. authorize_user() then puts a
+signed ticket in the X-OAuth-Ticket response header (and in self.ticket), which clients
+send back as "Authorization: Ticket <ticket>" until it expires.
+
 If you require a specific user to be logged in, call authorize_user(required_user="foo").
 If the request does not use "foo"'s credentials, the handler will raise an OAuthException.
 
 If you don't want to deal with exceptions, use try_authorize_user(), which returns True
 if the authorization succeeded and False if it failed.
 
-"""
+If the provider can't be reached in time, answers with a server error, or its circuit
+breaker is open, and no cached answer can be served, authorize_user() raises a
+verifier.UpstreamException instead. Neither method catches it; answering 503 is usually right. To bound the time
+spent verifying, call authorize_user(deadline=2) or set verification_deadline.
 
+The settings above, and all of the caching, come from authorizer.Authorizer.
+To check the same headers outside of webapp2, use an Authorizer directly, or
+wrap a WSGI application in middleware.OAuthMiddleware.
 
-class OAuthHandler(webapp2.RequestHandler):
-  # You can set a custom array of services you want to support.
-  supported_services = [TWITTER_SERVICE, FACEBOOK_SERVICE, GOOGLE_SERVICE]
+"""
 
-  #Only necessary for Twitter. These should be kept secret.
-  consumer_key = None
-  consumer_secret = None
 
+class OAuthHandler(webapp2.RequestHandler, authorizer.Authorizer):
   #Filled in by authorize_user() after successful execution.
   user_service = None
   user_id = None
+  ticket = None
 
-  #Cut down on network traffic by saving oAuth tokens
-  #to memcache. Requests can then be verfied without hitting the
-  #service provider. Note that if you turn this option off,
-  # you might run up against rate limits from the 3rd party provider.
-  use_credential_caching = True
-
-  #Expiration time for cached tokens
-  credential_caching_period = 900
-
-  def authorize_user(self, required_user=None):
-
-    authorization_header = self.request.headers.get("Authorization")
-
-    if not authorization_header:
-      raise verifier.OAuthException("Authorization header is required.")
-
-    fb_goog_re = re.compile("(Facebook|Google) (.+)\|(.+)")
-    twitter_re = re.compile("Twitter (.+)\|(.+)\|(.+)")
-
-    fb_goog_match = fb_goog_re.match(authorization_header)
-    twitter_match = twitter_re.match(authorization_header)
-
-    if not fb_goog_match and not twitter_match:
-      raise verifier.OAuthException("Malformed authorization header.")
-
-    if twitter_match:
-
-      if TWITTER_SERVICE not in self.supported_services:
-        raise verifier.OAuthException("Twitter authentication not supported.")
-
-      user_id = twitter_match.group(1)
-      token = twitter_match.group(2)
-      token_secret = twitter_match.group(3)
-
-      if not self.load_cached_credentials(TWITTER_SERVICE, user_id, token, token_secret):
-        self.user_id = verifier.TwitterVerifier(token,
-                                                user_id,
-                                                self.consumer_key,
-                                                self.consumer_secret,
-                                                token_secret).verify()
-        self.user_service = TWITTER_SERVICE
-
-        self.cache_credentials(TWITTER_SERVICE, user_id, token, token_secret)
-
-    else:
-      service = fb_goog_match.group(1)
-      user_id = fb_goog_match.group(2)
-      token = fb_goog_match.group(3)
-
-      if service not in self.supported_services:
-        raise verifier.OAuthException("%s authentication not supported." % service)
-
-      elif self.load_cached_credentials(service, user_id, token):
-        pass
-
-      elif service == FACEBOOK_SERVICE:
-        self.user_id = verifier.FacebookVerifier(token, user_id).verify()
-        self.user_service = FACEBOOK_SERVICE
+  #Cached credentials go to App Engine's memcache; see cache.py for other backends.
+  cache_backend = cache.AppEngineMemcacheBackend()
 
-        self.cache_credentials(FACEBOOK_SERVICE, user_id, token)
+  def authorize_user(self, required_user=None, deadline=None):
 
-      else:
-        self.user_id = verifier.GoogleVerifier(token, user_id).verify()
-        self.user_service = GOOGLE_SERVICE
+    identity = self.authorize(self.request.headers.get("Authorization"), deadline)
 
-        self.cache_credentials(GOOGLE_SERVICE, user_id, token)
+    self.user_service = identity.service
+    self.user_id = identity.user_id
 
     if required_user and required_user != self.user_id:
-      raise verifier.OAuthException("User %s is unauthorized." % user_id)
+      raise verifier.OAuthException("User %s is unauthorized." % self.user_id)
+
+    if identity.ticket:
+      self.ticket = identity.ticket
+      self.response.headers[self.ticket_response_header] = identity.ticket
 
   def try_authorize_user(self, required_user=None):
     try:
@@ -161,39 +113,3 @@ class OAuthHandler(webapp2.RequestHandler):
       return True
     except verifier.OAuthException as e:
       return False
-
-  @staticmethod
-  def key_for_credentials(service, user_id, token, token_secret=None):
-
-    key = "OAuthVerifier|{0}|{1}|{2}".format(service, user_id, token)
-
-    if token_secret:
-      key += "|{0}".format(token_secret)
-
-    return hashlib.sha256(key).hexdigest()
-
-  def load_cached_credentials(self, service, user_id, token, token_secret=None):
-
-    cache_key = OAuthHandler.key_for_credentials(service, user_id, token, token_secret)
-
-    if self.use_credential_caching and memcache.get(cache_key):
-      self.user_id = user_id
-      self.user_service = service
-      print("Found cached credentials.")
-      return True
-
-    else:
-      print("Caching is off or credentials not found.")
-      return False
-
-  def cache_credentials(self, service, user_id, token, token_secret=None):
-    cache_key = OAuthHandler.key_for_credentials(service, user_id, token, token_secret)
-    memcache.add(cache_key, True, time=self.credential_caching_period)
-
-
-
-
-
-
-
-
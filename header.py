@@ -0,0 +1,83 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Parses the Authorization headers understood by OAuthHandler:
+
+Facebook <user_id>|<auth_token>
+Google <user_id>|<auth_token>
+Twitter <user_id>|<auth_token>|<auth_token_secret>
+Ticket <ticket>
+
+parse_authorization_header() looks the scheme up in a table and splits the
+rest of the header once, so it runs in linear time however the header is
+crafted. Like the regular expressions it replaces, the last "|" separated
+fields are the token (and secret), and anything before them is the user ID.
+Tickets (see ticket.py) carry the user ID inside them, so for the Ticket
+scheme the whole credential is returned as the token.
+"""
+
+import verifier
+
+#Longer headers are rejected before any parsing is done.
+MAX_HEADER_LENGTH = 4096
+
+#Session tickets issued by OAuthHandler, see ticket.py.
+TICKET_SCHEME = "Ticket"
+
+#Number of "|" separated fields after the user ID, per scheme.
+SCHEMES = {
+    verifier.FACEBOOK_SERVICE: 1,
+    verifier.GOOGLE_SERVICE: 1,
+    verifier.TWITTER_SERVICE: 2,
+    TICKET_SCHEME: 0,
+}
+
+
+def parse_authorization_header(header, max_length=MAX_HEADER_LENGTH):
+    """-> (service, user_id, token, token_secret). token_secret is None except for Twitter.
+
+    For tickets, user_id is None and token is the ticket.
+
+    Raises an OAuthException if the header is malformed or too long.
+    """
+    if len(header) > max_length:
+        raise verifier.OAuthException("Authorization header is too long.")
+
+    service, _, credentials = header.partition(" ")
+    fields = SCHEMES.get(service)
+
+    if fields is None or "\n" in credentials or "\r" in credentials:
+        raise verifier.OAuthException("Malformed authorization header.")
+
+    parts = credentials.rsplit("|", fields)
+
+    if len(parts) != fields + 1 or not all(parts):
+        raise verifier.OAuthException("Malformed authorization header.")
+
+    if fields == 0:
+        return service, None, parts[0], None
+
+    if fields == 2:
+        return service, parts[0], parts[1], parts[2]
+
+    return service, parts[0], parts[1], None
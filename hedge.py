@@ -0,0 +1,276 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+
+"""
+Hedged requests for idempotent provider calls.
+
+A hedged request sends a second copy of a request when the first hasn't
+answered within a delay, and takes whichever answer comes first. The delay
+adapts to the provider: it is a high percentile (p95 by default) of recent
+response times, so only the slowest few percent of requests are hedged.
+
+The extra load is capped by a budget: every request earns budget tokens
+(0.05 by default), and a hedge costs one. So at most about 5% of requests
+send a second copy, however slow the provider gets.
+
+Verifiers share one HedgePolicy per provider name:
+
+import hedge
+hedge.policy_for("Facebook").percentile = 99
+hedge.policy_for("Facebook").stats()
+
+Hedging only suits requests that are safe to send twice, see
+OAuthVerifier.hedge_requests.
+"""
+
+import collections
+import Queue
+import sys
+import threading
+import time
+import urllib2
+
+import eventloop
+import metrics
+
+
+class HedgePolicy(object):
+    # Percentile of recent response times to wait before hedging.
+    percentile = 95
+
+    # Number of recent response times kept, and the number needed before
+    # the percentile is trusted over initial_delay.
+    window = 200
+    min_samples = 20
+    initial_delay = 0.25
+
+    # Bounds for the hedging delay, in seconds.
+    min_delay = 0.005
+    max_delay = 2.0
+
+    # Hedges allowed per request on average, and the most that can be saved up for bursts.
+    budget = 0.05
+    max_tokens = 10
+
+    def __init__(self, name, percentile=None, budget=None):
+        self.name = name
+
+        if percentile is not None:
+            self.percentile = percentile
+        if budget is not None:
+            self.budget = budget
+
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=self.window)
+        self.tokens = self.max_tokens
+
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self.throttled = 0
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def delay(self):
+        """-> seconds to wait for an answer before hedging."""
+        with self.lock:
+            delay = self.observed_percentile()
+
+        if delay is None:
+            delay = self.initial_delay
+
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def observed_percentile(self):
+        if len(self.samples) < self.min_samples:
+            return None
+
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100.0))]
+
+    def request_started(self):
+        with self.lock:
+            self.requests += 1
+            self.tokens = min(self.max_tokens, self.tokens + self.budget)
+
+    def acquire_hedge(self):
+        """-> True if the budget allows sending a hedge now."""
+        with self.lock:
+            if self.tokens < 1:
+                self.throttled += 1
+                outcome = "throttled"
+            else:
+                self.tokens -= 1
+                self.hedges += 1
+                outcome = "sent"
+
+        metrics.get_metrics().increment("oauth_hedges_total", {"provider": self.name, "outcome": outcome})
+        return outcome == "sent"
+
+    def record_win(self):
+        with self.lock:
+            self.wins += 1
+
+        metrics.get_metrics().increment("oauth_hedges_total", {"provider": self.name, "outcome": "won"})
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "wins": self.wins,
+                "throttled": self.throttled,
+                "observed_percentile": self.observed_percentile(),
+            }
+
+
+def is_answer(exc_info):
+    """Responses are answers, HTTP errors included. Connection errors and timeouts aren't."""
+    return exc_info is None or isinstance(exc_info[1], urllib2.HTTPError)
+
+
+def hedged_call(policy, attempt):
+    """Blocking version of hedged(). attempt() runs on worker threads. -> its first answer."""
+    policy.request_started()
+    answers = Queue.Queue()
+
+    def run(is_hedge):
+        started = time.time()
+        try:
+            answer = (is_hedge, attempt(), None)
+        except Exception:
+            answer = (is_hedge, None, sys.exc_info())
+
+        if is_answer(answer[2]):
+            policy.record_latency(time.time() - started)
+        answers.put(answer)
+
+    def launch(is_hedge):
+        thread = threading.Thread(target=run, args=(is_hedge,))
+        thread.daemon = True
+        thread.start()
+
+    launch(False)
+    pending = 1
+    errors = []
+
+    try:
+        answer = answers.get(timeout=policy.delay())
+    except Queue.Empty:
+        if policy.acquire_hedge():
+            launch(True)
+            pending += 1
+        answer = answers.get()
+
+    while True:
+        pending -= 1
+        is_hedge, value, exc_info = answer
+
+        if is_answer(exc_info):
+            if is_hedge:
+                policy.record_win()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return value
+
+        errors.append(exc_info)
+
+        #Give up once no other attempt can answer.
+        if not pending:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        answer = answers.get()
+
+
+def hedged(policy, attempt):
+    """Calls attempt() -> Future, and again if no answer came within policy.delay().
+
+    Returns a Future for the first answer. A response, including an HTTP
+    error response, is an answer; a connection error or timeout is not, so
+    the other attempt is waited for. If every attempt fails, the Future
+    fails with the first error. The losing attempt is left to finish on the
+    event loop, bounded by its own timeout. An error before the hedge is
+    sent fails the Future at once; hedging is not a retry.
+    """
+    policy.request_started()
+
+    loop = eventloop.get_event_loop()
+    result = eventloop.Future()
+    errors = []
+    pending = [0]
+
+    def launch(is_hedge):
+        started = time.time()
+        pending[0] += 1
+
+        def on_done(future):
+            pending[0] -= 1
+            exception = future.get_exception()
+
+            if is_answer(future.exc_info):
+                policy.record_latency(time.time() - started)
+
+                if not result.done:
+                    timer.cancel()
+                    if is_hedge:
+                        policy.record_win()
+
+                    if exception is None:
+                        result.set_result(future.result)
+                    else:
+                        result.set_exception(exception, future.exc_info[2])
+                return
+
+            errors.append(future.exc_info)
+
+            #Give up once no other attempt can answer.
+            if not pending[0]:
+                timer.cancel()
+                result.set_exception(errors[0][1], errors[0][2])
+
+        attempt().add_callback(on_done)
+
+    def send_hedge():
+        if not result.done and policy.acquire_hedge():
+            launch(True)
+
+    timer = loop.call_later(policy.delay(), send_hedge)
+    launch(False)
+    return result
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def policy_for(name):
+    """-> the process-wide HedgePolicy for a provider, created on first use."""
+    with _policies_lock:
+        policy = _policies.get(name)
+
+        if policy is None:
+            policy = _policies[name] = HedgePolicy(name)
+
+        return policy
@@ -0,0 +1,329 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Local verification of Google ID tokens (RS256 signed JWTs).
+
+Google signs ID tokens with keys published as a JWK set. KeySet keeps
+those keys in memory for as long as the Cache-Control header allows, and
+fetches them again early if a token names a key id it doesn't know. With
+warm keys, checking a token needs no network round trip at all.
+
+decode_id_token() raises ValueError for any token that fails verification.
+See verifier.GoogleIdTokenVerifier for the OAuthVerifier interface.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import re
+import socket
+import threading
+import time
+import urllib2
+
+import circuit
+import connection_pool
+import eventloop
+import singleflight
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+#ASN.1 DigestInfo prefix for SHA-256, from PKCS #1 v2.2, section 9.2.
+SHA256_DIGEST_INFO = "3031300d060960864801650304020105000420".decode("hex")
+
+
+def base64url_decode(data):
+    if isinstance(data, unicode):
+        data = data.encode("ascii")
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def bytes_to_int(data):
+    return int(data.encode("hex"), 16) if data else 0
+
+
+def int_to_bytes(value, length):
+    data = "%x" % value
+    data = ("0" * (len(data) % 2) + data).decode("hex")
+    return "\x00" * (length - len(data)) + data
+
+
+def verify_rs256(message, signature, modulus, exponent):
+    """Checks an RSASSA-PKCS1-v1_5 SHA-256 signature. -> True if it is valid."""
+    length = (modulus.bit_length() + 7) // 8
+
+    if len(signature) != length:
+        return False
+
+    value = bytes_to_int(signature)
+    if value >= modulus:
+        return False
+
+    digest_info = SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+    expected = "\x00\x01" + "\xff" * (length - len(digest_info) - 3) + "\x00" + digest_info
+
+    return hmac.compare_digest(int_to_bytes(pow(value, exponent, modulus), length), expected)
+
+
+class KeySet(object):
+    """A JWK set fetched over HTTPS and cached until its Cache-Control max-age runs out."""
+
+    # Used when the response has no usable max-age.
+    default_max_age = 3600
+
+    # Unknown key ids trigger a refresh at most this often, so tokens with
+    # made-up key ids can't make us hammer the certs endpoint.
+    min_refresh_interval = 30
+
+    # Seconds to wait for a connection to the certs endpoint, and for each
+    # read from it. Refreshes also stop at the caller's deadline.
+    connect_timeout = 5
+    read_timeout = 10
+
+    # Circuit breaker (see circuit.py) that refreshes report to and respect.
+    provider = "Google"
+
+    def __init__(self, url=GOOGLE_CERTS_URL, pool=None, connect_timeout=None, read_timeout=None):
+        self.url = url
+        self.pool = pool or connection_pool.default_pool
+        self.lock = threading.Lock()
+        self.flight = singleflight.SingleFlight()
+        self.keys = {}
+        self.expires_at = 0
+        self.fetched_at = 0
+
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+
+    def get_key(self, kid, deadline_at=None):
+        """-> (modulus, exponent) for kid, or None if the key set doesn't have it.
+
+        deadline_at is the time.time() by which a refresh must finish.
+        """
+        if self.needs_refresh(kid):
+            self.refresh(deadline_at)
+
+        return self.keys.get(kid)
+
+    @eventloop.tasklet
+    def get_key_async(self, kid, deadline_at=None):
+        """Non-blocking get_key(). Returns an eventloop.Future for the same result."""
+        if self.needs_refresh(kid):
+            yield self.flight.do_async(self.url, self.refresh_async, deadline_at)
+
+        raise eventloop.Return(self.keys.get(kid))
+
+    def needs_refresh(self, kid):
+        now = time.time()
+
+        if now >= self.expires_at:
+            return True
+
+        return kid not in self.keys and now - self.fetched_at >= self.min_refresh_interval
+
+    def refresh(self, deadline_at=None):
+        with self.lock:
+            now = time.time()
+
+            # Another thread may have refreshed while we waited for the lock.
+            if self.fetched_at > now - 1 and now < self.expires_at:
+                return
+
+            connect_timeout, read_timeout = self.begin_refresh(deadline_at)
+
+            try:
+                response = self.pool.urlopen(self.url, read_timeout, connect_timeout)
+            except Exception as e:
+                error = self.refresh_failed(e, deadline_at)
+                if error is e:
+                    raise
+                raise error
+
+            circuit.breaker_for(self.provider).record_success()
+            self.load_response(response)
+
+    @eventloop.tasklet
+    def refresh_async(self, deadline_at=None):
+        """Non-blocking refresh(), fetched without blocking the event loop."""
+        connect_timeout, read_timeout = self.begin_refresh(deadline_at)
+
+        timeout = connect_timeout + read_timeout
+        if deadline_at is not None:
+            timeout = min(timeout, deadline_at - time.time())
+
+        try:
+            response = yield eventloop.fetch(self.url, timeout, self.pool, connect_timeout)
+        except Exception as e:
+            error = self.refresh_failed(e, deadline_at)
+            if error is e:
+                raise
+            raise error
+
+        circuit.breaker_for(self.provider).record_success()
+        self.load_response(response)
+
+    def begin_refresh(self, deadline_at):
+        """-> (connect_timeout, read_timeout) for a refresh, cut down to the time left.
+
+        Raises DeadlineExceededException if there is no time left, and
+        CircuitOpenException if the provider's circuit breaker is open.
+        """
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+
+        if deadline_at is not None:
+            remaining = deadline_at - time.time()
+
+            if remaining <= 0:
+                raise circuit.DeadlineExceededException()
+
+            connect_timeout = min(connect_timeout, remaining)
+            read_timeout = min(read_timeout, remaining)
+
+        circuit.breaker_for(self.provider).before_request()
+        return connect_timeout, read_timeout
+
+    def refresh_failed(self, e, deadline_at):
+        """Records a failed refresh with the circuit breaker. -> the exception to raise.
+
+        Running into the caller's deadline says nothing about the provider,
+        so it isn't counted as a failure. Network and HTTP errors become
+        UpstreamExceptions.
+        """
+        if isinstance(e, socket.timeout) and deadline_at is not None and time.time() >= deadline_at - 0.001:
+            circuit.breaker_for(self.provider).record_abandoned()
+            return circuit.DeadlineExceededException()
+
+        if isinstance(e, urllib2.HTTPError) and e.code < 500:
+            circuit.breaker_for(self.provider).record_success()
+        else:
+            circuit.breaker_for(self.provider).record_failure()
+
+        return circuit.transport_error(self.provider, e)
+
+    def load_response(self, response):
+        # A broken key set says nothing about the token, so it mustn't
+        # surface as the ValueError that decode_id_token() raises for one.
+        try:
+            jwks = json.loads(response.read())
+        except ValueError:
+            jwks = None
+
+        if not isinstance(jwks, dict):
+            raise circuit.UpstreamException("Unreadable key set from %s." % self.url)
+
+        self.load(jwks, response.info().getheader("Cache-Control"))
+
+    def load(self, jwks, cache_control=None):
+        keys = {}
+
+        for jwk in jwks.get("keys", []):
+            if jwk.get("kty") == "RSA" and jwk.get("alg", "RS256") == "RS256" and "kid" in jwk:
+                keys[jwk["kid"]] = (bytes_to_int(base64url_decode(jwk["n"])),
+                                    bytes_to_int(base64url_decode(jwk["e"])))
+
+        max_age = self.default_max_age
+        match = re.search(r"max-age=(\d+)", cache_control or "")
+        if match:
+            max_age = int(match.group(1))
+
+        now = time.time()
+        self.keys = keys
+        self.fetched_at = now
+        self.expires_at = now + max_age
+
+
+def decode_id_token(token, key_set, audience, issuers=GOOGLE_ISSUERS, clock_skew=60, deadline_at=None):
+    """Verifies an ID token's signature, issuer, audience and expiry. -> claims dict.
+
+    audience may be a single client ID or a list of accepted client IDs.
+    deadline_at limits a signing key refresh, see KeySet.get_key().
+    Raises ValueError if the token is invalid.
+    """
+    header, claims, message, signature = split_id_token(token)
+    key = key_set.get_key(header.get("kid"), deadline_at)
+    return check_id_token(header, claims, message, signature, key, audience, issuers, clock_skew)
+
+
+@eventloop.tasklet
+def decode_id_token_async(token, key_set, audience, issuers=GOOGLE_ISSUERS, clock_skew=60, deadline_at=None):
+    """Non-blocking decode_id_token(). Returns an eventloop.Future for the claims."""
+    header, claims, message, signature = split_id_token(token)
+    key = yield key_set.get_key_async(header.get("kid"), deadline_at)
+    raise eventloop.Return(check_id_token(header, claims, message, signature, key, audience, issuers, clock_skew))
+
+
+def split_id_token(token):
+    """-> (header, claims, signed message, signature). Raises ValueError if token isn't an RS256 JWT."""
+    if isinstance(token, unicode):
+        token = token.encode("ascii")
+
+    parts = token.split(".")
+    if len(parts) != 3:
+        raise ValueError("ID token is not a JWT.")
+
+    try:
+        header = json.loads(base64url_decode(parts[0]))
+        claims = json.loads(base64url_decode(parts[1]))
+        signature = base64url_decode(parts[2])
+    except (TypeError, ValueError):
+        raise ValueError("ID token is not a JWT.")
+
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise ValueError("ID token is not a JWT.")
+
+    if header.get("alg") != "RS256":
+        raise ValueError("Unsupported ID token algorithm: %s" % header.get("alg"))
+
+    return header, claims, parts[0] + "." + parts[1], signature
+
+
+def check_id_token(header, claims, message, signature, key, audience, issuers, clock_skew):
+    if key is None:
+        raise ValueError("Unknown ID token signing key: %s" % header.get("kid"))
+
+    if not verify_rs256(message, signature, key[0], key[1]):
+        raise ValueError("Invalid ID token signature.")
+
+    if claims.get("iss") not in issuers:
+        raise ValueError("Invalid ID token issuer: %s" % claims.get("iss"))
+
+    audiences = [audience] if isinstance(audience, basestring) else audience
+    if claims.get("aud") not in audiences:
+        raise ValueError("ID token was issued for another audience: %s" % claims.get("aud"))
+
+    try:
+        expires_at = float(claims["exp"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("ID token has no expiry.")
+
+    if expires_at + clock_skew < time.time():
+        raise ValueError("ID token has expired.")
+
+    return claims
+
+
+google_key_set = KeySet()
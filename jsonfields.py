@@ -0,0 +1,176 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+
+"""
+Reads a few top-level fields from a JSON object without decoding all of it.
+
+Verifiers only need one or two fields from a provider's response. This
+scanner walks the object's members one at a time, decoding each with the
+json module's C scanner, and stops as soon as every wanted field has been
+seen. Data can be fed in chunks, for example straight out of a gzip
+decompressor, so the rest of the body is never even decompressed.
+
+scan_fields(['{"id": "123", "name": ...'], ["id"])  -> {u"id": u"123"}
+
+If the body isn't a JSON object, no fields are found. Invalid or truncated
+JSON raises ValueError, like json.loads.
+"""
+
+import json
+import re
+import zlib
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+_decoder = json.JSONDecoder()
+
+
+class FieldScanner(object):
+
+    def __init__(self, fields):
+        self.fields = frozenset(fields)
+        self.found = {}
+        self.done = not self.fields
+
+        self.buffer = ""
+        self.position = 0
+        self.expect = "{"
+        self.key = None
+
+    def feed(self, data):
+        """Adds the next chunk of the body. -> True once scanning is finished."""
+        if not self.done:
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+            self.scan(False)
+
+        return self.done
+
+    def close(self):
+        """Call after the last chunk. Raises ValueError if the JSON was incomplete."""
+        if not self.done:
+            self.scan(True)
+
+        if not self.done:
+            raise ValueError("Truncated JSON object.")
+
+    def scan(self, final):
+        buf = self.buffer
+        pos = self.position
+
+        while not self.done:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+
+            if self.expect == "{":
+                if buf[pos] != "{":
+                    # Not an object, so there are no fields to find.
+                    self.done = True
+                    break
+                pos += 1
+                self.expect = "key"
+
+            elif self.expect == "key" or self.expect == ",":
+                if buf[pos] == "}":
+                    self.done = True
+                    break
+
+                if self.expect == ",":
+                    if buf[pos] != ",":
+                        raise ValueError("Expecting , delimiter at %d" % pos)
+                    pos = WHITESPACE.match(buf, pos + 1).end()
+
+                try:
+                    self.key, end = _decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+
+                if not isinstance(self.key, basestring):
+                    raise ValueError("Expecting property name at %d" % pos)
+
+                pos = end
+                self.expect = ":"
+
+            elif self.expect == ":":
+                if buf[pos] != ":":
+                    raise ValueError("Expecting : delimiter at %d" % pos)
+                pos += 1
+                self.expect = "value"
+
+            else:
+                try:
+                    value, end = _decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+
+                # A number cut off by the end of the chunk may look complete
+                # ("12" of "12.5"), so wait until the delimiter after it arrives.
+                after = WHITESPACE.match(buf, end).end()
+                if not final and (after == len(buf) or buf[after] not in ",}"):
+                    break
+
+                if self.key in self.fields:
+                    self.found[self.key] = value
+                    self.done = len(self.found) == len(self.fields)
+
+                pos = end
+                self.expect = ","
+
+            self.position = pos
+
+
+def scan_fields(chunks, fields):
+    """-> dict of the wanted fields found in the JSON object whose text is split across chunks."""
+    scanner = FieldScanner(fields)
+
+    for chunk in chunks:
+        if scanner.feed(chunk):
+            break
+    else:
+        scanner.close()
+
+    return scanner.found
+
+
+def gunzip_chunks(data, chunk_size=8192):
+    """Yields gzip compressed data decompressed, chunk_size bytes at a time."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    chunk = decompressor.decompress(data, chunk_size)
+    while chunk:
+        yield chunk
+        chunk = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+
+    yield decompressor.flush()
+
+
+def decoded_chunks(body, content_encoding=None):
+    """-> the response body as chunks of text, decompressing it if it is gzipped."""
+    if content_encoding and content_encoding.strip().lower() == "gzip":
+        return gunzip_chunks(body)
+    return [body]
@@ -0,0 +1,183 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Metrics hook for verifications and credential caching.
+
+By default metrics go to a Metrics object that does nothing. To collect
+them in process:
+
+import metrics
+metrics.set_metrics(metrics.InMemoryMetrics())
+
+metrics.get_metrics().snapshot()   #Counters, gauges and histograms as dicts.
+metrics.get_metrics().exposition() #Prometheus text exposition format.
+
+To send them elsewhere (statsd, Cloud Monitoring...), subclass Metrics and
+implement increment(), observe() and gauge_add().
+
+Names recorded by this package:
+
+oauth_verification_seconds{provider}           histogram of provider round trips
+oauth_upstream_responses_total{provider,code}  provider status codes ("error" for network failures,
+                                               "deadline" for requests cut short by the caller's deadline)
+oauth_verifications_in_flight{provider}        gauge of provider requests in progress
+oauth_cache_lookups_total{result}              hit, miss, stale or negative
+oauth_local_cache_lookups_total{result}        hit or miss in the in-process cache
+oauth_shared_cache_lookups_total{result}       hit or miss in the cache shared between processes
+oauth_cache_refreshes_total{result}            background refreshes: ok, rejected or error
+oauth_circuit_breaker_transitions_total{provider,state}  circuit breaker state changes
+oauth_circuit_breaker_rejections_total{provider}         requests failed fast by an open breaker
+oauth_hedges_total{provider,outcome}                     hedged requests: sent, won or throttled by the budget
+oauth_rate_limit_rejections_total{provider,priority}     requests refused before sending to stay inside the rate limit
+"""
+
+import threading
+
+#Histogram bucket upper bounds, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    """Discards everything. Subclass it to send metrics somewhere."""
+
+    def increment(self, name, labels=None, value=1):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+    def gauge_add(self, name, value, labels=None):
+        pass
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append('%s="%s"' % (name, value))
+
+    return "{%s}" % ",".join(escaped)
+
+
+class InMemoryMetrics(Metrics):
+    """Keeps counters, gauges and histograms in memory. Thread-safe."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, labels=None, value=1):
+        key = (name, _label_key(labels))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name, value, labels=None):
+        key = (name, _label_key(labels))
+
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, _label_key(labels))
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        """-> dict of counters, gauges and histograms, keyed by (name, labels)."""
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": dict((key, {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]})
+                                   for key, h in self.histograms.items()),
+            }
+
+    def exposition(self):
+        """-> the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        for kind, values in (("counter", snapshot["counters"]), ("gauge", snapshot["gauges"])):
+            for name in sorted(set(name for name, _ in values)):
+                lines.append("# TYPE %s %s" % (name, kind))
+
+                for (metric_name, label_key), value in sorted(values.items()):
+                    if metric_name == name:
+                        lines.append("%s%s %s" % (name, _format_labels(label_key), value))
+
+        histograms = snapshot["histograms"]
+        for name in sorted(set(name for name, _ in histograms)):
+            lines.append("# TYPE %s histogram" % name)
+
+            for (metric_name, label_key), histogram in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (name, _format_labels(label_key, [("le", repr(bound))]), cumulative))
+
+                lines.append("%s_bucket%s %d" % (name, _format_labels(label_key, [("le", "+Inf")]), histogram["count"]))
+                lines.append("%s_sum%s %r" % (name, _format_labels(label_key), histogram["sum"]))
+                lines.append("%s_count%s %d" % (name, _format_labels(label_key), histogram["count"]))
+
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def set_metrics(metrics):
+    """Sets the process-wide metrics hook. Pass None to go back to the no-op default."""
+    global _metrics
+    _metrics = metrics or Metrics()
@@ -0,0 +1,115 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+WSGI middleware that checks Authorization headers before the application runs.
+
+application = middleware.OAuthMiddleware(application, consumer_key="abc", consumer_secret="def")
+
+The same headers as OAuthHandler are understood, and the same caching rules
+apply (see authorizer.py). Settings are passed to the Authorizer, or pass
+authorizer=MyAuthorizer() to share one you've configured.
+
+The application finds the result in the WSGI environ:
+
+environ["oauth.identity"] #authorizer.Identity(service, user_id, ticket), or None.
+environ["oauth.error"]    #The OAuthException, when the credentials were rejected.
+
+By default requests without valid credentials still reach the application,
+which decides what to do with them. With required=True they are answered
+with a 401 instead. When the provider can't give an answer (it can't be
+reached, answers with a 5xx, or runs past the deadline), the request is
+answered with a 503 either way. Issued tickets are added to the response in
+the ticket_response_header header. 503s caused by a provider's rate limit
+carry a Retry-After header.
+
+Python 2 has no ASGI; for event loop based servers, call
+Authorizer.authorize_async(), which verifies with the provider without
+blocking the loop.
+"""
+
+import math
+
+import verifier
+from authorizer import Authorizer
+
+IDENTITY_KEY = "oauth.identity"
+ERROR_KEY = "oauth.error"
+
+
+class OAuthMiddleware(object):
+
+    def __init__(self, application, authorizer=None, required=False, deadline=None, **settings):
+        if authorizer is None:
+            authorizer = Authorizer(**settings)
+        elif settings:
+            raise TypeError("Pass settings either to the Authorizer or to OAuthMiddleware, not both.")
+
+        self.application = application
+        self.authorizer = authorizer
+        self.required = required
+        self.deadline = deadline
+
+    def __call__(self, environ, start_response):
+        identity = None
+        error = None
+
+        authorization_header = environ.get("HTTP_AUTHORIZATION")
+
+        if authorization_header:
+            try:
+                identity = self.authorizer.authorize(authorization_header, self.deadline)
+            except verifier.OAuthException as e:
+                error = e
+            except verifier.UpstreamException as e:
+                headers = []
+                if getattr(e, "retry_after", None):
+                    headers.append(("Retry-After", str(int(math.ceil(e.retry_after)))))
+                return self.respond(start_response, "503 Service Unavailable", str(e), headers)
+        else:
+            error = verifier.OAuthException("Authorization header is required.")
+
+        environ[IDENTITY_KEY] = identity
+        environ[ERROR_KEY] = error
+
+        if identity is None and self.required:
+            return self.respond(start_response, "401 Unauthorized", "Authorization failed: %s" % error)
+
+        if identity is not None and identity.ticket:
+            start_response = self.adding_header(start_response, self.authorizer.ticket_response_header,
+                                                identity.ticket)
+
+        return self.application(environ, start_response)
+
+    @staticmethod
+    def adding_header(start_response, name, value):
+
+        def wrapped(status, headers, exc_info=None):
+            return start_response(status, list(headers) + [(name, value)], exc_info)
+
+        return wrapped
+
+    @staticmethod
+    def respond(start_response, status, message, headers=()):
+        body = message + "\n"
+        start_response(status, [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))] + list(headers))
+        return [body]
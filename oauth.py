@@ -29,6 +29,15 @@ import random
 import urlparse
 import hmac
 import binascii
+import os
+import struct
+import threading
+
+try:
+    import hashlib # 2.5
+    sha1 = hashlib.sha1
+except ImportError:
+    import sha as sha1 # Deprecated
 
 
 VERSION = '1.0' # Hi Blaine!
@@ -372,10 +381,13 @@ class OAuthServer(object):
     version = VERSION
     signature_methods = None
     data_store = None
+    nonce_store = None # If set, used instead of data_store.lookup_nonce.
 
-    def __init__(self, data_store=None, signature_methods=None):
+    def __init__(self, data_store=None, signature_methods=None,
+            nonce_store=None):
         self.data_store = data_store
         self.signature_methods = signature_methods or {}
+        self.nonce_store = nonce_store
 
     def set_data_store(self, data_store):
         self.data_store = data_store
@@ -494,7 +506,7 @@ class OAuthServer(object):
     def _check_signature(self, oauth_request, consumer, token):
         timestamp, nonce = oauth_request._get_timestamp_nonce()
         self._check_timestamp(timestamp)
-        self._check_nonce(consumer, token, nonce)
+        self._check_nonce(consumer, token, nonce, timestamp)
         signature_method = self._get_signature_method(oauth_request)
         try:
             signature = oauth_request.get_parameter('oauth_signature')
@@ -520,13 +532,141 @@ class OAuthServer(object):
                 'greater difference than threshold %d' %
                 (timestamp, now, self.timestamp_threshold))
 
-    def _check_nonce(self, consumer, token, nonce):
+    def _check_nonce(self, consumer, token, nonce, timestamp=None):
         """Verify that the nonce is uniqueish."""
+        if self.nonce_store is not None and timestamp is not None:
+            if self.nonce_store.check_and_add(consumer.key,
+                    token and token.key, timestamp, nonce):
+                raise OAuthError('Nonce already used: %s' % str(nonce))
+            return
         nonce = self.data_store.lookup_nonce(consumer, token, nonce)
         if nonce:
             raise OAuthError('Nonce already used: %s' % str(nonce))
 
 
+class OAuthNonceStore(object):
+    """Remembers used nonces for as long as their timestamps are accepted.
+
+    Nonces are kept in buckets by request timestamp, each 1/buckets of
+    timestamp_threshold wide. Once a bucket's timestamps are too old for
+    OAuthServer to accept, the whole bucket is dropped at once.
+
+    At most max_nonces nonces are kept. When the store is full, the oldest
+    bucket goes, and requests with timestamps from it are refused from then
+    on instead of risking a replay. The bucket holding the current time,
+    and any after it, never go: once only those are left, new nonces are
+    refused until the clock moves on. With bloom_bits set, each bucket also
+    has a Bloom filter of that many bits. It answers the usual "never seen"
+    case without touching the nonce sets, and when the store is full only
+    the oldest bucket's set is dropped. Its filter keeps catching replays,
+    at the cost of refusing a fresh nonce now and then.
+
+    Use it with OAuthServer(data_store, nonce_store=OAuthNonceStore()).
+    timestamp_threshold must be at least the server's. Thread-safe.
+    """
+    def __init__(self, timestamp_threshold=300, buckets=5,
+            max_nonces=1000000, bloom_bits=0, bloom_hashes=7):
+        self.timestamp_threshold = timestamp_threshold
+        self.bucket_width = max(1, timestamp_threshold // buckets)
+        self.max_nonces = max_nonces
+        self.bloom_bits = bloom_bits
+        self.bloom_hashes = bloom_hashes
+
+        self.lock = threading.Lock()
+        self.buckets = {} # Bucket number -> [set of keys or None, bloom or None].
+        self.count = 0
+        self.floor = 0 # Timestamps below this can't be checked any more.
+        self.expired_through = None
+
+    def check_and_add(self, consumer_key, token_key, timestamp, nonce):
+        """Records a nonce. -> True if it was used before, or can't be checked."""
+        timestamp = int(timestamp)
+        now = int(time.time())
+        key = _utf8_str('%s&%s&%d&%s' % (consumer_key, token_key or '',
+            timestamp, nonce))
+
+        with self.lock:
+            self._expire(now)
+
+            if (timestamp < self.floor or
+                    timestamp < now - self.timestamp_threshold):
+                return True
+
+            number = timestamp // self.bucket_width
+            bucket = self.buckets.get(number)
+            if bucket is None:
+                bucket = self.buckets[number] = [set(),
+                    bytearray((self.bloom_bits + 7) // 8) if self.bloom_bits else None]
+            nonces, bloom = bucket
+
+            if bloom is not None:
+                positions = self._bloom_positions(key)
+                if all(bloom[i >> 3] & (1 << (i & 7)) for i in positions):
+                    if nonces is None or key in nonces:
+                        return True
+                for i in positions:
+                    bloom[i >> 3] |= 1 << (i & 7)
+            elif key in nonces:
+                return True
+
+            if nonces is not None:
+                while self.count >= self.max_nonces:
+                    if not self._evict(now):
+                        return True
+                # The nonce's own bucket may just have gone.
+                if timestamp < self.floor:
+                    return True
+                if bucket[0] is not None:
+                    bucket[0].add(key)
+                    self.count += 1
+            return False
+
+    def __len__(self):
+        return self.count
+
+    def _expire(self, now):
+        # Only look for expired buckets when the clock enters a new bucket.
+        through = (now - self.timestamp_threshold) // self.bucket_width
+        if through == self.expired_through:
+            return
+        self.expired_through = through
+        for number in [n for n in self.buckets if n < through]:
+            self._drop(number)
+
+    def _evict(self, now):
+        """Forgets the oldest nonces. -> False if none can be forgotten."""
+        numbers = sorted(self.buckets)
+        if self.bloom_bits:
+            # Keep the filters; only the sets of the oldest buckets go.
+            for number in numbers:
+                nonces = self.buckets[number][0]
+                if nonces is not None:
+                    self.count -= len(nonces)
+                    self.buckets[number][0] = None
+                    return True
+            return False
+        # Dropping the bucket holding now would move floor past now, and
+        # refuse every request until the clock caught up.
+        number = numbers[0]
+        if number >= now // self.bucket_width:
+            return False
+        self._drop(number)
+        self.floor = max(self.floor, (number + 1) * self.bucket_width)
+        return True
+
+    def _drop(self, number):
+        nonces = self.buckets.pop(number)[0]
+        if nonces is not None:
+            self.count -= len(nonces)
+
+    def _bloom_positions(self, key):
+        # Double hashing: k positions from the two halves of one digest.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        h2 |= 1
+        return [(h1 + i * h2) % self.bloom_bits
+            for i in range(self.bloom_hashes)]
+
+
 class OAuthClient(object):
     """OAuthClient is a worker to attempt to execute a request."""
     consumer = None
@@ -626,12 +766,7 @@ class OAuthSignatureMethod_HMAC_SHA1(OAuthSignatureMethod):
             token)
 
         # HMAC object.
-        try:
-            import hashlib # 2.5
-            hashed = hmac.new(key, raw, hashlib.sha1)
-        except ImportError:
-            import sha # Deprecated
-            hashed = hmac.new(key, raw, sha)
+        hashed = hmac.new(key, raw, sha1)
 
         # Calculate the digest base 64.
         return binascii.b2a_base64(hashed.digest())[:-1]
@@ -654,3 +789,106 @@ class OAuthSignatureMethod_PLAINTEXT(OAuthSignatureMethod):
             token)
         return key
 
+
+class NonceSource(object):
+    """Hands out random hex nonces.
+
+    Random bytes come from os.urandom, read pool_size bytes at a time, so
+    each nonce is cryptographically random without costing a system call.
+    The pool belongs to the process that read it: a forked worker reads
+    its own instead of handing out the same nonces as its parent.
+    """
+    def __init__(self, nonce_bytes=16, pool_size=4096):
+        self.nonce_bytes = nonce_bytes
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.pool = ''
+        self.offset = 0
+        self.pid = None
+
+    def next(self):
+        with self.lock:
+            pid = os.getpid()
+            if self.offset + self.nonce_bytes > len(self.pool) or pid != self.pid:
+                self.pool = os.urandom(max(self.pool_size, self.nonce_bytes))
+                self.offset = 0
+                self.pid = pid
+            start = self.offset
+            self.offset += self.nonce_bytes
+            return binascii.hexlify(self.pool[start:self.offset])
+
+default_nonce_source = NonceSource()
+
+
+class OAuthSigner(object):
+    """Signs HMAC-SHA1 requests to one URL for one consumer.
+
+    Everything that doesn't depend on the token is worked out once: the
+    escaped key prefix, the normalized method and URL, and the escaped
+    static parameters. Signatures are the same as the ones
+    OAuthRequest.sign_request() builds with OAuthSignatureMethod_HMAC_SHA1
+    from the same parameters, timestamp and nonce.
+
+    Signers don't change after they are built, so they can be shared by
+    threads.
+    """
+    signature_method = OAuthSignatureMethod_HMAC_SHA1()
+
+    def __init__(self, consumer, http_method=HTTP_METHOD, http_url=None,
+            parameters=None, nonce_source=None):
+        self.consumer = consumer
+        self.http_method = http_method
+        self.http_url = http_url
+        self.nonce_source = nonce_source or default_nonce_source
+
+        request = OAuthRequest(http_method, http_url)
+        self.base_prefix = '%s&%s&' % (
+            escape(request.get_normalized_http_method()),
+            escape(request.get_normalized_http_url()))
+        self.key_prefix = '%s&' % escape(consumer.secret)
+
+        self.static_parameters = {
+            'oauth_consumer_key': consumer.key,
+            'oauth_signature_method': self.signature_method.get_name(),
+            'oauth_version': OAuthRequest.version,
+        }
+        self.static_parameters.update(parameters or {})
+        self.static_pairs = [(escape(_utf8_str(k)), escape(_utf8_str(v)))
+            for k, v in self.static_parameters.iteritems()]
+
+    def sign(self, token=None, timestamp=None, nonce=None):
+        """Returns the signed request's parameters, including oauth_signature."""
+        parameters = {
+            'oauth_timestamp': timestamp or generate_timestamp(),
+            'oauth_nonce': nonce or self.nonce_source.next(),
+        }
+        if token:
+            parameters['oauth_token'] = token.key
+            if token.callback:
+                parameters['oauth_callback'] = token.callback
+
+        key_values = self.static_pairs + [(escape(_utf8_str(k)),
+            escape(_utf8_str(v))) for k, v in parameters.iteritems()]
+        key_values.sort()
+        normalized = '&'.join(['%s=%s' % (k, v) for k, v in key_values])
+
+        key = self.key_prefix
+        if token:
+            key += escape(token.secret)
+        hashed = hmac.new(key, self.base_prefix + escape(normalized), sha1)
+
+        parameters.update(self.static_parameters)
+        parameters['oauth_signature'] = binascii.b2a_base64(hashed.digest())[:-1]
+        return parameters
+
+    def to_header(self, parameters, realm=''):
+        """Serialize signed parameters as a header, like OAuthRequest.to_header()."""
+        auth_header = 'OAuth realm="%s"' % realm
+        for k in sorted(parameters):
+            if k[:6] == 'oauth_':
+                auth_header += ', %s="%s"' % (k, escape(str(parameters[k])))
+        return {'Authorization': auth_header}
+
+    def sign_header(self, token=None, realm=''):
+        """Signs a request and returns its Authorization header."""
+        return self.to_header(self.sign(token), realm)
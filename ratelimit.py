@@ -0,0 +1,247 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Paces provider requests to stay inside the quota the provider reports.
+
+Twitter answers every request with x-rate-limit-limit,
+x-rate-limit-remaining and x-rate-limit-reset headers. A RateLimiter
+remembers them, counts the requests sent since, and spreads what is left
+of the quota evenly until the reset, allowing short bursts of up to burst
+requests. A request that would have to wait longer than it may (see
+reserve()) fails at once with RateLimitedException instead of being sent
+and answered with a 429.
+
+Requests have a priority. INTERACTIVE requests (a user waiting to log in)
+may use the whole quota. BACKGROUND requests (re-verifying cached
+credentials early) leave reserve_fraction of the quota alone, and are
+refused once only that is left.
+
+Twitter counts verify_credentials calls against each user's access
+token, so verifiers share one limiter per consumer key and token. A 429
+that doesn't come from the token's own quota running out means the whole
+application is being limited; it backs off every request for the consumer
+key until the reset. That limiter learns from nothing else:
+
+import ratelimit
+ratelimit.limiter_for("Twitter", (consumer_key, token)).stats()
+ratelimit.limiter_for("Twitter", consumer_key).stats()
+
+Until a provider has sent its quota headers, nothing is limited. The
+least recently used limiters are dropped once there are max_limiters.
+"""
+
+import collections
+import math
+import threading
+import time
+
+import metrics
+from circuit import UpstreamException
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+
+class RateLimitedException(UpstreamException):
+
+    def __init__(self, provider, retry_after=None):
+        message = "%s rate limit exhausted" % provider
+        if retry_after is not None and retry_after > 0:
+            message += "; retry in %d seconds" % math.ceil(retry_after)
+
+        UpstreamException.__init__(self, message + ".")
+        self.provider = provider
+        self.retry_after = retry_after if retry_after is not None and retry_after > 0 else None
+
+
+# Most limiters kept at once, one per token seen recently.
+max_limiters = 10000
+
+
+def header_number(headers, name):
+    try:
+        value = headers.getheader(name)
+        return float(value) if value is not None else None
+    except (AttributeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    # Requests that may be sent back to back before pacing starts.
+    burst = 5
+
+    # Share of the quota BACKGROUND requests leave for INTERACTIVE ones.
+    reserve_fraction = 0.2
+
+    # Most seconds a request may wait for its turn, when its deadline allows.
+    max_wait = 2.0
+
+    # Seconds to back off after a 429 that didn't say when the quota resets.
+    default_retry_after = 60
+
+    def __init__(self, provider, burst=None, reserve_fraction=None, max_wait=None):
+        self.provider = provider
+        if burst is not None:
+            self.burst = burst
+        if reserve_fraction is not None:
+            self.reserve_fraction = reserve_fraction
+        if max_wait is not None:
+            self.max_wait = max_wait
+
+        self.lock = threading.Lock()
+
+        # From the provider's headers; None until it has sent them.
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+
+        # When the next request is due, if requests were evenly spaced (GCRA).
+        self.next_at = 0.0
+
+        self.rejections = 0
+
+    def roll_over(self, now):
+        if self.reset_at is not None and now >= self.reset_at:
+            # A new window has started; wait for the provider to describe it.
+            self.remaining = None
+            self.reset_at = None
+            self.next_at = 0.0
+
+    def reserve(self, priority=INTERACTIVE, max_wait=None):
+        """Takes a place for one request. -> seconds to wait before sending it.
+
+        max_wait is the most the caller can wait (e.g. until its deadline);
+        it is cut down to the limiter's own max_wait. Raises
+        RateLimitedException if the request would have to wait longer, or
+        if only the INTERACTIVE reserve is left for a BACKGROUND request.
+        """
+        max_wait = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+
+        with self.lock:
+            now = time.time()
+            self.roll_over(now)
+
+            if self.remaining is None:
+                return 0.0
+
+            window = max(self.reset_at - now, 0.001)
+            reserved = math.ceil((self.limit or self.remaining) * self.reserve_fraction) if priority == BACKGROUND else 0
+            available = self.remaining - reserved
+
+            if available < 1:
+                #Nothing left until the reset.
+                if priority == BACKGROUND or window > max_wait:
+                    self.reject(priority)
+                    raise RateLimitedException(self.provider, window)
+
+                return window
+
+            interval = window / available
+            next_at = max(self.next_at, now)
+            wait = max(0.0, next_at - now - (self.burst - 1) * interval)
+
+            if wait > max_wait:
+                self.reject(priority)
+                raise RateLimitedException(self.provider, wait)
+
+            self.next_at = next_at + interval
+            self.remaining -= 1
+            return wait
+
+    def reject(self, priority):
+        self.rejections += 1
+        metrics.get_metrics().increment("oauth_rate_limit_rejections_total",
+                                        {"provider": self.provider,
+                                         "priority": PRIORITY_NAMES.get(priority, str(priority))})
+
+    def back_off(self, headers, code):
+        """Learns from a response only if it is a 429 the token's own quota doesn't explain."""
+        if code == 429 and not quota_exhausted(headers):
+            self.update(headers, code)
+
+    def update(self, headers, code=None):
+        """Learns the quota from a response's headers. code is its HTTP status."""
+        limit = header_number(headers, "x-rate-limit-limit")
+        remaining = header_number(headers, "x-rate-limit-remaining")
+        reset_at = header_number(headers, "x-rate-limit-reset")
+
+        with self.lock:
+            now = time.time()
+
+            if code == 429:
+                #A reset in the past means our clocks disagree; back off anyway.
+                if reset_at is None or reset_at <= now:
+                    retry_after = header_number(headers, "retry-after")
+                    reset_at = now + (retry_after if retry_after is not None else self.default_retry_after)
+                remaining = 0
+
+            if remaining is None or reset_at is None or reset_at <= now:
+                return
+
+            if limit is not None:
+                self.limit = limit
+
+            if self.reset_at is not None and abs(reset_at - self.reset_at) < 1:
+                # Same window: requests sent after this one was answered aren't counted in it yet.
+                self.remaining = min(self.remaining, remaining)
+            else:
+                self.remaining = remaining
+                self.next_at = 0.0
+
+            self.reset_at = reset_at
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "remaining": self.remaining,
+                "reset_at": self.reset_at,
+                "rejections": self.rejections,
+            }
+
+
+def quota_exhausted(headers):
+    """-> whether a response's x-rate-limit-* headers say its quota has run out."""
+    return header_number(headers, "x-rate-limit-remaining") == 0
+
+
+_limiters = collections.OrderedDict()
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(provider, key=None):
+    """-> the process-wide RateLimiter for a provider and key, created on first use."""
+    with _limiters_lock:
+        limiter = _limiters.pop((provider, key), None)
+
+        if limiter is None:
+            limiter = RateLimiter(provider)
+
+            while len(_limiters) >= max_limiters:
+                _limiters.popitem(last=False)
+
+        # Re-inserting moves the key to the most recently used end.
+        _limiters[provider, key] = limiter
+        return limiter
@@ -0,0 +1,139 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Coalesces concurrent calls that share a key into a single call.
+
+When several requests carrying the same credentials miss the cache at the
+same time, only the first one (the leader) verifies them with the provider.
+The others wait for the leader and get its result or exception.
+
+flight = SingleFlight()
+user_id = flight.do(cache_key, verifier.verify)
+
+do() is for threads. do_async() takes a function returning an
+eventloop.Future and coalesces tasklets running on the same event loop.
+"""
+
+import sys
+import threading
+
+import eventloop
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.local = threading.local()
+
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, function, *args, **kwargs):
+        """Calls function(*args, **kwargs) unless a call for key is already running.
+
+        In that case, waits for the running call and returns its result or
+        raises its exception.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            call.event.wait()
+
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+    def do_async(self, key, function, *args, **kwargs):
+        """Like do(), for a function returning an eventloop.Future.
+
+        Calls are coalesced per thread, since each thread runs its own event loop.
+        """
+        futures = getattr(self.local, "futures", None)
+        if futures is None:
+            futures = self.local.futures = {}
+
+        leader_future = futures.get(key)
+
+        if leader_future is None:
+            leader_future = futures[key] = function(*args, **kwargs)
+
+            with self.lock:
+                self.leaders += 1
+
+            def on_done(future):
+                futures.pop(key, None)
+
+            leader_future.add_callback(on_done)
+            return leader_future
+
+        with self.lock:
+            self.coalesced += 1
+
+        follower = eventloop.Future()
+
+        def on_leader_done(future):
+            if future.exc_info:
+                follower.set_exception(future.exc_info[1], future.exc_info[2])
+            else:
+                follower.set_result(future.result)
+
+        leader_future.add_callback(on_leader_done)
+        return follower
+
+    def stats(self):
+        with self.lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "in_flight": len(self.calls),
+            }
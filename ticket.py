@@ -0,0 +1,153 @@
+"""The MIT License
+
+Copyright (c) 2007 Nigel Brady
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE. """
+
+"""
+Short-lived session tickets, signed with HMAC-SHA256.
+
+After a user has been verified with their provider, OAuthHandler can hand
+them a ticket naming the service, the user ID and an expiry. Clients send
+the ticket back instead of their provider token:
+
+Authorization: Ticket <ticket>
+
+Checking a ticket takes one HMAC and no cache or network round trip.
+Tickets look like <key id>.<payload>.<signature>, with the payload and
+signature base64url encoded.
+
+signer = ticket.TicketSigner({"2016-01": "secret one", "2016-02": "secret two"},
+                             current_key_id="2016-02", ttl=300)
+value = signer.issue("Facebook", "1234")
+service, user_id, expires_at = signer.verify(value)
+
+New tickets are signed with current_key_id; tickets signed with any key in
+keys are accepted. To rotate, add the new key everywhere, then make it
+current, then remove the old one once its tickets have expired.
+
+verify() raises ValueError for any ticket that is malformed, signed with an
+unknown key, forged or expired. A ticket can't be revoked before it expires,
+so keep ttl short.
+"""
+
+import base64
+import hashlib
+import hmac
+import time
+
+
+def base64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip("=")
+
+
+def base64url_decode(data):
+    if isinstance(data, unicode):
+        data = data.encode("ascii")
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class TicketSigner(object):
+    # How long issued tickets are valid, in seconds.
+    ttl = 300
+
+    def __init__(self, keys, current_key_id=None, ttl=None):
+        if not keys:
+            raise ValueError("At least one ticket key is required.")
+
+        if current_key_id is None:
+            if len(keys) != 1:
+                raise ValueError("current_key_id is required when there are several keys.")
+            current_key_id = list(keys)[0]
+
+        if current_key_id not in keys:
+            raise ValueError("Unknown ticket key: %s" % current_key_id)
+
+        if ttl is not None:
+            self.ttl = ttl
+
+        # Keyed HMACs are built once and copied for each ticket.
+        self.macs = {}
+        for key_id, secret in keys.items():
+            if not key_id or "." in key_id:
+                raise ValueError("Ticket key ids must be non-empty and can't contain '.': %r" % key_id)
+            self.macs[key_id] = hmac.new(secret, digestmod=hashlib.sha256)
+
+        self.current_key_id = current_key_id
+
+    def signature(self, key_id, signed):
+        mac = self.macs[key_id].copy()
+        mac.update(signed)
+        return mac.digest()
+
+    def issue(self, service, user_id, now=None, expires_at=None):
+        """-> a ticket for user_id, valid for ttl seconds.
+
+        expires_at caps the ticket's expiry, e.g. at the provider token's.
+        Returns None if that leaves the ticket no time at all.
+        """
+        if isinstance(user_id, unicode):
+            user_id = user_id.encode("utf-8")
+
+        now = now or time.time()
+        expires_at = int(min(now + self.ttl, expires_at) if expires_at is not None else now + self.ttl)
+
+        if expires_at <= now:
+            return None
+
+        payload = "%d|%s|%s" % (expires_at, service, user_id)
+
+        signed = self.current_key_id + "." + base64url_encode(payload)
+        return signed + "." + base64url_encode(self.signature(self.current_key_id, signed))
+
+    def verify(self, ticket, now=None):
+        """-> (service, user_id, expires_at). Raises ValueError if the ticket isn't valid."""
+        if isinstance(ticket, unicode):
+            try:
+                ticket = ticket.encode("ascii")
+            except UnicodeError:
+                raise ValueError("Malformed ticket.")
+
+        signed, _, encoded_signature = ticket.rpartition(".")
+        key_id, _, encoded_payload = signed.partition(".")
+
+        if not key_id or not encoded_payload or not encoded_signature:
+            raise ValueError("Malformed ticket.")
+
+        if key_id not in self.macs:
+            raise ValueError("Ticket was signed with an unknown key: %s" % key_id)
+
+        try:
+            signature = base64url_decode(encoded_signature)
+        except TypeError:
+            raise ValueError("Malformed ticket.")
+
+        if not hmac.compare_digest(self.signature(key_id, signed), signature):
+            raise ValueError("Invalid ticket signature.")
+
+        try:
+            expires_at, service, user_id = base64url_decode(encoded_payload).split("|", 2)
+            expires_at = int(expires_at)
+        except (TypeError, ValueError):
+            raise ValueError("Malformed ticket.")
+
+        if expires_at <= (now or time.time()):
+            raise ValueError("Ticket has expired.")
+
+        return service, user_id, expires_at
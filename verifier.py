@@ -87,7 +87,104 @@ __author__ = 'Nigel Brady'
 import urllib
 import urllib2
 import json
+import socket
+import time
 import oauth
+import circuit
+import connection_pool
+import eventloop
+import hedge
+import idtoken
+import jsonfields
+import metrics
+import ratelimit
+
+from circuit import UpstreamException, CircuitOpenException, DeadlineExceededException
+from ratelimit import RateLimitedException
+
+TWITTER_SERVICE = "Twitter"
+FACEBOOK_SERVICE = "Facebook"
+GOOGLE_SERVICE = "Google"
+
+
+def record_response(provider, started, code):
+    """Records a provider round trip that began at started with metrics and the provider's circuit breaker."""
+    m = metrics.get_metrics()
+    m.observe("oauth_verification_seconds", time.time() - started, {"provider": provider})
+    m.increment("oauth_upstream_responses_total", {"provider": provider, "code": str(code)})
+
+    if code == "deadline":
+        #The caller's deadline cut the request short, which says nothing
+        #about the provider, so it counts as neither success nor failure.
+        circuit.breaker_for(provider).record_abandoned()
+    elif code == "error" or code >= 500:
+        circuit.breaker_for(provider).record_failure()
+    else:
+        circuit.breaker_for(provider).record_success()
+
+
+def deadline_after(deadline):
+    """-> the time.time() at which a deadline of that many seconds runs out, or None for no deadline."""
+    return time.time() + deadline if deadline is not None else None
+
+
+def capped(timeout, remaining):
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def timeouts_before(connect_timeout, read_timeout, deadline_at):
+    """-> (connect_timeout, read_timeout) cut down to the time left before deadline_at.
+
+    Raises DeadlineExceededException if there is no time left.
+    """
+    if deadline_at is None:
+        return connect_timeout, read_timeout
+
+    remaining = deadline_at - time.time()
+
+    if remaining <= 0:
+        raise DeadlineExceededException()
+
+    return capped(connect_timeout, remaining), capped(read_timeout, remaining)
+
+
+def begin_request(provider, connect_timeout, read_timeout, deadline_at):
+    """Call before sending a request to provider. -> (connect_timeout, read_timeout) to use.
+
+    See timeouts_before(). Also raises CircuitOpenException if the provider's
+    circuit breaker is open.
+    """
+    timeouts = timeouts_before(connect_timeout, read_timeout, deadline_at)
+    circuit.breaker_for(provider).before_request()
+    return timeouts
+
+
+def fetch_timeout(connect_timeout, read_timeout, deadline_at):
+    """-> the overall timeout for eventloop.fetch() from begin_request()'s timeouts."""
+    timeout = None
+    if connect_timeout is not None and read_timeout is not None:
+        timeout = connect_timeout + read_timeout
+    if deadline_at is not None:
+        timeout = capped(timeout, deadline_at - time.time())
+    return timeout
+
+
+def failure_code(error):
+    """-> the record_response() code for a request that failed with upstream_error()'s error."""
+    return "deadline" if isinstance(error, DeadlineExceededException) else "error"
+
+
+def upstream_error(e, deadline_at, provider="The provider"):
+    """-> the exception to raise for a failed request.
+
+    DeadlineExceededException if it timed out at the deadline, an
+    UpstreamException for other network and HTTP errors (see
+    circuit.transport_error()), or e itself.
+    """
+    #Socket timeouts never fire early, so allow for clock granularity only.
+    if isinstance(e, socket.timeout) and deadline_at is not None and time.time() >= deadline_at - 0.001:
+        return DeadlineExceededException()
+    return circuit.transport_error(provider, e)
 
 
 class OAuthVerifier:
@@ -98,6 +195,41 @@ class OAuthVerifier:
     request = None
     debug = False
 
+    #Label used for this verifier's metrics.
+    provider = "unknown"
+
+    #Shared keep-alive connection pool. Replace it to change the pool size.
+    pool = connection_pool.default_pool
+
+    #Seconds to wait for a connection to the provider, and for each read
+    #from it (for verify_async(), for the whole response). None waits forever.
+    connect_timeout = 5
+    read_timeout = 10
+
+    #Send a second copy of requests that are slower than usual, and use
+    #whichever answer comes first. See hedge.py. Only turn this on for
+    #requests that are safe to send twice.
+    hedge_requests = False
+
+    #Response fields with the token's lifetime in seconds, or the time it
+    #expires (seconds since the epoch), for providers that report them.
+    #verify() fills in expires_at from them, so credentials aren't cached
+    #for longer than the token lives.
+    expires_in_field = None
+    expires_at_field = None
+    expires_at = None
+
+    #Providers whose rate limits are tracked (see rate_limiter()) serve
+    #INTERACTIVE requests first and refuse BACKGROUND ones before the
+    #quota runs out. See ratelimit.py.
+    priority = ratelimit.INTERACTIVE
+
+    #Ask the provider for as small a response as it can give (see
+    #lean_parameters), gzipped, and stop reading it once user_id_field
+    #has been found.
+    lean_requests = True
+    lean_parameters = {}
+
     def __init__(self, token, user_id, url, user_id_field="id", debug=False):
         self.token = token
         self.user_id = user_id
@@ -105,48 +237,226 @@ class OAuthVerifier:
         self.user_id_field = user_id_field
         self.debug = debug
 
-    def verify(self):
+    def verify(self, deadline=None):
+        """Checks the token with the provider. -> the verified user ID.
+
+        deadline is the most seconds to spend, like urlfetch's deadline.
+        Raises OAuthException if the provider rejects the token, and
+        UpstreamException (DeadlineExceededException, CircuitOpenException)
+        if the provider couldn't be asked in time.
+        """
+        deadline_at = deadline_after(deadline)
+        self.prepare_request()
+        return self.execute_request(deadline_at)
+
+    @eventloop.tasklet
+    def verify_async(self, deadline=None):
+        """Non-blocking verify(). Returns an eventloop.Future for the same result."""
+        deadline_at = deadline_after(deadline)
+        self.prepare_request()
+        user_id = yield self.execute_request_async(deadline_at)
+        raise eventloop.Return(user_id)
+
+    def prepare_request(self):
         if not self.token or not self.user_id:
             raise Exception("You must provide a user ID and oAuth access token to proceed.")
 
+        query_string = urllib.urlencode(self.query_parameters())
+        self.request = urllib2.Request(self.url + "?" + query_string, headers=self.request_headers())
+
+    def query_parameters(self):
         params = {"access_token": self.token}
-        query_string = urllib.urlencode(params)
-        self.request = self.url + "?" + query_string
-        return self.execute_request()
 
-    def execute_request(self):
-        try:
-            result = urllib2.urlopen(self.request)
-            response = result.read()
+        if self.lean_requests:
+            params.update(self.lean_parameters)
 
-            result_dict = json.loads(response)
+        return params
 
-            if self.debug:
-                print response
+    def request_headers(self):
+        return {"Accept-Encoding": "gzip"} if self.lean_requests else {}
 
-            if self.user_id_field in result_dict and result_dict[self.user_id_field] == self.user_id:
-                return result_dict[self.user_id_field]
-            else:
-                raise OAuthException()
+    def execute_request(self, deadline_at=None):
+        delay = self.quota_delay(deadline_at)
+        if delay:
+            time.sleep(delay)
+
+        connect_timeout, read_timeout = begin_request(self.provider, self.connect_timeout,
+                                                      self.read_timeout, deadline_at)
 
+        labels = {"provider": self.provider}
+        metrics.get_metrics().gauge_add("oauth_verifications_in_flight", 1, labels)
+        started = time.time()
+
+        try:
+            result = self.urlopen(read_timeout, connect_timeout, deadline_at)
         except urllib2.HTTPError as e:
-            if e.code == 401:
-                raise OAuthException("Authorization failed.")
-            elif e.code == 400:
-                raise OAuthException("Bad request. Auth token is likely invalid.")
-            else:
-                raise e
+            self.record_response(started, e.code, e.info())
+            self.handle_http_error(e)
+        except Exception as e:
+            error = upstream_error(e, deadline_at, self.provider)
+            self.record_response(started, failure_code(error))
+            if error is e:
+                raise
+            raise error
+        finally:
+            metrics.get_metrics().gauge_add("oauth_verifications_in_flight", -1, labels)
+
+        self.record_response(started, result.getcode(), result.info())
+        return self.process_response(result.read(), result.info().getheader("Content-Encoding"))
+
+    @eventloop.tasklet
+    def execute_request_async(self, deadline_at=None):
+        delay = self.quota_delay(deadline_at)
+        if delay:
+            yield eventloop.sleep(delay)
+
+        connect_timeout, read_timeout = begin_request(self.provider, self.connect_timeout,
+                                                      self.read_timeout, deadline_at)
+
+        timeout = fetch_timeout(connect_timeout, read_timeout, deadline_at)
+
+        labels = {"provider": self.provider}
+        metrics.get_metrics().gauge_add("oauth_verifications_in_flight", 1, labels)
+        started = time.time()
+
+        try:
+            result = yield self.fetch_async(timeout, connect_timeout)
+        except urllib2.HTTPError as e:
+            self.record_response(started, e.code, e.info())
+            self.handle_http_error(e)
+        except Exception as e:
+            error = upstream_error(e, deadline_at, self.provider)
+            self.record_response(started, failure_code(error))
+            if error is e:
+                raise
+            raise error
+        finally:
+            metrics.get_metrics().gauge_add("oauth_verifications_in_flight", -1, labels)
+
+        self.record_response(started, result.getcode(), result.info())
+        raise eventloop.Return(self.process_response(result.read(), result.info().getheader("Content-Encoding")))
+
+    def urlopen(self, read_timeout, connect_timeout, deadline_at=None):
+        if not self.hedge_requests:
+            return self.pool.urlopen(self.request, read_timeout, connect_timeout)
+
+        def attempt():
+            #The hedge starts later, but must still finish by the deadline.
+            timeouts = timeouts_before(connect_timeout, read_timeout, deadline_at)
+            return self.pool.urlopen(self.request, timeouts[1], timeouts[0])
+
+        return hedge.hedged_call(hedge.policy_for(self.provider), attempt)
+
+    def fetch_async(self, timeout, connect_timeout):
+        if not self.hedge_requests:
+            return eventloop.fetch(self.request, timeout, self.pool, connect_timeout)
+
+        ends_at = time.time() + timeout if timeout is not None else None
+
+        def attempt():
+            remaining = max(0, ends_at - time.time()) if ends_at is not None else None
+            return eventloop.fetch(self.request, remaining, self.pool, connect_timeout)
+
+        return hedge.hedged(hedge.policy_for(self.provider), attempt)
+
+    def record_response(self, started, code, headers=None):
+        record_response(self.provider, started, code)
+
+        if headers is None:
+            return
+
+        limiter = self.rate_limiter()
+        if limiter is not None:
+            limiter.update(headers, code)
+
+        backoff = self.backoff_limiter()
+        if backoff is not None:
+            backoff.back_off(headers, code)
+
+    def rate_limiter(self):
+        """-> the ratelimit.RateLimiter pacing requests for this token, or None."""
+        return None
+
+    def backoff_limiter(self):
+        """-> the ratelimit.RateLimiter that backs off the whole application after a 429, or None."""
+        return None
+
+    def quota_delay(self, deadline_at=None):
+        """-> seconds to wait before sending, to stay inside the provider's rate limit.
+
+        Raises RateLimitedException if the wait would run past the deadline
+        or the limiter's max_wait.
+        """
+        max_wait = max(0, deadline_at - time.time()) if deadline_at is not None else None
+        delay = 0
+
+        for limiter in (self.backoff_limiter(), self.rate_limiter()):
+            if limiter is not None:
+                delay = max(delay, limiter.reserve(self.priority, max_wait))
+
+        return delay
+
+    def process_response(self, response, content_encoding=None):
+        chunks = jsonfields.decoded_chunks(response, content_encoding)
+
+        if self.debug:
+            chunks = ["".join(chunks)]
+            print chunks[0]
+
+        fields = jsonfields.scan_fields(chunks, self.response_fields())
+        return self.check_fields(fields)
+
+    def response_fields(self):
+        """-> the top-level response fields check_fields() needs."""
+        return tuple(field for field in (self.user_id_field, self.expires_in_field, self.expires_at_field) if field)
+
+    def check_fields(self, fields):
+        if self.user_id_field in fields and fields[self.user_id_field] == self.user_id:
+            self.expires_at = self.expiry_from(fields)
+            return fields[self.user_id_field]
+        else:
+            raise OAuthException()
+
+    def expiry_from(self, fields):
+        """-> when the token expires according to the response, or None if it doesn't say."""
+        try:
+            if self.expires_in_field in fields:
+                return time.time() + float(fields[self.expires_in_field])
+            if self.expires_at_field in fields:
+                return float(fields[self.expires_at_field])
+        except (TypeError, ValueError):
+            pass
+
+        return None
+
+    def handle_http_error(self, e):
+        if e.code == 401:
+            raise OAuthException("Authorization failed.", e.code)
+        elif e.code == 400:
+            raise OAuthException("Bad request. Auth token is likely invalid.", e.code)
+        elif e.code == 429:
+            resets = [limiter.stats()["reset_at"] for limiter in (self.rate_limiter(), self.backoff_limiter()) if limiter]
+            reset_at = max([reset for reset in resets if reset] or [None])
+            raise RateLimitedException(self.provider, reset_at - time.time() if reset_at else None)
+        else:
+            raise circuit.transport_error(self.provider, e)
 
 
 class OAuthException(Exception):
-    def __init__(self):
-        Exception.__init__(self, "Access token invalid or does not belong to the current user.")
+    #HTTP status from the provider when it rejected the token (400 or 401).
+    code = None
 
-    def __init__(self, message):
+    def __init__(self, message="Access token invalid or does not belong to the current user.", code=None):
         Exception.__init__(self, message)
+        self.code = code
 
 
 class FacebookVerifier(OAuthVerifier):
+    provider = FACEBOOK_SERVICE
+    lean_parameters = {"fields": "id"}
+
+    #/me doesn't say when the token expires, so expires_at stays None.
+
     def __init__(self, token, user_id, debug=False):
         OAuthVerifier.__init__(self,
                                token,
@@ -155,7 +465,215 @@ class FacebookVerifier(OAuthVerifier):
                                debug=debug)
 
 
+class FacebookBatchVerifier:
+    """Verifies many Facebook tokens using Graph API batch requests.
+
+    credentials is a list of (token, user_id) pairs. Up to max_batch_size of
+    them go into each request to the batch endpoint, and the results come back
+    as a list holding, for each pair, the user ID or the exception that
+    FacebookVerifier.verify() would have raised.
+
+    The Graph API requires a top level access token on every batch, so pass
+    your app access token ("app_id|app_secret"). Without one, the first token
+    of each batch is used, and if Facebook rejects the whole batch its tokens
+    are verified one by one instead. When the whole batch fails for any other
+    reason (a rejected app access token, or a server error), that says
+    nothing about the tokens in it, so each of them gets an UpstreamException.
+    """
+    url = "https://graph.facebook.com/"
+    max_batch_size = 50
+    pool = connection_pool.default_pool
+
+    #Batches take longer than single requests, so they get a longer read timeout.
+    connect_timeout = 5
+    read_timeout = 20
+
+    def __init__(self, credentials, app_access_token=None, debug=False):
+        self.credentials = list(credentials)
+        self.app_access_token = app_access_token
+        self.debug = debug
+
+    def verify(self, deadline=None):
+        deadline_at = deadline_after(deadline)
+        results, batches = self.prepare_batches()
+
+        for batch in batches:
+            try:
+                connect_timeout, read_timeout = begin_request(FACEBOOK_SERVICE, self.connect_timeout,
+                                                              self.read_timeout, deadline_at)
+            except UpstreamException as e:
+                for i in batch:
+                    results[i] = e
+                continue
+
+            started = time.time()
+
+            try:
+                response = self.pool.urlopen(self.request_for(batch), read_timeout, connect_timeout)
+            except urllib2.HTTPError as e:
+                record_response(FACEBOOK_SERVICE, started, e.code)
+
+                if self.verifies_one_by_one(e):
+                    for i in batch:
+                        results[i] = self.verify_one(i, deadline_at)
+                else:
+                    for i in batch:
+                        results[i] = self.batch_error(e)
+                continue
+
+            except Exception as e:
+                error = upstream_error(e, deadline_at, FACEBOOK_SERVICE)
+                record_response(FACEBOOK_SERVICE, started, failure_code(error))
+                for i in batch:
+                    results[i] = error
+                continue
+
+            record_response(FACEBOOK_SERVICE, started, 200)
+            self.split_batch(batch, response, results)
+
+        return results
+
+    @eventloop.tasklet
+    def verify_async(self, deadline=None):
+        deadline_at = deadline_after(deadline)
+        results, batches = self.prepare_batches()
+        yield [self.verify_batch_async(batch, results, deadline_at) for batch in batches]
+        raise eventloop.Return(results)
+
+    @eventloop.tasklet
+    def verify_batch_async(self, batch, results, deadline_at=None):
+        try:
+            connect_timeout, read_timeout = begin_request(FACEBOOK_SERVICE, self.connect_timeout,
+                                                          self.read_timeout, deadline_at)
+        except UpstreamException as e:
+            for i in batch:
+                results[i] = e
+            return
+
+        timeout = fetch_timeout(connect_timeout, read_timeout, deadline_at)
+        started = time.time()
+
+        try:
+            result = yield eventloop.fetch(self.request_for(batch), timeout, self.pool, connect_timeout)
+            record_response(FACEBOOK_SERVICE, started, 200)
+
+        except urllib2.HTTPError as e:
+            record_response(FACEBOOK_SERVICE, started, e.code)
+
+            if self.verifies_one_by_one(e):
+                for i in batch:
+                    try:
+                        results[i] = yield self.verifier_for(i).verify_async(self.remaining(deadline_at))
+                    except Exception as item_error:
+                        results[i] = item_error
+            else:
+                for i in batch:
+                    results[i] = self.batch_error(e)
+
+        except Exception as e:
+            error = upstream_error(e, deadline_at, FACEBOOK_SERVICE)
+            record_response(FACEBOOK_SERVICE, started, failure_code(error))
+            for i in batch:
+                results[i] = error
+
+        else:
+            self.split_batch(batch, result, results)
+
+    def remaining(self, deadline_at):
+        """-> seconds left before deadline_at, as a deadline for the fallback verifiers."""
+        return max(0, deadline_at - time.time()) if deadline_at is not None else None
+
+    def prepare_batches(self):
+        results = [None] * len(self.credentials)
+        valid = []
+
+        for i, (token, user_id) in enumerate(self.credentials):
+            if not token or not user_id:
+                results[i] = Exception("You must provide a user ID and oAuth access token to proceed.")
+            else:
+                valid.append(i)
+
+        batches = [valid[i:i + self.max_batch_size] for i in range(0, len(valid), self.max_batch_size)]
+        return results, batches
+
+    def request_for(self, batch):
+        operations = [{"method": "GET",
+                       "relative_url": "me?" + urllib.urlencode(self.verifier_for(i).query_parameters())}
+                      for i in batch]
+
+        params = {"batch": json.dumps(operations),
+                  "include_headers": "false",
+                  "access_token": self.app_access_token or self.credentials[batch[0]][0]}
+
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        headers.update(self.verifier_for(batch[0]).request_headers())
+
+        return urllib2.Request(self.url, urllib.urlencode(params), headers)
+
+    def verifier_for(self, i):
+        token, user_id = self.credentials[i]
+        return FacebookVerifier(token, user_id, debug=self.debug)
+
+    def verifies_one_by_one(self, e):
+        """Whether to verify the tokens of a batch that failed with HTTPError e one by one.
+
+        Only when the batch went out under its first token and Facebook
+        refused it, since that may be over the first token alone.
+        """
+        return not self.app_access_token and e.code in (400, 401, 403)
+
+    def batch_error(self, e):
+        """-> the exception for each token of a batch that failed as a whole with HTTPError e."""
+        if e.code == 429:
+            return RateLimitedException(FACEBOOK_SERVICE, None)
+        return circuit.transport_error(FACEBOOK_SERVICE + " batch", e)
+
+    def verify_one(self, i, deadline_at=None):
+        """Verifies one token of a rejected batch on its own. -> the user ID or the exception."""
+        try:
+            return self.verifier_for(i).verify(self.remaining(deadline_at))
+        except Exception as e:
+            return e
+
+    def split_batch(self, batch, result, results):
+        try:
+            chunks = jsonfields.decoded_chunks(result.read(), result.info().getheader("Content-Encoding"))
+            self.split_response(batch, "".join(chunks), results)
+        except Exception as e:
+            error = UpstreamException("Unreadable Facebook batch response: %s" % e)
+            for i in batch:
+                results[i] = error
+
+    def split_response(self, batch, response, results):
+        responses = json.loads(response)
+
+        if not isinstance(responses, list) or len(responses) != len(batch):
+            raise ValueError("Unexpected Graph API batch response.")
+
+        for i, item in zip(batch, responses):
+            single = self.verifier_for(i)
+
+            try:
+                # Facebook answers null for operations it didn't get to in time.
+                if not item:
+                    raise UpstreamException("Facebook did not complete this batch operation.")
+
+                code = item.get("code")
+                if code != 200:
+                    single.handle_http_error(urllib2.HTTPError(self.url, code, "Batch operation failed.", None, None))
+
+                results[i] = single.process_response(item.get("body"))
+
+            except Exception as e:
+                results[i] = e
+
+
 class GoogleVerifier(OAuthVerifier):
+    provider = GOOGLE_SERVICE
+
+    #tokeninfo reports the seconds the access token has left.
+    expires_in_field = "expires_in"
+
     def __init__(self, token, user_id, debug=False):
         OAuthVerifier.__init__(self,
                                token,
@@ -164,11 +682,84 @@ class GoogleVerifier(OAuthVerifier):
                                "user_id", debug=debug)
 
 
+class GoogleIdTokenVerifier(OAuthVerifier):
+    """Verifies a Google ID token locally, without calling Google.
+
+    token is the ID token (a JWT) from Google Sign-In, and audience is your
+    OAuth client ID, or a list of them. Signing keys are fetched from Google
+    and cached, see idtoken.py.
+    """
+    audience = None
+    key_set = idtoken.google_key_set
+    provider = GOOGLE_SERVICE
+
+    def __init__(self, token, user_id, audience, debug=False):
+        OAuthVerifier.__init__(self,
+                               token,
+                               user_id,
+                               idtoken.GOOGLE_CERTS_URL,
+                               "sub", debug=debug)
+
+        self.audience = audience
+
+    def verify(self, deadline=None):
+        #Tokens are checked locally. Only a signing key refresh calls Google,
+        #within KeySet's timeouts, the deadline and Google's circuit breaker.
+        self.check_token_given()
+
+        try:
+            claims = idtoken.decode_id_token(self.token, self.key_set, self.audience,
+                                             deadline_at=deadline_after(deadline))
+        except ValueError as e:
+            raise OAuthException(str(e))
+
+        return self.check_claims(claims)
+
+    @eventloop.tasklet
+    def verify_async(self, deadline=None):
+        #A signing key refresh is fetched without blocking the event loop.
+        self.check_token_given()
+
+        try:
+            claims = yield idtoken.decode_id_token_async(self.token, self.key_set, self.audience,
+                                                         deadline_at=deadline_after(deadline))
+        except ValueError as e:
+            raise OAuthException(str(e))
+
+        raise eventloop.Return(self.check_claims(claims))
+
+    def check_token_given(self):
+        if not self.token or not self.user_id:
+            raise Exception("You must provide a user ID and oAuth access token to proceed.")
+
+    def check_claims(self, claims):
+        if self.debug:
+            print claims
+
+        if claims.get(self.user_id_field) != self.user_id:
+            raise OAuthException()
+
+        self.expires_at = float(claims["exp"])
+        return claims[self.user_id_field]
+
+
 class TwitterVerifier(OAuthVerifier):
+    provider = TWITTER_SERVICE
+    lean_parameters = {"skip_status": "true", "include_entities": "false"}
+
+    #A second copy would reuse the signed request's nonce, and be rejected as a replay.
+    hedge_requests = False
+
     consumer_key = None
     consumer_secret = None
     token_secret = None
 
+    #One oauth.OAuthSigner per (consumer key, consumer secret, url, parameters), shared by every instance.
+    signers = {}
+
+    #Pace requests by the x-rate-limit-* headers Twitter sends.
+    rate_limit_requests = True
+
     def __init__(self, token, user_id, consumer_key, consumer_secret, token_secret, debug=False):
         OAuthVerifier.__init__(self,
                                token,
@@ -181,22 +772,126 @@ class TwitterVerifier(OAuthVerifier):
         self.consumer_secret = consumer_secret
         self.token_secret = token_secret
 
-    def verify(self):
-        consumer = oauth.OAuthConsumer(self.consumer_key, self.consumer_secret)
-        signature_method_hmac_sha1 = oauth.OAuthSignatureMethod_HMAC_SHA1()
+    def prepare_request(self):
+        params = self.query_parameters()
         oauth_token = oauth.OAuthToken(self.token, self.token_secret)
 
-        oauth_request = oauth.OAuthRequest.from_consumer_and_token(consumer,
-                                                                   token=oauth_token,
-                                                                   http_method='GET',
-                                                                   http_url=self.url)
-
-        oauth_request.sign_request(signature_method_hmac_sha1, consumer, oauth_token)
-
-        headers = oauth_request.to_header()
-        self.request = urllib2.Request(self.url, headers=headers)
-        return self.execute_request()
-
-
-
-
+        headers = self.signer(params).sign_header(oauth_token)
+        headers.update(self.request_headers())
+
+        url = self.url + "?" + urllib.urlencode(params) if params else self.url
+        self.request = urllib2.Request(url, headers=headers)
+
+    def query_parameters(self):
+        return dict(self.lean_parameters) if self.lean_requests else {}
+
+    def rate_limiter(self):
+        #verify_credentials is limited per user access token, so each token gets its own limiter.
+        return ratelimit.limiter_for(self.provider, (self.consumer_key, self.token)) if self.rate_limit_requests else None
+
+    def backoff_limiter(self):
+        #Shared by every token of the consumer key, and only fed 429s (see ratelimit.py).
+        return ratelimit.limiter_for(self.provider, self.consumer_key) if self.rate_limit_requests else None
+
+    def signer(self, params):
+        key = (self.consumer_key, self.consumer_secret, self.url, tuple(sorted(params.items())))
+        signer = TwitterVerifier.signers.get(key)
+
+        if signer is None:
+            consumer = oauth.OAuthConsumer(self.consumer_key, self.consumer_secret)
+            signer = TwitterVerifier.signers[key] = oauth.OAuthSigner(consumer, 'GET', self.url, params)
+
+        return signer
+
+
+def verifier_for(service, user_id, token, token_secret=None,
+                 consumer_key=None, consumer_secret=None, debug=False, google_audience=None):
+    """Returns the verifier for a service name ('Facebook', 'Google' or 'Twitter').
+
+    If google_audience is set, Google tokens are treated as ID tokens for that
+    client ID and verified locally.
+    """
+    if service == FACEBOOK_SERVICE:
+        return FacebookVerifier(token, user_id, debug=debug)
+    elif service == GOOGLE_SERVICE and google_audience:
+        return GoogleIdTokenVerifier(token, user_id, google_audience, debug=debug)
+    elif service == GOOGLE_SERVICE:
+        return GoogleVerifier(token, user_id, debug=debug)
+    elif service == TWITTER_SERVICE:
+        return TwitterVerifier(token, user_id, consumer_key, consumer_secret, token_secret, debug=debug)
+    else:
+        raise OAuthException("%s authentication not supported." % service)
+
+
+def verify_many(credentials, consumer_key=None, consumer_secret=None, max_concurrency=10, debug=False,
+                facebook_batch=False, facebook_app_access_token=None):
+    """Verifies a list of (service, user_id, token[, token_secret]) tuples.
+
+    Duplicate credentials are only sent to the provider once, and at most
+    max_concurrency provider requests are in flight at a time. Returns a list
+    in input order holding the verified user ID, or the exception raised, for
+    each item. consumer_key and consumer_secret are only needed for Twitter.
+
+    With facebook_batch=True, Facebook tokens are packed into Graph API batch
+    requests, see FacebookBatchVerifier.
+    """
+    return verify_many_async(credentials, consumer_key, consumer_secret, max_concurrency, debug,
+                             facebook_batch, facebook_app_access_token).get_result()
+
+
+@eventloop.tasklet
+def verify_many_async(credentials, consumer_key=None, consumer_secret=None, max_concurrency=10, debug=False,
+                      facebook_batch=False, facebook_app_access_token=None):
+    """Non-blocking verify_many(). Returns an eventloop.Future for the result list."""
+    credentials = [tuple(c) for c in credentials]
+
+    positions = {}
+    unique = []
+    for c in credentials:
+        if c not in positions:
+            positions[c] = len(unique)
+            unique.append(c)
+
+    results = [None] * len(unique)
+    jobs = range(len(unique))
+
+    if facebook_batch:
+        batched = [i for i in jobs if len(unique[i]) == 3 and unique[i][0] == FACEBOOK_SERVICE]
+        size = FacebookBatchVerifier.max_batch_size
+
+        in_batch = set(batched)
+        jobs = [i for i in jobs if i not in in_batch]
+        jobs += [batched[i:i + size] for i in range(0, len(batched), size)]
+
+    pending = iter(jobs)
+
+    @eventloop.tasklet
+    def worker():
+        # Workers share one iterator, so each job is taken exactly once.
+        for i in pending:
+            if isinstance(i, list):
+                batch_verifier = FacebookBatchVerifier([(unique[j][2], unique[j][1]) for j in i],
+                                                       facebook_app_access_token, debug=debug)
+                try:
+                    batch_results = yield batch_verifier.verify_async()
+                except Exception as e:
+                    batch_results = [e] * len(i)
+
+                for j, result in zip(i, batch_results):
+                    results[j] = result
+                continue
+
+            try:
+                if not 3 <= len(unique[i]) <= 4:
+                    raise ValueError("Expected (service, user_id, token[, token_secret]), got %r" % (unique[i],))
+
+                v = verifier_for(*unique[i], consumer_key=consumer_key,
+                                 consumer_secret=consumer_secret, debug=debug)
+                results[i] = yield v.verify_async()
+
+            except Exception as e:
+                results[i] = e
+
+    yield [worker() for _ in range(min(max(1, max_concurrency), len(unique)))]
+
+    raise eventloop.Return([results[positions[c]] for c in credentials])